@@ -0,0 +1,117 @@
+"""Benchmarks shipping a directory to a container, comparing the previous approach (tar to a temp file,
+read it fully into memory) with the streaming tar generator.
+
+Each mode runs in its own process so peak RSS can be measured independently.  By default the archive
+is consumed by a sink that discards it, which isolates the archiving cost.  Pass --container to upload
+into a running container with put_archive instead.
+
+    python benchmarks/bench_tar_stream.py --size-gb 2
+    python benchmarks/bench_tar_stream.py --size-gb 2 --container <container id>
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from harborml import core  # noqa: E402
+
+
+def make_dataset(path, size_gb, file_mb):
+    os.makedirs(path, exist_ok = True)
+    file_size = file_mb * 1024 * 1024
+    num_files = max(1, int(size_gb * 1024 / file_mb))
+    block = os.urandom(1024 * 1024)
+    for i in range(num_files):
+        sub = os.path.join(path, 'part{:03d}'.format(i // 100))
+        os.makedirs(sub, exist_ok = True)
+        with open(os.path.join(sub, 'file{:05d}.bin'.format(i)), 'wb') as f:
+            for _ in range(file_size // len(block)):
+                f.write(block)
+    return num_files * file_size
+
+
+def upload(data, container_id):
+    if container_id is None:
+        if isinstance(data, bytes):
+            return len(data)
+        return sum(len(chunk) for chunk in data)
+    container = core._docker_client().containers.get(container_id)
+    container.exec_run('mkdir -p /tmp/bench')
+    container.put_archive('/tmp/bench', data)
+    return None
+
+
+def run_tempfile(path, container_id):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tar_file = os.path.join(tmp_dir, 'bench.tar')
+        with tarfile.open(tar_file, mode = 'w') as tar:
+            tar.add(path, arcname = '')
+        data = open(tar_file, 'rb').read()
+        upload(data, container_id)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_stream(path, container_id):
+    upload(core._tar_stream(core._iter_directory_entries(path)), container_id)
+
+
+def child(mode, path, container_id):
+    start = time.time()
+    {'tempfile': run_tempfile, 'stream': run_stream}[mode](path, container_id)
+    elapsed = time.time() - start
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    print('{} {}'.format(elapsed, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-gb', type = float, default = 2.0, help = 'Size of the synthetic directory')
+    parser.add_argument('--file-mb', type = int, default = 64, help = 'Size of each synthetic file')
+    parser.add_argument('--dir', default = None, help = 'Existing directory to ship instead of a synthetic one')
+    parser.add_argument('--container', default = None, help = 'Running container to upload into')
+    parser.add_argument('--child', nargs = 2, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.container)
+        return
+
+    work_dir = None
+    path = args.dir
+    if path is None:
+        work_dir = tempfile.mkdtemp()
+        path = os.path.join(work_dir, 'data')
+        print('Writing {:.2f} GB synthetic dataset to {}'.format(args.size_gb, path))
+        total = make_dataset(path, args.size_gb, args.file_mb)
+    else:
+        total = sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(path) for f in fs)
+    try:
+        print('{:<10} {:>10} {:>14} {:>14}'.format('mode', 'seconds', 'MB/s', 'peak RSS MB'))
+        for mode in ['tempfile', 'stream']:
+            cmd = [sys.executable, __file__, '--child', mode, path]
+            if args.container:
+                cmd += ['--container', args.container]
+            out = subprocess.run(cmd, check = True, stdout = subprocess.PIPE, universal_newlines = True).stdout
+            elapsed, peak = out.split()
+            elapsed = float(elapsed)
+            print('{:<10} {:>10.2f} {:>14.1f} {:>14.1f}'.format(
+                mode, elapsed, total / 1024 / 1024 / elapsed, int(peak) / 1024 / 1024))
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
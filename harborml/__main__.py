@@ -1,9 +1,18 @@
+import asyncio
 import click
+import json
+import time
+from . import constants as _constants
 from . import core as _core
 
 @click.group()
-def cli():
-    pass
+@click.option('--api-timings', is_flag=True, help='Print how long each Docker API call took when the command finishes')
+@click.pass_context
+def cli(ctx, api_timings):
+    if api_timings:
+        session = ctx.with_resource(_core.docker_session())
+        # runs before the session is closed
+        ctx.call_on_close(session.print_stats)
 
 @click.command()
 @click.option('--dir', default='./', help='Directory of the project')
@@ -16,21 +25,37 @@ cli.add_command(start_project)
 @click.command()
 @click.argument('container')
 @click.option('--dir', default='./', help='Directory of the project')
-def build_container(container, dir):
+@click.option('--rebuild', is_flag=True, help='Rebuild the image even if a cached build is available')
+def build_container(container, dir, rebuild):
     """Builds a container
 
     CONTAINER: Name of the container that the training script will run in
     """
-    return _core.build_container(dir, container)
+    return _core.build_container(dir, container, rebuild = rebuild)
 
 cli.add_command(build_container)
 
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+def prune_images(dir):
+    """Removes stale images and entries from the project build cache
+    """
+    for tag in _core.prune_images(dir):
+        print("Removed " + tag)
+
+cli.add_command(prune_images)
+
 @click.command()
 @click.argument('train_model_file')
 @click.argument('container')
 @click.option('--dir', default='./', help='Directory of the project')
 @click.option('--model_name', default='', help='Name of the model')
-def train_model(train_model_file, container, dir, model_name):
+@click.option('--rebuild', is_flag=True, help='Rebuild the image even if a cached build is available')
+@click.option('--transfer', default=None, type=click.Choice(['copy', 'sync', 'mount']), help='How the project is transferred to the container, defaults to the strategy in project.ini')
+@click.option('--artifact', multiple=True, help='Only copy back output files matching this glob, can be given more than once')
+@click.option('--force', is_flag=True, help='Train even if the script, data and container are unchanged')
+@click.option('--stream', is_flag=True, help='Print the script output as it runs, and keep a copy in .harborml/logs')
+def train_model(train_model_file, container, dir, model_name, rebuild, transfer, artifact, force, stream):
     """Trains a model, and saves the results written to the "output" folder in the "model" folder
 
     TRAIN_MODEL_FILE: Name/path of file in src folder that will train a model and save the results to the "output" folder
@@ -39,27 +64,175 @@ def train_model(train_model_file, container, dir, model_name):
     """
     if model_name == '': 
         model_name = None
-    _core.train_model(dir, container, train_model_file, model_name = model_name)
+    _core.train_model(dir, container, train_model_file, model_name = model_name, rebuild = rebuild, transfer = transfer,
+        artifacts = list(artifact) or None, force = force, stream_logs = stream)
 
 cli.add_command(train_model)
 
+@click.command()
+@click.argument('container')
+@click.argument('train_model_files', nargs=-1)
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--map', 'container_map', multiple=True, help='Run a script in another container, as SCRIPT=CONTAINER')
+@click.option('--workers', default=_constants.DEFAULT_TRAIN_WORKERS, type=int, help='Maximum number of trainings running at once')
+@click.option('--cpus', default=None, type=float, help='CPU limit per container')
+@click.option('--memory', default=None, help='Memory limit per container, for example 2g')
+@click.option('--rebuild', is_flag=True, help='Rebuild the images even if a cached build is available')
+@click.option('--transfer', default=None, type=click.Choice(['copy', 'sync', 'mount']), help='How the project is transferred to the containers, defaults to the strategy in project.ini')
+@click.option('--artifact', multiple=True, help='Only copy back output files matching this glob, can be given more than once')
+@click.option('--force', is_flag=True, help='Train models even if they are up to date')
+@click.option('--stream', is_flag=True, help='Print the script output as it runs, and keep a copy in .harborml/logs')
+def train_many(container, train_model_files, dir, container_map, workers, cpus, memory, rebuild, transfer, artifact, force,
+    stream):
+    """Trains several models in parallel
+
+    CONTAINER: Name of the container that the training scripts run in
+
+    TRAIN_MODEL_FILES: Training scripts in the src folder, defaults to every train_*/fit_* script
+    """
+    containers = {}
+    for entry in container_map:
+        if '=' not in entry:
+            raise click.BadParameter("expected SCRIPT=CONTAINER, got " + entry, param_hint='--map')
+        script, name = entry.split('=', 1)
+        containers[script] = name
+    jobs = _core.train_many(
+        dir, container, train_model_files = list(train_model_files) or None, containers = containers,
+        max_workers = workers, cpus = cpus, mem_limit = memory, rebuild = rebuild, transfer = transfer,
+        artifacts = list(artifact) or None, force = force, stream_logs = stream)
+    if any(x['status'] == 'failed' for x in jobs):
+        raise SystemExit(1)
+
+cli.add_command(train_many)
+
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+def model_cache_stats(dir):
+    """Prints model cache hits and misses as JSON
+    """
+    print(json.dumps(_core.model_cache_stats(dir)))
+
+cli.add_command(model_cache_stats)
+
 @click.command()
 @click.argument('model_scorer')
 @click.argument('container')
 @click.option('--dir', default='./', help='Directory of the project')
 @click.option('--model_name', default='', help='Name of the model')
 @click.option('--include_data', default='0', help='Whether the data directory should be copied to the container')
-def deploy_model(model_scorer, container, dir, model_name, include_data):
+@click.option('--rebuild', is_flag=True, help='Rebuild the image even if a cached build is available')
+@click.option('--transfer', default=None, type=click.Choice(['copy', 'sync', 'mount']), help='How the project is transferred to the container, defaults to the strategy in project.ini')
+@click.option('--server', default=None, type=click.Choice(['flask', 'gunicorn']), help='Server for python models, defaults to the serving settings in project.ini')
+@click.option('--workers', default=None, type=int, help='Number of gunicorn worker processes')
+@click.option('--threads', default=None, type=int, help='Number of threads per gunicorn worker')
+@click.option('--worker_class', default=None, help='Gunicorn worker class, for example sync or gthread')
+@click.option('--timeout', default=None, type=int, help='Gunicorn worker timeout in seconds')
+@click.option('--preload/--no-preload', default=None, help='Load the model once before forking gunicorn workers')
+@click.option('--microbatch/--no-microbatch', default=None, help='Group concurrent requests into batches for api_predict_batch')
+@click.option('--max_batch_size', default=None, type=int, help='Largest micro-batch')
+@click.option('--max_wait_ms', default=None, type=float, help='Longest time a request waits for its micro-batch to fill')
+@click.option('--cache/--no-cache', default=None, help='Cache responses for repeated requests')
+@click.option('--cache_size', default=None, type=int, help='Maximum number of cached responses per worker')
+@click.option('--cache_ttl', default=None, type=float, help='Seconds a cached response stays valid')
+@click.option('--load', default=None, type=click.Choice(['eager', 'lazy']), help='Import the deploy script when the server starts, or on first use in each worker')
+@click.option('--mmap/--no-mmap', default=None, help='Memory-map NumPy arrays of model files loaded with artifacts.load')
+@click.option('--warmup/--no-warmup', default=None, help='Load the model in each worker as it starts and call api_warmup before reporting ready')
+@click.option('--readiness_timeout', default=None, type=float, help='Seconds to wait for the new version to pass its health check')
+@click.option('--drain_seconds', default=None, type=float, help='Seconds the previous version keeps serving in-flight requests after the switch')
+@click.option('--replicas', default=None, type=int, help='Number of containers serving the model')
+@click.option('--balance', default=None, type=click.Choice(['round_robin', 'least_conn', 'ip_hash', 'random']), help='How nginx spreads requests over the replicas')
+@click.option('--keepalive', default=None, type=int, help='Idle connections nginx keeps open to the replicas')
+@click.option('--artifact_version', default=None, type=int, help='Deploy this version from the artifact store instead of the current model output')
+def deploy_model(model_scorer, container, dir, model_name, include_data, rebuild, transfer, server, workers, threads,
+    worker_class, timeout, preload, microbatch, max_batch_size, max_wait_ms, cache, cache_size, cache_ttl, load,
+    mmap, warmup, readiness_timeout, drain_seconds, replicas, balance, keepalive, artifact_version):
     """Deploys a model in a docker container.
 
     MODEL_SCORER: File in source that has a "predict" function that takes data and returns a prediction
 
     CONTAINER: Name of the container that the training script will run in
     """
-    _core.deploy_model(dir, container, model_scorer, model_name, include_data = include_data)
+    serving = {
+        'server': server,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': worker_class,
+        'timeout': timeout,
+        'preload': preload,
+        'microbatch': microbatch,
+        'max_batch_size': max_batch_size,
+        'max_wait_ms': max_wait_ms,
+        'cache': cache,
+        'cache_size': cache_size,
+        'cache_ttl': cache_ttl,
+        'load': load,
+        'mmap': mmap,
+        'warmup': warmup
+    }
+    _core.deploy_model(dir, container, model_scorer, model_name, include_data = include_data, rebuild = rebuild, transfer = transfer,
+        serving = serving, readiness_timeout = readiness_timeout, drain_seconds = drain_seconds,
+        replicas = replicas, balance = balance, keepalive = keepalive, artifact_version = artifact_version)
 
 cli.add_command(deploy_model)
 
+@click.command()
+@click.argument('container')
+@click.argument('model_scorers', nargs=-1, required=True)
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--map', 'container_map', multiple=True, help='Deploy a script in another container, as SCRIPT=CONTAINER')
+@click.option('--concurrency', default=_constants.DEFAULT_TRAIN_WORKERS, type=int, help='Maximum number of builds and deployments running at once')
+@click.option('--rebuild', is_flag=True, help='Rebuild the images even if a cached build is available')
+@click.option('--transfer', default=None, type=click.Choice(['copy', 'sync', 'mount']), help='How the project is transferred to the containers, defaults to the strategy in project.ini')
+def deploy_many(container, model_scorers, dir, container_map, concurrency, rebuild, transfer):
+    """Deploys several models at once, switching the reverse proxy to all of them with one reload
+
+    CONTAINER: Name of the container that the models are deployed in
+
+    MODEL_SCORERS: Deploy scripts in the src folder
+    """
+    containers = {}
+    for entry in container_map:
+        if '=' not in entry:
+            raise click.BadParameter("expected SCRIPT=CONTAINER, got " + entry, param_hint='--map')
+        script, name = entry.split('=', 1)
+        containers[script] = name
+    models = [{'model_api_file': x, 'container_name': containers.get(x, container)} for x in model_scorers]
+    results = asyncio.run(_core.deploy_models(dir, container, models, max_concurrency = concurrency,
+        rebuild = rebuild, transfer = transfer))
+    if any(x['status'] == 'failed' for x in results):
+        raise SystemExit(1)
+
+cli.add_command(deploy_many)
+
+@click.command()
+@click.argument('model_name')
+@click.argument('replicas', type=int)
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--readiness_timeout', default=None, type=float, help='Seconds to wait for new replicas to pass their health check')
+@click.option('--drain_seconds', default=None, type=float, help='Seconds removed replicas keep serving in-flight requests')
+def scale_model(model_name, replicas, dir, readiness_timeout, drain_seconds):
+    """Changes the number of containers serving a deployed model
+
+    MODEL_NAME: Name of the model
+
+    REPLICAS: Number of containers to run
+    """
+    _core.scale_model(dir, model_name, replicas, readiness_timeout = readiness_timeout, drain_seconds = drain_seconds)
+
+cli.add_command(scale_model)
+
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--model_name', default=None, help='Only show rollouts of this model')
+def rollout_history(dir, model_name):
+    """Shows recent deploys with their duration, readiness wait and dropped requests
+    """
+    for rollout in _core.rollout_history(dir, model_name):
+        click.echo("{model_name} v{version}: {rollout_seconds:.1f}s total, ready after {ready_seconds:.1f}s, "
+            "{dropped_requests} dropped request(s)".format(**rollout))
+
+cli.add_command(rollout_history)
+
 @click.command()
 @click.argument('model_name')
 @click.option('--dir', default='./', help='Directory of the project')
@@ -81,13 +254,78 @@ def undeploy_all(dir):
 
 cli.add_command(undeploy_all)
 
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--reconcile', is_flag=True, help='Drop replicas that are no longer running from the registry first')
+def list_deployments(dir, reconcile):
+    """Lists the deployed models, their version and replicas
+    """
+    for model_name, deployment in sorted(_core.list_deployments(dir, reconcile = reconcile).items()):
+        click.echo("{} v{}: {}".format(model_name, deployment['version'],
+            ', '.join('{} ({})'.format(x['name'], x['address']) for x in deployment['replicas'])))
+
+cli.add_command(list_deployments)
+
+@click.command()
+@click.argument('model_name')
+@click.option('--dir', default='./', help='Directory of the project')
+def store_artifacts(model_name, dir):
+    """Stores the current output of a model as a new artifact version
+
+    MODEL_NAME: Name of the model
+    """
+    _core.store_artifacts(dir, model_name)
+
+cli.add_command(store_artifacts)
+
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--model_name', default=None, help='Only show versions of this model')
+def list_artifacts(dir, model_name):
+    """Lists the model versions in the artifact store
+    """
+    for version in _core.list_artifacts(dir, model_name):
+        click.echo("{} v{}: {} file(s), {} bytes, stored {}".format(version['model_name'], version['version'],
+            version['files'], version['size'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version['created']))))
+
+cli.add_command(list_artifacts)
+
+@click.command()
+@click.argument('model_name')
+@click.argument('version', type=int)
+@click.option('--dir', default='./', help='Directory of the project')
+def restore_artifacts(model_name, version, dir):
+    """Replaces the output of a model with a stored version
+
+    MODEL_NAME: Name of the model
+
+    VERSION: Stored version number
+    """
+    _core.restore_artifacts(dir, model_name, version)
+
+cli.add_command(restore_artifacts)
+
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--keep', default=None, type=int, help='Versions to keep per model, defaults to the [artifacts] settings')
+def gc_artifacts(dir, keep):
+    """Removes old model versions and unused blobs from the artifact store
+    """
+    _core.gc_artifacts(dir, keep = keep)
+
+cli.add_command(gc_artifacts)
+
 
 @click.command()
 @click.argument('data_refresh_file')
 @click.argument('container')
 @click.option('--dir', default='./', help='Directory of the project')
 @click.option('--dataset_name', default='', help='Name of the dataset')
-def refresh_data(data_refresh_file, container, dir, dataset_name):
+@click.option('--rebuild', is_flag=True, help='Rebuild the image even if a cached build is available')
+@click.option('--transfer', default=None, type=click.Choice(['copy', 'sync', 'mount']), help='How the project is transferred to the container, defaults to the strategy in project.ini')
+@click.option('--artifact', multiple=True, help='Only copy back output files matching this glob, can be given more than once')
+@click.option('--stream', is_flag=True, help='Print the script output as it runs, and keep a copy in .harborml/logs')
+def refresh_data(data_refresh_file, container, dir, dataset_name, rebuild, transfer, artifact, stream):
     """Refreshes data and saves to data folder
 
     data_refresh_file: Name/path of file in src folder that will refresh the data and save the results to the "output" folder
@@ -96,9 +334,66 @@ def refresh_data(data_refresh_file, container, dir, dataset_name):
     """
     if dataset_name == '': 
         dataset_name = None
-    _core.refresh_data(dir, container, data_refresh_file, dataset_name = dataset_name)
+    _core.refresh_data(dir, container, data_refresh_file, dataset_name = dataset_name, rebuild = rebuild, transfer = transfer,
+        artifacts = list(artifact) or None, stream_logs = stream)
 
 cli.add_command(refresh_data)
 
+@click.command()
+@click.argument('container')
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--size', default=None, type=int, help='Number of idle containers to keep, defaults to the pool size in project.ini')
+def warm_pool(container, dir, size):
+    """Starts idle containers that train and refresh runs can lease
+
+    CONTAINER: Name of the container to keep warm
+    """
+    started = _core.warm_pool(dir, container, size = size)
+    print("Started {} container(s)".format(started))
+
+cli.add_command(warm_pool)
+
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--expired_only', is_flag=True, help='Only remove containers idle for longer than the pool ttl')
+def drain_pool(dir, expired_only):
+    """Stops and removes idle pooled containers
+    """
+    removed = _core.drain_pool(dir, expired_only = expired_only)
+    print("Removed {} container(s)".format(removed))
+
+cli.add_command(drain_pool)
+
+@click.command()
+@click.option('--dir', default='./', help='Directory of the project')
+def pool_stats(dir):
+    """Prints container pool lease and startup statistics
+    """
+    for key, value in sorted(_core.pool_stats(dir).items()):
+        print("{}: {}".format(key, round(value, 3) if isinstance(value, float) else value))
+
+cli.add_command(pool_stats)
+
+@click.command()
+@click.argument('stages', nargs=-1)
+@click.option('--dir', default='./', help='Directory of the project')
+@click.option('--pipeline', default=None, help='Pipeline file, defaults to pipeline.ini in the project')
+@click.option('--workers', default=_constants.DEFAULT_TRAIN_WORKERS, type=int, help='Maximum number of stages running at once')
+@click.option('--force', is_flag=True, help='Run every stage even if its inputs are unchanged')
+@click.option('--rebuild', is_flag=True, help='Rebuild the images even if a cached build is available')
+@click.option('--transfer', default=None, type=click.Choice(['copy', 'sync', 'mount']), help='How the project is transferred to the containers, defaults to the strategy in project.ini')
+def run_pipeline(stages, dir, pipeline, workers, force, rebuild, transfer):
+    """Runs the refresh, train and deploy stages in pipeline.ini
+
+    STAGES: Stages to run along with the stages they depend on, defaults to all stages
+    """
+    results = _core.run_pipeline(
+        dir, pipeline_file = pipeline, stages = list(stages) or None, max_workers = workers, force = force,
+        rebuild = rebuild, transfer = transfer)
+    if any(x['status'] not in ('ok', 'skipped') for x in results.values()):
+        raise SystemExit(1)
+
+cli.add_command(run_pipeline)
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
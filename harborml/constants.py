@@ -2,10 +2,28 @@ DATA_PATH = "data"
 DOCKER_PATH = "containers"
 DOCKER_INCLUDES = "containers/includes"
 INI_PATH = "project.ini"
+PIPELINE_PATH = "pipeline.ini"
 MODEL_PATH = "model"
 OUTPUT_PATH = "output"
 SOURCE_PATH = "src"
 TMP_BUILD_PATH = "tmp"
+META_PATH = ".harborml"
+BUILD_CACHE_PATH = ".harborml/build_cache.json"
+BUILD_CACHE_LOCK_PATH = ".harborml/build_cache.lock"
+POOL_STATE_PATH = ".harborml/pool.json"
+POOL_LOCK_PATH = ".harborml/pool.lock"
+PIPELINE_STATE_PATH = ".harborml/pipeline_state.json"
+MODEL_CACHE_STATS_PATH = ".harborml/model_cache.json"
+MODEL_CACHE_LOCK_PATH = ".harborml/model_cache.lock"
+MODEL_FINGERPRINT_NAME = ".harborml_fingerprint.json"
+ROLLOUT_HISTORY_PATH = ".harborml/rollouts.json"
+RUN_LOGS_PATH = ".harborml/logs"
+DEPLOYMENTS_PATH = ".harborml/deployments.json"
+DEPLOYMENTS_LOCK_PATH = ".harborml/deployments.lock"
+MANIFEST_PATH = ".harborml/manifests"
+LOCAL_MANIFEST_NAME = "local.json"
+ARTIFACTS_PATH = ".harborml/artifacts"
+ARTIFACTS_LOCK_PATH = ".harborml/artifacts.lock"
 
 DOCKER_TAG_SUFFIX = "harborml_"
 
@@ -15,9 +33,54 @@ DEFAULT_CONTAINER_COMMAND = "tail -f /dev/null"
 
 DEFAULT_DIR_IN_CONTAINER = "/var/harborml"
 
+# connections kept open by the shared docker client, enough for concurrent trainings and deploys
+DOCKER_POOL_SIZE = 32
+# housekeeping commands run in containers (mkdir, rm, chown) are polled until they exit
+EXEC_TIMEOUT = 30
+# attempts for docker calls that fail transiently, with a jittered exponential delay in between
+DOCKER_ATTEMPTS = 3
+DOCKER_RETRY_DELAY = .2
+TAR_STREAM_CHUNK_SIZE = 1024 * 1024
+
+CONTAINER_LABEL_PROJECT = "harborml.project"
+CONTAINER_LABEL_ROLE = "harborml.role"
+
+DEFAULT_POOL_SIZE = 0
+DEFAULT_POOL_TTL = 600
+
+# model files are stored in chunks of this size, a chunk is stored once however many versions contain it
+ARTIFACT_CHUNK_SIZE = 4 * 1024 * 1024
+# blob file extension and default level per compression
+ARTIFACT_COMPRESSIONS = {
+    'gzip': {'extension': '.gz', 'level': 6},
+    'zstd': {'extension': '.zst', 'level': 3}
+}
+# used when project.ini has no artifacts section, keeps deploys of existing projects copying model/<name>
+DEFAULT_ARTIFACTS = {
+    'enabled': False,
+    'keep': 5,
+    'compression': 'gzip'
+}
+# written to project.ini for new projects
+NEW_PROJECT_ARTIFACTS_ENABLED = True
+# deploy containers share the project's blobs in a docker volume, so each blob is uploaded once
+ARTIFACT_BLOBS_IN_CONTAINER = "/var/harborml-blobs"
+ARTIFACT_VOLUME_PREFIX = "harborml-blobs-"
+# rebuilding a large model from its blobs takes longer than a housekeeping command
+ARTIFACT_RESTORE_TIMEOUT = 600
+ARTIFACT_RESTORE_SCRIPT_NAME = "restore.sh"
+
+DEFAULT_TRAIN_WORKERS = 4
+RUN_PHASES = ['build', 'start', 'copy_in', 'run', 'copy_out', 'stop']
+
+PIPELINE_STAGE_TYPES = set(['refresh', 'train', 'deploy'])
+
+TRANSFER_STRATEGIES = set(['copy', 'sync', 'mount'])
+DEFAULT_TRANSFER_STRATEGY = "copy"
+
 DEFAULT_DOCKERFILE_NAME = "default.dockerfile"
 DEFAULT_DOCKERFILE_CONTENTS = """FROM python
-RUN pip install scikit-learn pandas flask"""
+RUN pip install scikit-learn pandas flask gunicorn"""
 
 DEFAULT_NGINX_NAME = "nginx"
 DEFAULT_NGINX_CONTENTS = """FROM nginx:alpine
@@ -25,6 +88,86 @@ RUN apk update && apk add bash
 COPY includes/nginx.conf /etc/nginx/nginx.conf
 """
 NGINX_CONF_IN_CONTAINER_PATH = "/etc/nginx/nginx.conf"
+# new configs are uploaded next to the live one, validated, then renamed over it
+NGINX_STAGED_CONF_NAME = "nginx.conf.harborml"
+NGINX_CONF_PATH = ".harborml/nginx.conf"
+# nginx runs as a daemon rather than as the container's main process, so its log does not reach the container
+# logs.  The rendered config writes it to a file that dropped requests are counted from.
+NGINX_ACCESS_LOG_IN_CONTAINER_PATH = "/var/log/nginx/harborml_access.log"
+# the model server replaces the shell that wrote its pid here, PID 1 is the idle container command and ignores
+# SIGTERM, so stopping a replica gracefully signals the server itself
+SERVER_PID_IN_CONTAINER_PATH = "/tmp/harborml_server.pid"
+
+SERVING_SERVERS = set(['flask', 'gunicorn'])
+# eager imports the deploy module when the server starts, lazy on first use in each worker
+MODEL_LOAD_MODES = set(['eager', 'lazy'])
+# used when project.ini has no serving section, keeps projects created before gunicorn support working
+DEFAULT_SERVING = {
+    'server': 'flask',
+    'workers': 2,
+    'threads': 4,
+    'worker_class': 'gthread',
+    'timeout': 30,
+    'graceful_timeout': 30,
+    'keepalive': 5,
+    'preload': True,
+    'microbatch': False,
+    'max_batch_size': 32,
+    'max_wait_ms': 5.0,
+    'cache': False,
+    'cache_size': 1024,
+    'cache_ttl': 300.0,
+    'load': 'eager',
+    'mmap': False,
+    'warmup': False
+}
+# written to project.ini for new projects
+NEW_PROJECT_SERVING_SERVER = "gunicorn"
+
+HEALTH_ROUTE = "/health"
+DEFAULT_READINESS_TIMEOUT = 60.0
+DEFAULT_DRAIN_SECONDS = 5.0
+ROLLOUT_HISTORY_LENGTH = 100
+DEFAULT_REPLICAS = 1
+BALANCE_METHODS = {'round_robin', 'least_conn', 'ip_hash', 'random'}
+DEFAULT_BALANCE = "round_robin"
+
+# reverse proxy settings.  None leaves the directive as it is in includes/nginx.conf (or nginx's default).
+# upstream_keepalive is the default for the keepalive deploy setting.
+PROXY_SETTINGS = [
+    'worker_processes', 'worker_connections', 'upstream_keepalive', 'keepalive_requests',
+    'gzip', 'gzip_min_length', 'gzip_comp_level', 'gzip_types', 'gzip_proxied',
+    'proxy_buffering', 'proxy_buffer_size', 'proxy_buffers', 'proxy_busy_buffers_size',
+    'proxy_connect_timeout', 'proxy_send_timeout', 'proxy_read_timeout'
+]
+PROXY_PROFILES = {
+    'default': {
+        'upstream_keepalive': 0
+    },
+    'performance': {
+        'worker_processes': 'auto',
+        'worker_connections': '4096',
+        'upstream_keepalive': 32,
+        'keepalive_requests': '1000',
+        'gzip': 'on',
+        # small responses are not worth compressing
+        'gzip_min_length': '1024',
+        'gzip_comp_level': '4',
+        # text/html is always compressed, listing it makes nginx warn about a duplicate MIME type
+        'gzip_types': 'application/json text/plain',
+        'gzip_proxied': 'any',
+        'proxy_buffering': 'on',
+        'proxy_buffer_size': '16k',
+        'proxy_buffers': '16 16k',
+        'proxy_busy_buffers_size': '32k',
+        'proxy_connect_timeout': '5s',
+        'proxy_send_timeout': '60s',
+        'proxy_read_timeout': '60s'
+    }
+}
+# used when project.ini has no proxy section, keeps the reverse proxy of existing projects unchanged
+DEFAULT_PROXY_PROFILE = "default"
+NEW_PROJECT_PROXY_PROFILE = "performance"
 
 REFRESH_FILE_SUFFIXES = set(['refresh', 'prepare'])
 TRAIN_FILE_SUFFIXES = set(['train', 'fit'])
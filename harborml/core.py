@@ -1,16 +1,38 @@
+import asyncio as _asyncio
+import concurrent.futures as _futures
 import configparser as _configparser
+import contextlib as _contextlib
+import contextvars as _contextvars
 import docker as _docker
 import errno as _errno
+import fnmatch as _fnmatch
+import gzip as _gzip
+import hashlib as _hashlib
+import io as _io
+import itertools as _itertools
+import json as _json
+import math as _math
 import nginx as _nginx
 import os as _os
+import posixpath as _posixpath
 import pkg_resources as _pkg_resources
 import random as _random
+import requests as _requests
+import re as _re
+import shlex as _shlex
 import tarfile as _tarfile
+import threading as _threading
 import time as _time
 import shutil as _shutil
+import sys as _sys
 
 from . import constants as _constants
 
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
 def _check_project_dir(project_root_dir):
     if not _os.path.isdir(project_root_dir):
         raise FileNotFoundError("Provided path is not a valid directory")
@@ -41,38 +63,306 @@ def _mkdir_p(path):
         else:
             raise
 
+class DockerSession(object):
+    """Owns one docker client, shared by every core call made while the session is active, and records how
+    many times each Docker API method was called and how long the calls took.  Calls that stream (logs,
+    archives, exec output) are timed until the stream is returned, not until it is consumed.
+
+    A fake client can be passed in, so core functions can run without a Docker daemon.  It needs the same
+    attributes core uses (images, containers and api).  A client passed in stays open when the session is
+    closed, closing it is left to the caller."""
+    def __init__(self, client = None):
+        self._client = client
+        self._owns_client = client is None
+        self._instrumented = False
+        self._lock = _threading.Lock()
+        self._tokens = []
+        self.calls = {}
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = _docker.from_env(max_pool_size = _constants.DOCKER_POOL_SIZE)
+            if not self._instrumented:
+                self._instrument(self._client.api)
+                self._instrumented = True
+            return self._client
+
+    def _instrument(self, api):
+        # time the API methods themselves, not the requests.Session plumbing they are built on
+        plumbing = set(dir(_docker.APIClient)) - set(dir(_requests.Session)) \
+            if isinstance(api, _docker.APIClient) else None
+        for name in dir(api):
+            if name.startswith('_') or (plumbing is not None and name not in plumbing):
+                continue
+            method = getattr(api, name, None)
+            if callable(method) and not isinstance(method, type):
+                setattr(api, name, self._timed(name, method))
+
+    def _timed(self, name, method):
+        def timed(*args, **kwargs):
+            start = _time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._record(name, _time.time() - start)
+        return timed
+
+    def _record(self, name, seconds):
+        with self._lock:
+            stats = self.calls.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def stats(self):
+        """Returns {api_method: {count, seconds, max_seconds}}"""
+        with self._lock:
+            return {k: dict(v) for k, v in self.calls.items()}
+
+    def print_stats(self):
+        rows = sorted(self.stats().items(), key = lambda x: -x[1]['seconds'])
+        _print_table(['api call', 'count', 'seconds', 'max'],
+            [[k, v['count'], '{:.3f}'.format(v['seconds']), '{:.3f}'.format(v['max_seconds'])] for k, v in rows])
+
+    def close(self):
+        with self._lock:
+            # the caller's client is kept as is, already instrumented, so the session can be entered again
+            if not self._owns_client:
+                return
+            if self._client is not None and hasattr(self._client, 'close'):
+                self._client.close()
+            self._client = None
+            self._instrumented = False
+
+    def __enter__(self):
+        self._tokens.append(_sessions.set(_sessions.get() + (self,)))
+        return self
+
+    def __exit__(self, *exc_info):
+        _sessions.reset(self._tokens.pop())
+        self.close()
+
+# sessions entered with "with" in the current thread or task, the innermost one is used.  Threads do not
+# inherit it, work handed to an executor is wrapped with _in_session to use the session of the caller.
+_sessions = _contextvars.ContextVar('harborml_docker_sessions', default = ())
+_default_session = DockerSession()
+
+def docker_session(client = None):
+    """Returns a DockerSession to use as a context manager.  Core calls inside the block share its client and
+    are timed by it, and the client is closed when the block ends.  Outside of any session, core calls share
+    a process-wide client.
+
+        with harborml.docker_session() as session:
+            harborml.deploy_model('.', 'default', 'deploy_iris_model.py')
+            session.print_stats()
+
+    Args:
+        client: Optional docker client to use instead of one created from the environment, for example a fake
+            client in tests
+    """
+    return DockerSession(client)
+
+def _current_session():
+    sessions = _sessions.get()
+    return sessions[-1] if len(sessions) > 0 else _default_session
+
+def _in_session(func):
+    """Wraps func to run in the Docker session that is active now, for passing work to another thread"""
+    session = _current_session()
+    def run(*args, **kwargs):
+        token = _sessions.set(_sessions.get() + (session,))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _sessions.reset(token)
+    return run
+
 def _docker_client():
-    return _docker.from_env()
+    return _current_session().client
 
 def _docker_image_tag(container_name):
     return _constants.DOCKER_TAG_SUFFIX + container_name + ":latest"
 
-def _build_container(project_root_dir, container_name):
+def _hash_file(file_path, hasher = None, chunk_size = 1024 * 1024):
+    if hasher is None:
+        hasher = _hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+def _hash_build_context(container_path, docker_includes_path):
+    hasher = _hashlib.sha256()
+    hasher.update(_os.path.basename(container_path).encode('utf-8'))
+    _hash_file(container_path, hasher)
+    for root, dirs, files in _os.walk(docker_includes_path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = _os.path.join(root, filename)
+            rel_path = _fix_path(_os.path.relpath(file_path, docker_includes_path))
+            hasher.update(b'\0' + rel_path.encode('utf-8') + b'\0')
+            _hash_file(file_path, hasher)
+    return hasher.hexdigest()
+
+def _read_json_file(file_path, default = None):
+    if not _os.path.isfile(file_path):
+        return {} if default is None else default
+    with open(file_path, 'r') as f:
+        return _json.load(f)
+
+def _write_json_file(file_path, data):
+    _mkdir_p(_os.path.dirname(file_path))
+    tmp_path = file_path + '.' + _random_file_name(8)
+    with open(tmp_path, 'w') as f:
+        _json.dump(data, f, indent = 2, sort_keys = True)
+    _os.replace(tmp_path, file_path)
+
+def _load_build_cache(project_root_dir):
+    return _read_json_file(_build_relative_path(project_root_dir, _constants.BUILD_CACHE_PATH))
+
+def _save_build_cache(project_root_dir, build_cache):
+    _write_json_file(_build_relative_path(project_root_dir, _constants.BUILD_CACHE_PATH), build_cache)
+
+def _get_cached_image(client, build_cache, digest):
+    entry = build_cache.get(digest)
+    if entry is None:
+        return None
+    try:
+        return client.images.get(entry['image_id'])
+    except _docker.errors.ImageNotFound:
+        return None
+
+def _build_container(project_root_dir, container_name, rebuild = False):
     container_dockerfile = container_name + _constants.DOCKERFILE_EXTENSION
     container_path = _check_and_format_file(project_root_dir, _constants.DOCKER_PATH + '/' + container_dockerfile)
     container_tag = _docker_image_tag(container_name)
     tmp_build_path = _build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH + '/' + container_name)
     #tmp_container_path = _build_relative_path(tmp_build_path, container_dockerfile)
     docker_includes_path = _build_relative_path(project_root_dir, _constants.DOCKER_INCLUDES)
+    client = _docker_client()
+    digest = _hash_build_context(container_path, docker_includes_path)
+    build_cache = _load_build_cache(project_root_dir)
+    if not rebuild:
+        image = _get_cached_image(client, build_cache, digest)
+        if image is not None:
+            if container_tag not in image.tags:
+                image.tag(container_tag)
+            print("Using cached image for container " + container_name)
+            return container_tag
     try:
         _os.mkdir(tmp_build_path)
         _shutil.copy(container_path, tmp_build_path)
         _shutil.copytree(docker_includes_path, _build_relative_path(tmp_build_path, 'includes'))
-        client = _docker_client()
         #with open(tmp_container_path, 'rb') as f:
-        client.images.build(
+        image, _ = client.images.build(
             #fileobj = f,
             path = tmp_build_path,
             dockerfile = container_dockerfile,
             tag = container_tag,
+            # harborml_<name>:latest tags are shared by every project on the host, the label tells whose build it is
+            labels = {_constants.CONTAINER_LABEL_PROJECT: _get_project_config(project_root_dir)['DEFAULT']['PROJECT_ID']},
             quiet = False
         )
     finally:
         _shutil.rmtree(tmp_build_path, ignore_errors=True)
         pass
+    with _file_lock(_build_relative_path(project_root_dir, _constants.BUILD_CACHE_LOCK_PATH)):
+        # reloaded, another build may have finished in the meantime
+        build_cache = _load_build_cache(project_root_dir)
+        build_cache[digest] = {
+            'container_name': container_name,
+            'image_id': image.id,
+            'built': _time.time()
+        }
+        _save_build_cache(project_root_dir, build_cache)
     return container_tag
 
-def _start_container(image_tag, port_mappings = {}, hostname = None) -> _docker.models.containers.Container:
+def _prune_images(project_root_dir):
+    client = _docker_client()
+    project_id = _get_project_config(project_root_dir)['DEFAULT']['PROJECT_ID']
+    with _file_lock(_build_relative_path(project_root_dir, _constants.BUILD_CACHE_LOCK_PATH)):
+        build_cache = _load_build_cache(project_root_dir)
+        images = {}
+        # drop cache entries whose image is gone
+        for digest in list(build_cache.keys()):
+            image = _get_cached_image(client, build_cache, digest)
+            if image is None:
+                del build_cache[digest]
+            else:
+                images[digest] = image
+        # the newest cached image per container with a dockerfile is the live one
+        dockerfiles = _build_relative_path(project_root_dir, _constants.DOCKER_PATH)
+        current = {}
+        for digest, entry in build_cache.items():
+            name = entry['container_name']
+            if not _os.path.isfile(_build_relative_path(dockerfiles, name + _constants.DOCKERFILE_EXTENSION)):
+                continue
+            if name not in current or build_cache[current[name]]['built'] < entry['built']:
+                current[name] = digest
+        live = set(build_cache[x]['image_id'] for x in current.values())
+        # only images this project recorded are removed, other projects' tags are left alone
+        removed = []
+        for digest, image in images.items():
+            if image.id in live:
+                continue
+            owner = (image.labels or {}).get(_constants.CONTAINER_LABEL_PROJECT)
+            if owner is not None and owner != project_id:
+                continue
+            name = ', '.join(image.tags) if len(image.tags) > 0 else image.short_id
+            try:
+                client.images.remove(image.id)
+            except _docker.errors.ImageNotFound:
+                # several cache entries can point at one image
+                pass
+            except _docker.errors.APIError as e:
+                print("Could not remove image {}: {}".format(name, e))
+                continue
+            del build_cache[digest]
+            removed.append(name)
+        _save_build_cache(project_root_dir, build_cache)
+    return removed
+
+def _retry(func, attempts = _constants.DOCKER_ATTEMPTS, base_delay = _constants.DOCKER_RETRY_DELAY):
+    """Calls func, retrying docker API errors and failed commands after a jittered exponential delay"""
+    for attempt in range(attempts):
+        try:
+            return func()
+        except (_docker.errors.APIError, RuntimeError) as e:
+            if attempt == attempts - 1:
+                raise
+            delay = _random.uniform(0, base_delay * 2 ** attempt)
+            print("{}, retrying in {:.2f}s".format(str(e).strip(), delay))
+            _time.sleep(delay)
+
+def _exec_and_wait(container, cmd, timeout = _constants.EXEC_TIMEOUT, attempts = _constants.DOCKER_ATTEMPTS):
+    """Runs a command in a container and waits for it to exit.  The exec is started detached and polled
+    through the exec inspect API, so a hung exec cannot block past the timeout.  A non-zero exit code
+    raises RuntimeError after the retries are used up, running out of time raises TimeoutError."""
+    api = _docker_client().api
+
+    def run_once():
+        exec_id = api.exec_create(container.id, cmd)['Id']
+        api.exec_start(exec_id, detach = True)
+        deadline = _time.time() + timeout
+        delay = .005
+        while True:
+            info = api.exec_inspect(exec_id)
+            # ExitCode stays None until the process has both started and exited
+            if not info['Running'] and info['ExitCode'] is not None:
+                break
+            if _time.time() > deadline:
+                raise TimeoutError("Command {} did not finish within {}s".format(cmd, timeout))
+            _time.sleep(_random.uniform(delay / 2, delay))
+            delay = min(delay * 2, .25)
+        if info['ExitCode'] != 0:
+            raise RuntimeError("Command {} exited with code {}".format(cmd, info['ExitCode']))
+
+    _retry(run_once, attempts = attempts)
+
+def _start_container(image_tag, port_mappings = {}, hostname = None, labels = None,
+    volumes = None, cpus = None, mem_limit = None) -> _docker.models.containers.Container:
     client = _docker_client()
     container = client.containers.run(
         image_tag, 
@@ -80,13 +370,227 @@ def _start_container(image_tag, port_mappings = {}, hostname = None) -> _docker.
         ports = port_mappings,
         detach = True,
         #remove = True,
-        hostname = hostname)
+        hostname = hostname,
+        labels = labels,
+        volumes = volumes,
+        nano_cpus = int(cpus * 1e9) if cpus is not None else None,
+        mem_limit = mem_limit)
     
-    container.exec_run("mkdir " + _constants.DEFAULT_DIR_IN_CONTAINER)
-    container.exec_run(
-        "mkdir " + _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH))
+    _exec_and_wait(container, ['mkdir', '-p', _constants.DEFAULT_DIR_IN_CONTAINER,
+        _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH)])
+    return container
+
+def _stop_server(container, timeout):
+    """Sends SIGTERM to a deployed model server and waits up to timeout seconds for it to finish its in-flight
+    requests and exit.  Containers without a model server return right away."""
+    # an exited server can linger as a zombie until it is reaped, kill -0 still finds it
+    script = ('pid=$(cat {pid_file} 2>/dev/null) && kill -TERM $pid 2>/dev/null || exit 0; '
+        'i=0; while kill -0 $pid 2>/dev/null && ! grep -qs "^State:.*Z" /proc/$pid/status && [ $i -lt {polls} ]; '
+        'do sleep 0.1; i=$((i + 1)); done').format(
+        pid_file = _constants.SERVER_PID_IN_CONTAINER_PATH, polls = int(_math.ceil(timeout * 10)))
+    try:
+        container.exec_run(['sh', '-c', script])
+    except _docker.errors.APIError:
+        # not running any more
+        pass
+
+def _stop_container(container, timeout = 0):
+    """Stops and removes a container.  With a timeout, a deployed model server first gets that many seconds
+    to shut down gracefully."""
+    if timeout > 0:
+        _stop_server(container, timeout)
+    container.stop(timeout = 0)
+    try:
+        container.remove()
+    except _docker.errors.APIError:
+        # already removed, or removal in progress
+        pass
+
+@_contextlib.contextmanager
+def _file_lock(lock_path, timeout = 60, stale_after = 300):
+    _mkdir_p(_os.path.dirname(lock_path))
+    start = _time.time()
+    while True:
+        try:
+            fd = _os.open(lock_path, _os.O_CREAT | _os.O_EXCL | _os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if _time.time() - _os.path.getmtime(lock_path) > stale_after:
+                    _os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if _time.time() - start > timeout:
+                raise TimeoutError("Timed out waiting for lock " + lock_path)
+            _time.sleep(.05)
+    try:
+        yield
+    finally:
+        _os.close(fd)
+        _os.remove(lock_path)
+
+def _get_pool_config(project_root_dir):
+    config = _get_project_config(project_root_dir)
+    size = config.getint('pool', 'size', fallback = _constants.DEFAULT_POOL_SIZE)
+    ttl = config.getfloat('pool', 'ttl', fallback = _constants.DEFAULT_POOL_TTL)
+    return size, ttl
+
+def _empty_pool_state():
+    return {
+        'containers': {},
+        'stats': {
+            'leases': 0,
+            'hits': 0,
+            'misses': 0,
+            'lease_wait_total': 0.0,
+            'lease_wait_max': 0.0,
+            'startup_total': 0.0,
+            'startup_max': 0.0,
+            'startups': 0,
+            'evictions': 0
+        }
+    }
+
+def _load_pool_state(project_root_dir):
+    state = _read_json_file(
+        _build_relative_path(project_root_dir, _constants.POOL_STATE_PATH),
+        default = _empty_pool_state())
+    return state
+
+def _save_pool_state(project_root_dir, state):
+    _write_json_file(_build_relative_path(project_root_dir, _constants.POOL_STATE_PATH), state)
+
+def _pool_lock(project_root_dir):
+    return _file_lock(_build_relative_path(project_root_dir, _constants.POOL_LOCK_PATH))
+
+def _pool_labels(project_root_dir):
+    return {
+        _constants.CONTAINER_LABEL_PROJECT: _get_project_config(project_root_dir)['DEFAULT']['PROJECT_ID'],
+        _constants.CONTAINER_LABEL_ROLE: 'pool'
+    }
+
+def _remove_pooled_container(project_root_dir, client, container_id):
+    _remove_container_manifest(project_root_dir, container_id)
+    try:
+        _stop_container(client.containers.get(container_id))
+    except _docker.errors.NotFound:
+        pass
+
+def _evict_pooled_containers(project_root_dir, state, ttl, client, image_tag = None, image_id = None):
+    now = _time.time()
+    for container_id, entry in list(state['containers'].items()):
+        if entry['state'] != 'idle':
+            continue
+        expired = ttl is not None and now - entry['since'] > ttl
+        outdated = image_tag is not None and entry['image_tag'] == image_tag and entry['image_id'] != image_id
+        if expired or outdated:
+            _remove_pooled_container(project_root_dir, client, container_id)
+            del state['containers'][container_id]
+            state['stats']['evictions'] += 1
+
+def _lease_container(project_root_dir, image_tag):
+    client = _docker_client()
+    _, ttl = _get_pool_config(project_root_dir)
+    image_id = client.images.get(image_tag).id
+    start = _time.time()
+    container = None
+    while container is None:
+        with _pool_lock(project_root_dir):
+            state = _load_pool_state(project_root_dir)
+            _evict_pooled_containers(project_root_dir, state, ttl, client, image_tag, image_id)
+            container_id = None
+            for cid, entry in state['containers'].items():
+                if entry['state'] == 'idle' and entry['image_tag'] == image_tag:
+                    container_id = cid
+                    entry['state'] = 'leased'
+                    entry['since'] = _time.time()
+                    break
+            _save_pool_state(project_root_dir, state)
+        if container_id is None:
+            break
+        try:
+            container = client.containers.get(container_id)
+            if container.status != 'running':
+                raise _docker.errors.NotFound("Pooled container is not running")
+        except _docker.errors.NotFound:
+            # container died or was removed behind our back, forget it and try the next one
+            container = None
+            with _pool_lock(project_root_dir):
+                state = _load_pool_state(project_root_dir)
+                state['containers'].pop(container_id, None)
+                _save_pool_state(project_root_dir, state)
+            _remove_container_manifest(project_root_dir, container_id)
+    lease_wait = _time.time() - start
+    startup = None
+    if container is None:
+        start = _time.time()
+        container = _start_container(image_tag, labels = _pool_labels(project_root_dir))
+        startup = _time.time() - start
+    with _pool_lock(project_root_dir):
+        state = _load_pool_state(project_root_dir)
+        stats = state['stats']
+        stats['leases'] += 1
+        stats['lease_wait_total'] += lease_wait
+        stats['lease_wait_max'] = max(stats['lease_wait_max'], lease_wait)
+        if startup is None:
+            stats['hits'] += 1
+        else:
+            stats['misses'] += 1
+            stats['startups'] += 1
+            stats['startup_total'] += startup
+            stats['startup_max'] = max(stats['startup_max'], startup)
+        state['containers'][container.id] = {
+            'image_tag': image_tag,
+            'image_id': image_id,
+            'state': 'leased',
+            'since': _time.time()
+        }
+        _save_pool_state(project_root_dir, state)
+    if startup is None:
+        print("Leased warm container (waited {:.2f}s)".format(lease_wait))
+    else:
+        print("Started new pool container in {:.2f}s (waited {:.2f}s)".format(startup, lease_wait))
     return container
 
+def _wipe_container(container, keep_project = False):
+    if keep_project:
+        # synced project files stay in place, only the run output is cleared
+        target = _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH)
+    else:
+        target = _constants.DEFAULT_DIR_IN_CONTAINER
+    try:
+        _exec_and_wait(container, ['sh', '-c', 'rm -rf "{0}" && mkdir -p "{1}/{2}"'.format(
+            target, _constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH)])
+    except (_docker.errors.APIError, RuntimeError, TimeoutError):
+        return False
+    return True
+
+def _release_container(project_root_dir, container, keep_project = False):
+    size, _ = _get_pool_config(project_root_dir)
+    keep = _wipe_container(container, keep_project = keep_project)
+    if not keep_project:
+        _remove_container_manifest(project_root_dir, container.id)
+    with _pool_lock(project_root_dir):
+        state = _load_pool_state(project_root_dir)
+        entry = state['containers'].get(container.id)
+        if entry is not None and keep:
+            idle = [x for x in state['containers'].values()
+                if x['state'] == 'idle' and x['image_tag'] == entry['image_tag']]
+            keep = len(idle) < size
+        if entry is not None and keep:
+            entry['state'] = 'idle'
+            entry['since'] = _time.time()
+        else:
+            state['containers'].pop(container.id, None)
+        _save_pool_state(project_root_dir, state)
+    if keep:
+        print("Returned container to pool")
+    else:
+        print("Stopping container...")
+        _remove_container_manifest(project_root_dir, container.id)
+        _stop_container(container)
+
 def _random_file_name(length = 16):
     validchars = "0123456789abcdefghijklmnopqrstuvwxyz"
     filename = ''
@@ -94,29 +598,142 @@ def _random_file_name(length = 16):
         filename += _random.choice(validchars)
     return filename
 
-def _tar_it(project_root_dir, file_dir):
-    rand_file_name = _build_relative_path(
-        project_root_dir, _constants.TMP_BUILD_PATH
-        ) + '/' + _random_file_name() + '.tar'
-    tar = _tarfile.open(rand_file_name, mode='w')
-    try:
-        tar.add(file_dir, arcname='')
-    finally:
-        tar.close()
-    return rand_file_name
+def _iter_directory_entries(file_dir, arc_prefix = ''):
+    """Yields (path, arcname) for everything under file_dir, directories before their contents"""
+    file_dir = _fix_path(file_dir).rstrip('/')
+    for root, dirs, filenames in _os.walk(file_dir):
+        dirs.sort()
+        rel_root = _fix_path(_os.path.relpath(root, file_dir))
+        rel_root = '' if rel_root == '.' else rel_root + '/'
+        for name in dirs:
+            yield _os.path.join(root, name), arc_prefix + rel_root + name
+        for name in sorted(filenames):
+            yield _os.path.join(root, name), arc_prefix + rel_root + name
+
+def _tar_stream(entries, chunk_size = _constants.TAR_STREAM_CHUNK_SIZE):
+    """Generates a tar archive of (path, arcname) entries in chunks of at most chunk_size bytes.
+    Files are read in chunks as the archive is consumed, so memory use does not depend on file sizes."""
+    for path, arcname in entries:
+        stat = _os.lstat(path)
+        info = _tarfile.TarInfo(arcname)
+        info.mtime = stat.st_mtime
+        info.mode = stat.st_mode & 0o7777
+        if _os.path.islink(path):
+            info.type = _tarfile.SYMTYPE
+            info.linkname = _os.readlink(path)
+        elif _os.path.isdir(path):
+            info.type = _tarfile.DIRTYPE
+        elif _os.path.isfile(path):
+            info.size = stat.st_size
+        else:
+            continue
+        yield info.tobuf(format = _tarfile.PAX_FORMAT)
+        if info.type != _tarfile.REGTYPE:
+            continue
+        remaining = info.size
+        with open(path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise RuntimeError("File changed size while being archived: " + path)
+                remaining -= len(chunk)
+                yield chunk
+        leftover = info.size % _tarfile.BLOCKSIZE
+        if leftover > 0:
+            yield _tarfile.NUL * (_tarfile.BLOCKSIZE - leftover)
+    # end of archive marker
+    yield _tarfile.NUL * (_tarfile.BLOCKSIZE * 2)
 
 def _copy_directory_to_container(project_root_dir, srcpath, dstpath, container):
-    tar_file = _tar_it(project_root_dir, srcpath)
-    try:
-        data = open(tar_file, 'rb').read()
-        container.exec_run('mkdir -p "' + dstpath + '"', detach = True)
-        # introducing potential race condition :::::((((((  but the above exec fails sometimes for no reason and hangs
-        _time.sleep(.1)
-        container.put_archive(dstpath, data)
-    finally:
-        _os.remove(tar_file)
+    _exec_and_wait(container, ['mkdir', '-p', dstpath])
+
+    def upload():
+        # the archive is a generator, so each attempt needs a fresh one
+        if not container.put_archive(dstpath, _tar_stream(_iter_directory_entries(srcpath))):
+            raise RuntimeError("Error while copying {} to container".format(srcpath))
+    _retry(upload)
+
+def _get_transfer_strategy(project_root_dir, transfer = None):
+    if transfer is None:
+        transfer = _get_project_config(project_root_dir).get(
+            'transfer', 'strategy', fallback = _constants.DEFAULT_TRANSFER_STRATEGY)
+    if transfer not in _constants.TRANSFER_STRATEGIES:
+        raise ValueError("Unknown transfer strategy {}, must be one of {}".format(
+            transfer, ', '.join(sorted(_constants.TRANSFER_STRATEGIES))))
+    return transfer
+
+def _project_scopes(include_data = True, include_model = None):
+    scopes = [_constants.SOURCE_PATH]
+    if include_data:
+        scopes.append(_constants.DATA_PATH)
+    if include_model is not None:
+        scopes.append(_build_relative_path(_constants.MODEL_PATH, include_model))
+    return scopes
+
+def _manifest_file(project_root_dir, name):
+    return _build_relative_path(
+        _build_relative_path(project_root_dir, _constants.MANIFEST_PATH),
+        name)
+
+def _remove_container_manifest(project_root_dir, container_id):
+    manifest_file = _manifest_file(project_root_dir, container_id + '.json')
+    if _os.path.isfile(manifest_file):
+        _os.remove(manifest_file)
 
-def _copy_project_to_container(project_root_dir, container, include_data = True, include_model = None):
+def _scan_project_files(project_root_dir, scopes):
+    """Builds a manifest of {relative path: {size, mtime, hash}} for all files under the scopes.
+    Hashes are reused from the local manifest when size and mtime are unchanged, so unchanged
+    files are not re-read."""
+    local_manifest_file = _manifest_file(project_root_dir, _constants.LOCAL_MANIFEST_NAME)
+    local_manifest = _read_json_file(local_manifest_file)
+    files = {}
+    for scope in scopes:
+        scope_path = _build_relative_path(project_root_dir, scope)
+        for root, _, filenames in _os.walk(scope_path):
+            for filename in filenames:
+                file_path = _os.path.join(root, filename)
+                rel_path = _fix_path(_os.path.relpath(file_path, project_root_dir))
+                stat = _os.stat(file_path)
+                entry = local_manifest.get(rel_path)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                    entry = {
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime_ns,
+                        'hash': _hash_file(file_path).hexdigest()
+                    }
+                files[rel_path] = entry
+    # forget files under these scopes that no longer exist
+    for rel_path in list(local_manifest.keys()):
+        if rel_path not in files and any(rel_path.startswith(x + '/') for x in scopes):
+            del local_manifest[rel_path]
+    local_manifest.update(files)
+    _write_json_file(local_manifest_file, local_manifest)
+    return files
+
+def _sync_project_to_container(project_root_dir, container, include_data = True, include_model = None):
+    manifest_file = _manifest_file(project_root_dir, container.id + '.json')
+    container_manifest = _read_json_file(manifest_file)
+    files = _scan_project_files(project_root_dir, _project_scopes(include_data, include_model))
+    changed = sorted(x for x in files if x not in container_manifest or container_manifest[x]['hash'] != files[x]['hash'])
+    deleted = sorted(x for x in container_manifest if x not in files)
+    print("Syncing {} changed file(s), deleting {} file(s)".format(len(changed), len(deleted)))
+    # forget the manifest while the container is being changed, so a failed sync forces a full one next time
+    _remove_container_manifest(project_root_dir, container.id)
+    for i in range(0, len(deleted), 500):
+        _exec_and_wait(container, ['rm', '-f', '--'] + [
+            _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, x) for x in deleted[i:i + 500]])
+    def upload():
+        entries = ((_build_relative_path(project_root_dir, x), x) for x in changed)
+        if not container.put_archive(_constants.DEFAULT_DIR_IN_CONTAINER, _tar_stream(entries)):
+            raise RuntimeError("Error while copying files to container")
+    if len(changed) > 0:
+        _retry(upload)
+    _write_json_file(manifest_file, files)
+
+def _copy_project_to_container(project_root_dir, container, include_data = True, include_model = None, transfer = 'copy'):
+    if transfer == 'sync':
+        _sync_project_to_container(project_root_dir, container, include_data = include_data, include_model = include_model)
+        return
     src_src_path = _build_relative_path(project_root_dir, _constants.SOURCE_PATH)
     src_dst_path = _constants.DEFAULT_DIR_IN_CONTAINER + '/' + _constants.SOURCE_PATH
     _copy_directory_to_container(project_root_dir, src_src_path, src_dst_path, container)
@@ -133,43 +750,482 @@ def _copy_project_to_container(project_root_dir, container, include_data = True,
             include_model)
         _copy_directory_to_container(project_root_dir, mdl_src_path, mdl_dst_path, container)
 
-def _copy_output_to_project(project_root_dir, container, relative_target_directory):
-    src_path = _constants.DEFAULT_DIR_IN_CONTAINER + '/' + _constants.OUTPUT_PATH
+def _project_volumes(project_root_dir, include_data = True, include_model = None, output_dir = None):
+    """Bind mounts for the mount transfer strategy.  Project directories are mounted read-only,
+    output_dir (a host directory) is mounted read-write as the container output directory."""
+    volumes = {}
+    for scope in _project_scopes(include_data, include_model):
+        host_path = _os.path.abspath(_build_relative_path(project_root_dir, scope))
+        _mkdir_p(host_path)
+        volumes[host_path] = {
+            'bind': _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, scope),
+            'mode': 'ro'
+        }
+    if output_dir is not None:
+        volumes[_os.path.abspath(output_dir)] = {
+            'bind': _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH),
+            'mode': 'rw'
+        }
+    return volumes
+
+def _claim_mounted_output(container):
+    # files written by the container belong to its user (usually root), hand them back to the host user
+    if hasattr(_os, 'getuid'):
+        _exec_and_wait(container, ['chown', '-R', '{}:{}'.format(_os.getuid(), _os.getgid()),
+            _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH)])
+
+def _move_tree(src_dir, dst_dir):
+    _mkdir_p(dst_dir)
+    for name in _os.listdir(src_dir):
+        src = _os.path.join(src_dir, name)
+        dst = _os.path.join(dst_dir, name)
+        if _os.path.isdir(src) and _os.path.isdir(dst):
+            _move_tree(src, dst)
+        else:
+            if _os.path.isdir(dst):
+                _shutil.rmtree(dst)
+            _os.replace(src, dst)
+
+def _move_output_to_project(project_root_dir, output_dir, relative_target_directory, artifacts = None):
     dst_path = _build_relative_path(project_root_dir, relative_target_directory)
-    _mkdir_p(dst_path)
-    with open(dst_path + '.tar', 'wb') as f:
-        bits, _ = container.get_archive(src_path)
-        for chunk in bits:
-            f.write(chunk)
-    
-    with _tarfile.open(dst_path + '.tar') as tf:
-        tf.extractall(dst_path)
-    
-    source_dir = _build_relative_path(dst_path, 'output')
-    for filename in _os.listdir(source_dir):
-        srcfile = _build_relative_path(source_dir, filename)
-        tgtfile = _build_relative_path(dst_path, filename)
-        _shutil.move(srcfile, tgtfile)
-    _shutil.rmtree(source_dir)
-    _os.remove(dst_path + '.tar')
+    if artifacts is None:
+        _move_tree(output_dir, dst_path)
+        return dst_path
+    selected = []
+    for root, _, filenames in _os.walk(output_dir):
+        for filename in filenames:
+            rel_path = _fix_path(_os.path.relpath(_os.path.join(root, filename), output_dir))
+            if any(_fnmatch.fnmatch(rel_path, pattern) for pattern in artifacts):
+                selected.append(rel_path)
+    for rel_path in selected:
+        target = _build_relative_path(dst_path, rel_path)
+        _mkdir_p(_os.path.dirname(target))
+        _os.replace(_build_relative_path(output_dir, rel_path), target)
+    print("Copied {} artifact(s) matching {}".format(len(selected), ', '.join(artifacts)))
     return dst_path
 
-def _copy_data_to_project(project_root_dir, container, model_name):
+class _ChunkReader(_io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks, such as the stream returned by get_archive"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) == 0:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+def _archive_member_path(name, strip_root = True):
+    parts = [x for x in _fix_path(name).split('/') if x not in ('', '.')]
+    if '..' in parts:
+        raise RuntimeError("Refusing to extract path outside of target directory: " + name)
+    if strip_root:
+        parts = parts[1:]
+    if len(parts) == 0:
+        return None
+    return '/'.join(parts)
+
+def _extract_archive_stream(chunks, dst_path, strip_root = True):
+    """Extracts a get_archive stream into dst_path as it is read.  With strip_root, the archived directory
+    itself is dropped so its contents land directly in dst_path."""
+    extracted = []
+    with _tarfile.open(fileobj = _io.BufferedReader(_ChunkReader(chunks)), mode = 'r|') as tf:
+        for member in tf:
+            name = _archive_member_path(member.name, strip_root = strip_root)
+            if name is None:
+                continue
+            member.name = name
+            if member.islnk():
+                # hard links name another member of the archive
+                member.linkname = _archive_member_path(member.linkname, strip_root = strip_root)
+            elif member.issym():
+                target = _posixpath.normpath(_posixpath.join(_posixpath.dirname(name), _fix_path(member.linkname)))
+                # later members could be written through a link pointing outside of dst_path
+                if _posixpath.isabs(target) or target == '..' or target.startswith('../'):
+                    raise RuntimeError("Refusing to extract link outside of target directory: " + member.linkname)
+            tf.extract(member, dst_path)
+            if not member.isdir():
+                extracted.append(name)
+    return extracted
+
+def _list_container_files(container, path):
+    result = container.exec_run(['find', path, '-type', 'f'])
+    if result.exit_code != 0:
+        raise RuntimeError("Error while listing files in container: " + str(result.output))
+    prefix = path.rstrip('/') + '/'
+    files = result.output.decode('utf-8').splitlines()
+    return [x[len(prefix):] for x in files if x.startswith(prefix)]
+
+def _copy_output_to_project(project_root_dir, container, relative_target_directory, artifacts = None):
+    """Copies the container output directory into the project.
+
+    Args:
+        artifacts: Optional list of glob patterns, matched against paths relative to the output directory.
+            Only matching files are pulled out of the container.
+    """
     src_path = _constants.DEFAULT_DIR_IN_CONTAINER + '/' + _constants.OUTPUT_PATH
-    dst_path = _build_relative_path(
-        _build_relative_path(project_root_dir, _constants.MODEL_PATH),
-        model_name)
+    dst_path = _build_relative_path(project_root_dir, relative_target_directory)
     _mkdir_p(dst_path)
-    with open(dst_path + '.tar', 'wb') as f:
+    if artifacts is None:
         bits, _ = container.get_archive(src_path)
-        for chunk in bits:
-            f.write(chunk)
-    
-    with _tarfile.open(dst_path + '.tar') as tf:
-        tf.extractall(dst_path)
-    _os.remove(dst_path + '.tar')
+        _extract_archive_stream(bits, dst_path)
+        return dst_path
+    selected = [x for x in _list_container_files(container, src_path)
+        if any(_fnmatch.fnmatch(x, pattern) for pattern in artifacts)]
+    for rel_path in selected:
+        file_dst_path = _build_relative_path(dst_path, _os.path.dirname(rel_path))
+        _mkdir_p(file_dst_path)
+        bits, _ = container.get_archive(_build_relative_path(src_path, rel_path))
+        _extract_archive_stream(bits, file_dst_path, strip_root = False)
+    print("Copied {} artifact(s) matching {}".format(len(selected), ', '.join(artifacts)))
     return dst_path
 
+def _copy_data_to_project(project_root_dir, container, model_name, artifacts = None):
+    return _copy_output_to_project(
+        project_root_dir,
+        container,
+        _build_relative_path(_constants.MODEL_PATH, model_name),
+        artifacts = artifacts)
+
+def _get_artifacts_config(project_root_dir):
+    config = _get_project_config(project_root_dir)
+    defaults = _constants.DEFAULT_ARTIFACTS
+    compression = config.get('artifacts', 'compression', fallback = defaults['compression'])
+    if compression not in _constants.ARTIFACT_COMPRESSIONS:
+        raise ValueError("Unknown artifact compression {}, must be one of {}".format(
+            compression, ', '.join(sorted(_constants.ARTIFACT_COMPRESSIONS))))
+    if compression == 'zstd' and _zstd is None:
+        raise ValueError("zstd artifact compression needs the zstandard package")
+    settings = {
+        'enabled': config.getboolean('artifacts', 'enabled', fallback = defaults['enabled']),
+        'keep': config.getint('artifacts', 'keep', fallback = defaults['keep']),
+        'compression': compression,
+        'level': config.getint('artifacts', 'level',
+            fallback = _constants.ARTIFACT_COMPRESSIONS[compression]['level'])
+    }
+    if settings['keep'] < 1:
+        raise ValueError("[artifacts] keep must be at least 1")
+    return settings
+
+def _artifacts_dir(project_root_dir, name):
+    return _build_relative_path(_build_relative_path(project_root_dir, _constants.ARTIFACTS_PATH), name)
+
+def _blob_path(project_root_dir, blob):
+    return _build_relative_path(_artifacts_dir(project_root_dir, 'blobs'), blob[:2] + '/' + blob)
+
+def _find_blob(project_root_dir, digest):
+    """Returns the name of the stored blob holding a chunk, whichever compression it was stored with"""
+    for compression in _constants.ARTIFACT_COMPRESSIONS.values():
+        if _os.path.isfile(_blob_path(project_root_dir, digest + compression['extension'])):
+            return digest + compression['extension']
+    return None
+
+def _write_blob(project_root_dir, digest, data, settings):
+    blob = digest + _constants.ARTIFACT_COMPRESSIONS[settings['compression']]['extension']
+    if settings['compression'] == 'zstd':
+        compressed = _zstd.ZstdCompressor(level = settings['level']).compress(data)
+    else:
+        compressed = _gzip.compress(data, compresslevel = settings['level'], mtime = 0)
+    path = _blob_path(project_root_dir, blob)
+    _mkdir_p(_os.path.dirname(path))
+    tmp_path = path + '.' + _random_file_name() + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(compressed)
+    _os.replace(tmp_path, path)
+    return blob, len(compressed)
+
+def _read_blob(project_root_dir, blob):
+    with open(_blob_path(project_root_dir, blob), 'rb') as f:
+        data = f.read()
+    if blob.endswith(_constants.ARTIFACT_COMPRESSIONS['zstd']['extension']):
+        if _zstd is None:
+            raise RuntimeError("Blob {} is zstd compressed, which needs the zstandard package".format(blob))
+        return _zstd.ZstdDecompressor().decompress(data)
+    return _gzip.decompress(data)
+
+def _manifest_path(project_root_dir, model_name, version):
+    return _build_relative_path(_artifacts_dir(project_root_dir, 'manifests'), '{}/{}.json'.format(model_name, version))
+
+def _artifact_versions(project_root_dir, model_name):
+    manifest_dir = _build_relative_path(_artifacts_dir(project_root_dir, 'manifests'), model_name)
+    if not _os.path.isdir(manifest_dir):
+        return []
+    return sorted(int(x[:-len('.json')]) for x in _os.listdir(manifest_dir) if _re.match(r'^\d+\.json$', x))
+
+def _load_artifact_manifest(project_root_dir, model_name, version = None):
+    """Returns the manifest of a stored version, the latest one by default, or None if there is none"""
+    if version is None:
+        versions = _artifact_versions(project_root_dir, model_name)
+        if len(versions) == 0:
+            return None
+        version = versions[-1]
+    return _read_json_file(_manifest_path(project_root_dir, model_name, version), default = None)
+
+def _store_artifacts(project_root_dir, model_name):
+    """Stores model/<model_name> as a new version in the artifact store and returns its manifest.  Files are
+    split into chunks, and only chunks not already in the store are compressed and written.  If nothing
+    changed since the latest version, that version is returned instead."""
+    settings = _get_artifacts_config(project_root_dir)
+    model_dir = _build_relative_path(_build_relative_path(project_root_dir, _constants.MODEL_PATH), model_name)
+    if not _os.path.isdir(model_dir):
+        raise ValueError("Model {} has no output in {}".format(model_name, _constants.MODEL_PATH))
+    with _file_lock(_build_relative_path(project_root_dir, _constants.ARTIFACTS_LOCK_PATH)):
+        latest = _load_artifact_manifest(project_root_dir, model_name)
+        previous_files = latest['files'] if latest is not None else {}
+        files = {}
+        new_blobs = 0
+        new_bytes = 0
+        for path, rel_path in _iter_directory_entries(model_dir):
+            # the fingerprint describes the training run, not the model
+            if rel_path == _constants.MODEL_FINGERPRINT_NAME or _os.path.islink(path) or not _os.path.isfile(path):
+                continue
+            stat = _os.stat(path)
+            previous = previous_files.get(rel_path)
+            if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns \
+                    and all(_os.path.isfile(_blob_path(project_root_dir, x)) for x in previous['chunks']):
+                files[rel_path] = dict(previous, mode = stat.st_mode & 0o7777)
+                continue
+            hasher = _hashlib.sha256()
+            chunks = []
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(_constants.ARTIFACT_CHUNK_SIZE), b''):
+                    hasher.update(data)
+                    digest = _hashlib.sha256(data).hexdigest()
+                    blob = _find_blob(project_root_dir, digest)
+                    if blob is None:
+                        blob, size = _write_blob(project_root_dir, digest, data, settings)
+                        new_blobs += 1
+                        new_bytes += size
+                    chunks.append(blob)
+            files[rel_path] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'mode': stat.st_mode & 0o7777,
+                'hash': hasher.hexdigest(),
+                'chunks': chunks
+            }
+        content = lambda entries: {k: (v['hash'], v['mode']) for k, v in entries.items()}
+        if latest is not None and content(files) == content(previous_files):
+            print("Model {} is unchanged since artifact version {}".format(model_name, latest['version']))
+            return latest
+        manifest = {
+            'model_name': model_name,
+            'version': latest['version'] + 1 if latest is not None else 1,
+            'created': _time.time(),
+            'size': sum(x['size'] for x in files.values()),
+            'files': files
+        }
+        _write_json_file(_manifest_path(project_root_dir, model_name, manifest['version']), manifest)
+        print("Stored model {} as artifact version {}: {} file(s), {} new blob(s), {} compressed bytes written".format(
+            model_name, manifest['version'], len(files), new_blobs, new_bytes))
+        _gc_artifacts(project_root_dir, settings['keep'])
+    return manifest
+
+def _referenced_blobs(project_root_dir):
+    referenced = set()
+    manifest_root = _artifacts_dir(project_root_dir, 'manifests')
+    for model_name in (_os.listdir(manifest_root) if _os.path.isdir(manifest_root) else []):
+        for version in _artifact_versions(project_root_dir, model_name):
+            manifest = _load_artifact_manifest(project_root_dir, model_name, version)
+            for entry in manifest['files'].values():
+                referenced.update(entry['chunks'])
+    return referenced
+
+def _gc_artifacts(project_root_dir, keep):
+    """Removes all but the last keep versions of every model, except versions that are deployed, then the
+    blobs no remaining version uses.  Expects the artifacts lock to be held."""
+    deployed = set((k, v.get('artifact_version')) for k, v in _load_deployments(project_root_dir).items())
+    removed_versions = 0
+    manifest_root = _artifacts_dir(project_root_dir, 'manifests')
+    for model_name in (_os.listdir(manifest_root) if _os.path.isdir(manifest_root) else []):
+        for version in _artifact_versions(project_root_dir, model_name)[:-keep]:
+            if (model_name, version) not in deployed:
+                _os.remove(_manifest_path(project_root_dir, model_name, version))
+                removed_versions += 1
+    referenced = _referenced_blobs(project_root_dir)
+    removed_blobs = 0
+    freed = 0
+    for root, _, filenames in _os.walk(_artifacts_dir(project_root_dir, 'blobs')):
+        for name in filenames:
+            if name not in referenced:
+                path = _os.path.join(root, name)
+                freed += _os.path.getsize(path)
+                _os.remove(path)
+                removed_blobs += 1
+    if removed_versions > 0 or removed_blobs > 0:
+        print("Removed {} artifact version(s) and {} blob(s), freeing {} bytes".format(
+            removed_versions, removed_blobs, freed))
+    return {'versions': removed_versions, 'blobs': removed_blobs, 'bytes': freed}
+
+def _artifact_volume_name(project_root_dir):
+    return _constants.ARTIFACT_VOLUME_PREFIX + _get_project_config(project_root_dir)['DEFAULT']['PROJECT_ID']
+
+def _artifact_restore_script(manifest):
+    """Shell script rebuilding a version from its blobs, called with the blob directory and the target
+    directory.  Compressed gzip and zstd streams are decompressed with the container's gzip and zstd."""
+    lines = ['set -e', 'B="$1"', 'T="$2"', 'rm -rf "$T"', 'mkdir -p "$T"']
+    for rel_path in sorted(manifest['files']):
+        entry = manifest['files'][rel_path]
+        target = '"$T"/' + _shlex.quote(rel_path)
+        if '/' in rel_path:
+            lines.append('mkdir -p "$T"/' + _shlex.quote(_os.path.dirname(rel_path)))
+        if len(entry['chunks']) == 0:
+            lines.append(': > ' + target)
+        else:
+            lines.append('{ ' + ' '.join('{} "$B"/{};'.format(
+                'zstd -dcq' if x.endswith(_constants.ARTIFACT_COMPRESSIONS['zstd']['extension']) else 'gzip -dc',
+                _shlex.quote(x)) for x in entry['chunks']) + ' } > ' + target)
+        lines.append('chmod {:o} {}'.format(entry['mode'], target))
+    return '\n'.join(lines) + '\n'
+
+def _copy_artifacts_to_container(project_root_dir, container, manifest):
+    """Rebuilds a stored version in model/<model_name> of a container with the artifact volume mounted,
+    uploading only the blobs the volume does not have yet"""
+    blobs_dir = _constants.ARTIFACT_BLOBS_IN_CONTAINER
+    _exec_and_wait(container, ['mkdir', '-p', blobs_dir])
+    present = set(_list_container_files(container, blobs_dir))
+    needed = sorted(set(x for entry in manifest['files'].values() for x in entry['chunks']))
+    missing = [x for x in needed if x not in present]
+    print("Uploading {} of {} blob(s) for model {} artifact version {}".format(
+        len(missing), len(needed), manifest['model_name'], manifest['version']))
+    # other deploys share the volume, blobs are uploaded to a staging directory and renamed into place so
+    # they never see a partly written one
+    staging = '.upload-{}'.format(_random_file_name())
+    script = _artifact_restore_script(manifest).encode('utf-8')
+    def upload():
+        # the script travels in the same archive as the blobs
+        entries = ((_blob_path(project_root_dir, x), staging + '/' + x) for x in missing)
+        chunks = _tar_stream(entries)
+        header = _tarfile.TarInfo(staging + '/' + _constants.ARTIFACT_RESTORE_SCRIPT_NAME)
+        header.size = len(script)
+        header.mtime = _time.time()
+        padding = _tarfile.NUL * ((_tarfile.BLOCKSIZE - len(script) % _tarfile.BLOCKSIZE) % _tarfile.BLOCKSIZE)
+        archive = _itertools.chain([header.tobuf(format = _tarfile.PAX_FORMAT), script, padding], chunks)
+        if not container.put_archive(blobs_dir, archive):
+            raise RuntimeError("Error while copying artifacts to container")
+    staging_path = blobs_dir + '/' + staging
+    target = _build_relative_path(
+        _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.MODEL_PATH), manifest['model_name'])
+    try:
+        _retry(upload)
+        _exec_and_wait(container, ['sh', '-c',
+            'cd "$1" && for f in *; do [ "$f" = "$2" ] || mv -f -- "$f" ../; done',
+            'sh', staging_path, _constants.ARTIFACT_RESTORE_SCRIPT_NAME])
+        _exec_and_wait(container, ['sh', staging_path + '/' + _constants.ARTIFACT_RESTORE_SCRIPT_NAME,
+            blobs_dir, target], timeout = _constants.ARTIFACT_RESTORE_TIMEOUT)
+    finally:
+        _exec_and_wait(container, ['rm', '-rf', staging_path])
+    _remove_unreferenced_volume_blobs(project_root_dir, container)
+
+def _remove_unreferenced_volume_blobs(project_root_dir, container):
+    """Removes blobs of versions no longer in the store from the artifact volume.  The listing and the removal
+    happen under the artifact store lock.  A deploy stores its version, under the same lock, before it lists
+    the volume, so a blob is either referenced when it is checked here or uploaded again by that deploy."""
+    blobs_dir = _constants.ARTIFACT_BLOBS_IN_CONTAINER
+    with _file_lock(_build_relative_path(project_root_dir, _constants.ARTIFACTS_LOCK_PATH)):
+        present = set(_list_container_files(container, blobs_dir))
+        # names starting with a dot are staged uploads of deploys still running
+        unreferenced = sorted(x for x in present - _referenced_blobs(project_root_dir) if not x.startswith('.'))
+        for i in range(0, len(unreferenced), 500):
+            _exec_and_wait(container, ['rm', '-f', '--'] + [blobs_dir + '/' + x for x in unreferenced[i:i + 500]])
+
+def store_artifacts(project_root_dir, model_name):
+    """Stores the current output of a model in the artifact store.  train_model does this after every
+    training when the store is enabled in project.ini.
+
+    Args:
+        project_root_dir: The root directory of the project
+        model_name: Name of the model, its output is read from model/<model_name>
+
+    Returns:
+        The stored version number
+    """
+    _check_project_dir(project_root_dir)
+    return _store_artifacts(project_root_dir, model_name)['version']
+
+def list_artifacts(project_root_dir, model_name = None):
+    """Returns the stored versions, oldest first, as dicts of model_name, version, created, size and files
+
+    Args:
+        project_root_dir: The root directory of the project
+        model_name: Optional model to filter on
+    """
+    _check_project_dir(project_root_dir)
+    manifest_root = _artifacts_dir(project_root_dir, 'manifests')
+    model_names = [model_name] if model_name is not None else \
+        sorted(_os.listdir(manifest_root)) if _os.path.isdir(manifest_root) else []
+    versions = []
+    for name in model_names:
+        for version in _artifact_versions(project_root_dir, name):
+            manifest = _load_artifact_manifest(project_root_dir, name, version)
+            versions.append({
+                'model_name': name,
+                'version': version,
+                'created': manifest['created'],
+                'size': manifest['size'],
+                'files': len(manifest['files'])
+            })
+    return versions
+
+def restore_artifacts(project_root_dir, model_name, version):
+    """Replaces model/<model_name> with a stored version.  The model is retrained the next time train_model
+    runs for it, as the restored files did not come from the current script and data.
+
+    Args:
+        project_root_dir: The root directory of the project
+        model_name: Name of the model
+        version: Stored version number
+    """
+    _check_project_dir(project_root_dir)
+    manifest = _load_artifact_manifest(project_root_dir, model_name, version)
+    if manifest is None:
+        raise ValueError("Model {} has no artifact version {}".format(model_name, version))
+    model_dir = _build_relative_path(_build_relative_path(project_root_dir, _constants.MODEL_PATH), model_name)
+    tmp_dir = _build_relative_path(
+        _build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH), 'restore-' + _random_file_name())
+    try:
+        for rel_path, entry in manifest['files'].items():
+            path = _build_relative_path(tmp_dir, rel_path)
+            _mkdir_p(_os.path.dirname(path))
+            with open(path, 'wb') as f:
+                for blob in entry['chunks']:
+                    f.write(_read_blob(project_root_dir, blob))
+            _os.chmod(path, entry['mode'])
+        _shutil.rmtree(model_dir, ignore_errors = True)
+        _mkdir_p(_os.path.dirname(model_dir))
+        _os.replace(tmp_dir, model_dir)
+    finally:
+        _shutil.rmtree(tmp_dir, ignore_errors = True)
+    print("Restored model {} artifact version {}".format(model_name, version))
+
+def gc_artifacts(project_root_dir, keep = None):
+    """Removes old versions from the artifact store, keeping the last keep versions of every model and every
+    deployed version, then the blobs no remaining version uses
+
+    Args:
+        project_root_dir: The root directory of the project
+        keep: Number of versions to keep per model, defaults to the [artifacts] settings
+
+    Returns:
+        A dict with the number of versions and blobs removed and the bytes freed
+    """
+    _check_project_dir(project_root_dir)
+    if keep is None:
+        keep = _get_artifacts_config(project_root_dir)['keep']
+    if keep < 1:
+        raise ValueError("At least one version per model has to be kept")
+    with _file_lock(_build_relative_path(project_root_dir, _constants.ARTIFACTS_LOCK_PATH)):
+        return _gc_artifacts(project_root_dir, keep)
+
 def _get_file_type(file_name):
     if len(file_name) > 3 and file_name[-3:].lower() == '.py':
         return 'python'
@@ -201,10 +1257,20 @@ def _extract_deploy_model_name(model_api_file):
         raise IOError("Cannot extract valid model_name from file, please manually provide model_name")
     return '_'.join(filename_split[1:]).lower()
 
-def _get_train_model_command(train_model_file):
+def _get_train_model_command(train_model_file, stream = False):
     commands = []
     commands.append('cd "' + _constants.DEFAULT_DIR_IN_CONTAINER + '"')
     file_type = _get_file_type(train_model_file)
+    if file_type is None:
+        raise NotImplementedError("No run option available for file {}".format(train_model_file))
+    if stream:
+        # unbuffered output, written to the log in the container and to the exec stream as it is produced
+        tmf_path = _build_relative_path(_constants.SOURCE_PATH, train_model_file)
+        run = {'python': 'python -u', 'r': 'Rscript'}[file_type]
+        commands.insert(0, 'set -o pipefail')
+        commands.append(run + ' "' + tmf_path + '" 2>&1 | tee -a ./output/log.log')
+        return 'bash -c "' + ' && '.join(commands).replace('"', '\\"') + '"'
+
     if file_type == 'python':
         tmf_path = _build_relative_path(_constants.SOURCE_PATH, train_model_file)
         commands.append('python "' +  tmf_path + '" 2>&1 >> ./output/log.log')
@@ -217,13 +1283,91 @@ def _get_train_model_command(train_model_file):
 def _get_refresh_data_command(data_refresh_file):
     return _get_train_model_command(data_refresh_file)
 
-def _get_flask_deploy_command(flask_path):
+def _get_serving_config(project_root_dir, model_name, overrides = None):
+    """Serving options for a deployment: package defaults, then the [serving] section of project.ini,
+    then a [serving.<model_name>] section, then overrides"""
+    config = _get_project_config(project_root_dir)
+    serving = dict(_constants.DEFAULT_SERVING)
+    for section in ['serving', 'serving.' + model_name]:
+        if not config.has_section(section):
+            continue
+        for key, default in _constants.DEFAULT_SERVING.items():
+            if key not in config[section]:
+                continue
+            if isinstance(default, bool):
+                serving[key] = config.getboolean(section, key)
+            elif isinstance(default, int):
+                serving[key] = config.getint(section, key)
+            elif isinstance(default, float):
+                serving[key] = config.getfloat(section, key)
+            else:
+                serving[key] = config.get(section, key)
+    for key, value in (overrides or {}).items():
+        if key not in _constants.DEFAULT_SERVING:
+            raise ValueError("Unknown serving option " + key)
+        if value is not None:
+            serving[key] = value
+    if serving['server'] not in _constants.SERVING_SERVERS:
+        raise ValueError("Unknown server {}, must be one of {}".format(
+            serving['server'], ', '.join(sorted(_constants.SERVING_SERVERS))))
+    if serving['load'] not in _constants.MODEL_LOAD_MODES:
+        raise ValueError("Unknown load mode {}, must be one of {}".format(
+            serving['load'], ', '.join(sorted(_constants.MODEL_LOAD_MODES))))
+    return serving
+
+def _server_pid_command():
+    # the server is exec'd after this, so it keeps the shell's pid
+    return 'echo $$ > ' + _constants.SERVER_PID_IN_CONTAINER_PATH
+
+def _get_flask_deploy_command(flask_path, serving = None, deploy_version = None, model_name = None):
+    # deployments registered before a setting existed get its default
+    serving = dict(_constants.DEFAULT_SERVING, **(serving or {}))
     commands = []
     commands.append('cd "' + _constants.DEFAULT_DIR_IN_CONTAINER + '"')
+    if deploy_version is not None:
+        commands.append('export HARBORML_DEPLOY_VERSION={}'.format(deploy_version))
+    if model_name is not None:
+        commands.append('export HARBORML_MODEL_DIR="{}"'.format(_build_relative_path(
+            _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, _constants.MODEL_PATH), model_name)))
+    commands.append('export HARBORML_LOAD={}'.format(serving['load']))
+    if serving['mmap']:
+        commands.append('export HARBORML_MMAP=1')
+    if serving['warmup']:
+        commands.append('export HARBORML_WARMUP=1')
+    if serving['cache']:
+        commands.append('export HARBORML_CACHE=1')
+        commands.append('export HARBORML_CACHE_SIZE={}'.format(serving['cache_size']))
+        commands.append('export HARBORML_CACHE_TTL={}'.format(serving['cache_ttl']))
     api_path = _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, flask_path)
-    commands.append('export FLASK_APP="' +  api_path + '"')
-    commands.append('export FLASK_ENV=development')
-    commands.append('flask run --host=0.0.0.0 2>&1 >> ./output/log.log')
+    if serving['microbatch']:
+        commands.append('export HARBORML_MICROBATCH=1')
+        commands.append('export HARBORML_MAX_BATCH_SIZE={}'.format(serving['max_batch_size']))
+        commands.append('export HARBORML_MAX_WAIT_MS={}'.format(serving['max_wait_ms']))
+    if serving['server'] == 'gunicorn':
+        # the working directory stays the project root, so relative paths in the deploy script keep working
+        args = [
+            'gunicorn',
+            '--bind 0.0.0.0:5000',
+            '--pythonpath "{}"'.format(_os.path.dirname(api_path)),
+            '--workers {}'.format(serving['workers']),
+            '--worker-class {}'.format(serving['worker_class']),
+            '--threads {}'.format(serving['threads']),
+            '--timeout {}'.format(serving['timeout']),
+            '--graceful-timeout {}'.format(serving['graceful_timeout']),
+            '--keep-alive {}'.format(serving['keepalive'])
+        ]
+        if serving['preload']:
+            # import the app, and with it the model, once in the master and fork it into the workers
+            args.append('--preload')
+            commands.append('export HARBORML_PRELOAD=1')
+        args.append('{}:app'.format(_os.path.splitext(_os.path.basename(api_path))[0]))
+        commands.append(_server_pid_command())
+        commands.append('exec ' + ' '.join(args) + ' >> ./output/log.log 2>&1')
+    else:
+        commands.append('export FLASK_APP="' +  api_path + '"')
+        commands.append('export FLASK_ENV=development')
+        commands.append(_server_pid_command())
+        commands.append('exec flask run --host=0.0.0.0 2>&1 >> ./output/log.log')
     cmd = 'bash -c  "' + ' && '.join(commands).replace('"', '\\"') + '"'
     return cmd
 
@@ -234,19 +1378,34 @@ def _get_plumber_deploy_command(plumber_path):
     #commands.append('export FLASK_APP="' +  api_path + '"')
     #commands.append('export FLASK_ENV=development')
     #commands.append('flask run --host=0.0.0.0 >> log.log')
-    commands.append('R -e \'plumber::plumb(\\"{}\\")$run(host=\\"0.0.0.0\\", port=5000)\' 2>&1 >> ./output/log.log'.format(api_path))
+    commands.append(_server_pid_command())
+    commands.append('exec R -e \'plumber::plumb(\\"{}\\")$run(host=\\"0.0.0.0\\", port=5000)\' 2>&1 >> ./output/log.log'.format(api_path))
     cmd = 'bash -c  "' + ' && '.join(commands) + '"'
     return cmd
 
 def _random_hex(num_digits):
     return ''.join(_random.choice('0123456789abcdef') for n in range(num_digits))
 
+_project_config_cache = {}
+_project_config_lock = _threading.Lock()
+
 def _get_project_config(project_root_dir):
+    """Parsed project.ini, cached until the file changes.  Callers must not modify the returned config."""
+    ini_path = _os.path.abspath(_build_relative_path(project_root_dir, _constants.INI_PATH))
+    try:
+        stat = _os.stat(ini_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+    with _project_config_lock:
+        cached = _project_config_cache.get(ini_path)
+        if cached is not None and key is not None and cached[0] == key:
+            return cached[1]
     config = _configparser.ConfigParser()
-    config.read(
-        _build_relative_path(
-            project_root_dir,
-            _constants.INI_PATH))
+    config.read(ini_path)
+    if key is not None:
+        with _project_config_lock:
+            _project_config_cache[ini_path] = (key, config)
     return config
 
 def start_project(project_root_dir):
@@ -256,6 +1415,7 @@ def start_project(project_root_dir):
         project_root_dir: The root directory of the project"""
     _check_project_dir(project_root_dir)
     _mkdir_p(_build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH))
+    _mkdir_p(_build_relative_path(project_root_dir, _constants.META_PATH))
     _mkdir_p(_build_relative_path(project_root_dir, _constants.DATA_PATH))
     _mkdir_p(_build_relative_path(project_root_dir, _constants.DOCKER_PATH))
     _mkdir_p(_build_relative_path(project_root_dir, _constants.DOCKER_INCLUDES))
@@ -283,109 +1443,556 @@ def start_project(project_root_dir):
     config['DEFAULT'] = {
         'PROJECT_ID': _random_hex(32)
     }
+    config['pool'] = {
+        'size': str(_constants.DEFAULT_POOL_SIZE),
+        'ttl': str(_constants.DEFAULT_POOL_TTL)
+    }
+    config['transfer'] = {
+        'strategy': _constants.DEFAULT_TRANSFER_STRATEGY
+    }
+    config['deploy'] = {
+        'readiness_timeout': str(_constants.DEFAULT_READINESS_TIMEOUT),
+        'drain_seconds': str(_constants.DEFAULT_DRAIN_SECONDS),
+        'replicas': str(_constants.DEFAULT_REPLICAS),
+        'balance': _constants.DEFAULT_BALANCE
+    }
+    config['proxy'] = {
+        'profile': _constants.NEW_PROJECT_PROXY_PROFILE
+    }
+    config['artifacts'] = {
+        'enabled': str(_constants.NEW_PROJECT_ARTIFACTS_ENABLED).lower(),
+        'keep': str(_constants.DEFAULT_ARTIFACTS['keep']),
+        'compression': _constants.DEFAULT_ARTIFACTS['compression']
+    }
+    serving = dict(_constants.DEFAULT_SERVING)
+    serving['server'] = _constants.NEW_PROJECT_SERVING_SERVER
+    config['serving'] = {k: str(v).lower() if isinstance(v, bool) else str(v) for k, v in serving.items()}
     with open(_build_relative_path(project_root_dir, _constants.INI_PATH), 'w') as configfile:
         config.write(configfile)
 
-def build_container(project_root_dir, container_name):
+def build_container(project_root_dir, container_name, rebuild = False):
     """Inteface for building a specific container.  This is useful for testing container builds work correctly
 
     Args:
         project_root_dir: The root directory of the project
         container_name: The name of the container
+        rebuild: Build the image even if the build cache has an image for the current dockerfile and includes
     """
     _check_project_dir(project_root_dir)
-    return _build_container(project_root_dir, container_name)
+    return _build_container(project_root_dir, container_name, rebuild = rebuild)
 
-def train_model(project_root_dir, container_name, train_model_file, model_name = None, save_history = False, 
-    stop_container = True):
-    if model_name is None:
-        model_name = _extract_train_model_name(train_model_file)
+def prune_images(project_root_dir):
+    """Removes stale images from the project's build cache and drops cache entries for images that no longer
+    exist.  A cached image is stale if its container has no dockerfile in the project, or if it is not the most
+    recent build of that container.  Images the build cache did not record, or that another project built, are
+    never removed.
+
+    Args:
+        project_root_dir: The root directory of the project
 
+    Returns:
+        The list of removed images, by tag, or by id if they had no tags
+    """
     _check_project_dir(project_root_dir)
-    print("Building container...")
-    image_tag = _build_container(project_root_dir, container_name)
+    return _prune_images(project_root_dir)
+
+def _format_elapsed(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return '{}:{:02d}:{:02d}'.format(minutes // 60, minutes % 60, seconds)
+
+def _stream_exec(container, cmd, log_file, prefix):
+    """Runs a command in a container, printing its stdout and stderr line by line with the elapsed time as
+    they arrive, and appending the raw output to log_file.  Returns the exit code."""
+    api = _docker_client().api
+    exec_id = api.exec_create(container.id, cmd)['Id']
+    start = _time.time()
+    partial = {'stdout': b'', 'stderr': b''}
+
+    def emit(stream_name, line):
+        print("[{} {}] {}".format(prefix, _format_elapsed(_time.time() - start), line.decode('utf-8', 'replace')),
+            file = _sys.stderr if stream_name == 'stderr' else _sys.stdout, flush = True)
+
+    _mkdir_p(_os.path.dirname(log_file))
+    with open(log_file, 'ab') as log:
+        for stdout, stderr in api.exec_start(exec_id, stream = True, demux = True):
+            for stream_name, chunk in (('stdout', stdout), ('stderr', stderr)):
+                if not chunk:
+                    continue
+                log.write(chunk)
+                log.flush()
+                lines = (partial[stream_name] + chunk).split(b'\n')
+                partial[stream_name] = lines.pop()
+                for line in lines:
+                    emit(stream_name, line)
+        for stream_name, rest in partial.items():
+            if rest:
+                emit(stream_name, rest)
+    return api.exec_inspect(exec_id)['ExitCode']
+
+def _run_job(project_root_dir, container_name, run_file, relative_target_directory, stop_container = True,
+    rebuild = False, transfer = None, artifacts = None, image_tag = None, cpus = None, mem_limit = None,
+    stream_logs = False):
+    """Runs a script in a container and copies its output to relative_target_directory.  Returns the run result:
+    the seconds spent in each phase, the total, where the output and the streamed log were written, and
+    the container, which is only still running if stop_container is False."""
+    job_start = _time.time()
+    timings = {}
+    lap_start = [job_start]
+
+    def lap(phase):
+        now = _time.time()
+        timings[phase] = timings.get(phase, 0.0) + now - lap_start[0]
+        lap_start[0] = now
+
+    result = {
+        'run_file': run_file,
+        'target_dir': None,
+        'log_file': None,
+        'timings': timings,
+        'seconds': None,
+        'container': None
+    }
+    transfer = _get_transfer_strategy(project_root_dir, transfer)
+    # before anything is built or started, so a script that can not run fails right away
+    cmd = _get_train_model_command(run_file, stream = stream_logs)
+    if image_tag is None:
+        print("Building container...")
+        image_tag = _build_container(project_root_dir, container_name, rebuild = rebuild)
+    lap('build')
+    pool_size, _ = _get_pool_config(project_root_dir)
+    # mounts and resource limits are fixed when a container is created, so those runs cannot share pooled containers
+    limited = cpus is not None or mem_limit is not None
+    use_pool = stop_container and pool_size > 0 and transfer != 'mount' and not limited
+    output_dir = None
+    container = None
     print("Starting container...")
-    container = _start_container(image_tag)
     try:
-        print("Copying project to container...")
-        _copy_project_to_container(project_root_dir, container)
-        cmd = _get_train_model_command(train_model_file)
+        if use_pool:
+            container = _lease_container(project_root_dir, image_tag)
+        elif transfer == 'mount':
+            output_dir = _build_relative_path(
+                _build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH),
+                _random_file_name())
+            _mkdir_p(output_dir)
+            container = _start_container(image_tag, volumes = _project_volumes(project_root_dir, output_dir = output_dir),
+                cpus = cpus, mem_limit = mem_limit)
+        else:
+            container = _start_container(image_tag, cpus = cpus, mem_limit = mem_limit)
+        lap('start')
+        if transfer != 'mount':
+            print("Copying project to container...")
+            _copy_project_to_container(project_root_dir, container, transfer = transfer)
+        lap('copy_in')
         print("Running command in container: " + cmd)
-        result = container.exec_run(cmd)
-        if result.exit_code != 0:
-            raise RuntimeError("Error while running container command: " + str(result.output))
+        if stream_logs:
+            name = _os.path.basename(relative_target_directory)
+            result['log_file'] = _build_relative_path(
+                _build_relative_path(project_root_dir, _constants.RUN_LOGS_PATH),
+                '{}-{}.log'.format(name, _time.strftime('%Y%m%d-%H%M%S')))
+            print("Streaming output, also written to " + result['log_file'])
+            exit_code = _stream_exec(container, cmd, result['log_file'], name)
+            if exit_code != 0:
+                raise RuntimeError("Container command exited with code {}, see {}".format(exit_code, result['log_file']))
+        else:
+            run = container.exec_run(cmd)
+            if run.exit_code != 0:
+                raise RuntimeError("Error while running container command: " + str(run.output))
+        lap('run')
         print("Copying output back to project")
-        output_dir = _copy_output_to_project(project_root_dir, container, _build_relative_path(_constants.MODEL_PATH, model_name))
-        print("Run output written to " + output_dir)
+        if transfer == 'mount':
+            _claim_mounted_output(container)
+            target_dir = _move_output_to_project(project_root_dir, output_dir, relative_target_directory, artifacts = artifacts)
+        else:
+            target_dir = _copy_output_to_project(project_root_dir, container, relative_target_directory, artifacts = artifacts)
+        result['target_dir'] = target_dir
+        print("Run output written to " + target_dir)
+        lap('copy_out')
     finally:
-        if stop_container and container != None:
+        if use_pool and container != None:
+            _release_container(project_root_dir, container, keep_project = transfer == 'sync')
+        elif stop_container and container != None:
             print("Stopping container...")
-            container.stop(timeout = 0)
-        if not stop_container and container != None:
-            print("Container still running")
-            return container
+            _remove_container_manifest(project_root_dir, container.id)
+            _stop_container(container)
+        if stop_container and output_dir is not None:
+            _shutil.rmtree(output_dir, ignore_errors = True)
+        lap('stop')
+    result['seconds'] = _time.time() - job_start
+    print("Finished in {:.1f}s ({})".format(result['seconds'], ', '.join(
+        '{} {:.1f}s'.format(x, timings[x]) for x in _constants.RUN_PHASES if x in timings)))
+    if not stop_container:
+        print("Container still running")
+        result['container'] = container
+    return result
+
+def _model_fingerprint(project_root_dir, train_model_file, image_tag, artifacts = None):
+    script_hash = _hash_file(
+        _check_and_format_file(project_root_dir, _constants.SOURCE_PATH + '/' + train_model_file)).hexdigest()
+    data_hash = _hash_project_scopes(project_root_dir, [_constants.DATA_PATH])
+    image_id = _docker_client().images.get(image_tag).id
+    fingerprint = {
+        'script': script_hash,
+        'data': data_hash,
+        'image_id': image_id,
+        'artifacts': sorted(artifacts) if artifacts is not None else None
+    }
+    fingerprint['fingerprint'] = _hashlib.sha256(_json.dumps(fingerprint, sort_keys = True).encode('utf-8')).hexdigest()
+    return fingerprint
+
+def _record_model_cache(project_root_dir, hit):
+    stats_file = _build_relative_path(project_root_dir, _constants.MODEL_CACHE_STATS_PATH)
+    with _file_lock(_build_relative_path(project_root_dir, _constants.MODEL_CACHE_LOCK_PATH)):
+        stats = _read_json_file(stats_file, default = {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+        _write_json_file(stats_file, stats)
+
+def _train_model(project_root_dir, container_name, train_model_file, model_name, image_tag, force = False,
+    stop_container = True, artifacts = None, **kwargs):
+    """Trains a model unless the fingerprint stored with its output matches the current script, data and image.
+    Returns the run result of _run_job, with cached set if training was skipped."""
+    relative_target_directory = _build_relative_path(_constants.MODEL_PATH, model_name)
+    fingerprint_file = _build_relative_path(
+        _build_relative_path(project_root_dir, relative_target_directory),
+        _constants.MODEL_FINGERPRINT_NAME)
+    fingerprint = _model_fingerprint(project_root_dir, train_model_file, image_tag, artifacts = artifacts)
+    # a caller asking for the container to be kept running needs a real run
+    if not force and stop_container:
+        previous = _read_json_file(fingerprint_file)
+        if previous.get('fingerprint') == fingerprint['fingerprint']:
+            _record_model_cache(project_root_dir, hit = True)
+            print("Model {} is up to date, skipping training".format(model_name))
+            return {
+                'run_file': train_model_file,
+                'target_dir': _build_relative_path(project_root_dir, relative_target_directory),
+                'log_file': None,
+                'timings': {},
+                'seconds': 0.0,
+                'container': None,
+                'cached': True
+            }
+    _record_model_cache(project_root_dir, hit = False)
+    result = _run_job(
+        project_root_dir, container_name, train_model_file, relative_target_directory,
+        stop_container = stop_container, artifacts = artifacts, image_tag = image_tag, **kwargs)
+    _write_json_file(fingerprint_file, fingerprint)
+    result['cached'] = False
+    if _get_artifacts_config(project_root_dir)['enabled']:
+        _store_artifacts(project_root_dir, model_name)
+    return result
+
+def train_model(project_root_dir, container_name, train_model_file, model_name = None, save_history = False, 
+    stop_container = True, rebuild = False, transfer = None, artifacts = None, force = False, stream_logs = False,
+    timings = False):
+    """Trains a model in a container and copies the output to model/<model_name>.  Training is skipped if the
+    script, the data and the container image are unchanged since the model was last trained.
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The name of the container
+        train_model_file: Training script, relative to src
+        model_name: Name of the model, taken from the file name by default
+        stop_container: Stop the container when training is done, otherwise it is returned
+        rebuild: Build the image even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the container, defaults to the strategy in project.ini
+        artifacts: Optional list of glob patterns, only matching output files are copied back
+        force: Train even if the model is up to date
+        stream_logs: Print the script's output as it runs, and keep a copy in .harborml/logs
+        timings: Return the run result instead of the container
+
+    Returns:
+        The container if stop_container is False, otherwise None.  With timings, a dict with the seconds spent
+        in each phase (timings: build, start, copy_in, run, copy_out, stop), the total seconds, target_dir,
+        log_file when streaming, cached, and the container if stop_container is False.
+    """
+    if model_name is None:
+        model_name = _extract_train_model_name(train_model_file)
+
+    _check_project_dir(project_root_dir)
+    build_start = _time.time()
+    print("Building container...")
+    image_tag = _build_container(project_root_dir, container_name, rebuild = rebuild)
+    build_seconds = _time.time() - build_start
+    result = _train_model(
+        project_root_dir, container_name, train_model_file, model_name, image_tag, force = force,
+        stop_container = stop_container, transfer = transfer, artifacts = artifacts, stream_logs = stream_logs)
+    result['timings']['build'] = build_seconds
+    result['seconds'] += build_seconds
+    return result if timings else result['container']
+
+def model_cache_stats(project_root_dir):
+    """Returns the number of train_model calls skipped because the model was up to date (hits), and the
+    number that trained (misses)
+
+    Args:
+        project_root_dir: The root directory of the project
+    """
+    _check_project_dir(project_root_dir)
+    return _read_json_file(
+        _build_relative_path(project_root_dir, _constants.MODEL_CACHE_STATS_PATH),
+        default = {'hits': 0, 'misses': 0})
+
+def _discover_train_files(project_root_dir):
+    src_path = _build_relative_path(project_root_dir, _constants.SOURCE_PATH)
+    train_files = []
+    for root, dirs, filenames in _os.walk(src_path):
+        dirs[:] = sorted(x for x in dirs if x != '__pycache__')
+        for filename in sorted(filenames):
+            if _get_file_type(filename) is None:
+                continue
+            try:
+                _extract_train_model_name(filename)
+            except IOError:
+                continue
+            train_files.append(_fix_path(_os.path.relpath(_os.path.join(root, filename), src_path)))
+    return train_files
+
+def _print_table(headers, rows):
+    widths = [max([len(str(h))] + [len(str(r[i])) for r in rows]) for i, h in enumerate(headers)]
+    print('  '.join(str(h).ljust(w) for h, w in zip(headers, widths)).rstrip())
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(str(c).ljust(w) for c, w in zip(row, widths)).rstrip())
+
+def _training_jobs(project_root_dir, container_name, train_model_files = None, containers = None):
+    if train_model_files is None:
+        train_model_files = _discover_train_files(project_root_dir)
+    containers = containers or {}
+    jobs = []
+    for train_model_file in train_model_files:
+        jobs.append({
+            'model_name': _extract_train_model_name(train_model_file),
+            'train_model_file': train_model_file,
+            'container_name': containers.get(train_model_file, container_name),
+            'status': 'pending',
+            'seconds': None,
+            'timings': {},
+            'log_file': None,
+            'error': None
+        })
+    model_names = [x['model_name'] for x in jobs]
+    duplicates = sorted(set(x for x in model_names if model_names.count(x) > 1))
+    if len(duplicates) > 0:
+        raise ValueError("Several training scripts write the same model: " + ', '.join(duplicates))
+    return jobs
+
+def _run_training(project_root_dir, job, image_tag, **kwargs):
+    """Trains the model of a job from _training_jobs, recording its status, timings and error in the job"""
+    start = _time.time()
+    try:
+        result = _train_model(
+            project_root_dir, job['container_name'], job['train_model_file'], job['model_name'], image_tag, **kwargs)
+        job['status'] = 'cached' if result['cached'] else 'ok'
+        job['timings'].update(result['timings'])
+        job['log_file'] = result['log_file']
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    job['seconds'] = _time.time() - start
+
+def _print_training_summary(jobs, total):
+    _print_table(
+        ['model', 'script', 'container', 'status', 'seconds'],
+        [[x['model_name'], x['train_model_file'], x['container_name'], x['status'], '{:.1f}'.format(x['seconds'])]
+            for x in jobs])
+    print("{} of {} trainings succeeded in {:.1f}s".format(
+        len([x for x in jobs if x['status'] in ('ok', 'cached')]), len(jobs), total))
+    for job in jobs:
+        if job['error'] is not None:
+            print("{} failed: {}".format(job['train_model_file'], job['error']))
+
+def _image_builder(project_root_dir, executor, rebuild = False):
+    """Returns an async function building a container image in the executor.  Each container is built once,
+    callers asking for a container that is already being built wait for that build."""
+    loop = _asyncio.get_running_loop()
+    builds = {}
+    def build(container_name):
+        print("Building container {}...".format(container_name))
+        return _build_container(project_root_dir, container_name, rebuild = rebuild)
+    async def image_tag(container_name):
+        if container_name not in builds:
+            builds[container_name] = loop.run_in_executor(executor, _in_session(build), container_name)
+        return await builds[container_name]
+    return image_tag
 
-def _deploy_flask_model(project_root_dir, model_api_file, container):
+def train_many(project_root_dir, container_name, train_model_files = None, containers = None,
+    max_workers = _constants.DEFAULT_TRAIN_WORKERS, cpus = None, mem_limit = None, rebuild = False,
+    transfer = None, artifacts = None, force = False, stream_logs = False):
+    """Trains several models concurrently.  Each distinct container image is built once, then the
+    trainings run in parallel, each in its own container.
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The container that training scripts run in, unless overridden in containers
+        train_model_files: Training scripts relative to src, defaults to every script in src named like a
+            training script (for example train_iris_model.py)
+        containers: Optional dict of {train_model_file: container_name} overrides
+        max_workers: Maximum number of trainings running at once
+        cpus: Optional CPU limit per container, for example 1.5
+        mem_limit: Optional memory limit per container, for example "2g"
+        rebuild: Build the images even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the containers, defaults to the strategy in project.ini
+        artifacts: Optional list of glob patterns, only matching output files are copied back
+        force: Train models even if they are up to date
+        stream_logs: Print each script's output as it runs, prefixed with the model name, and keep a copy
+            in .harborml/logs
+
+    Returns:
+        A list of dicts with model_name, train_model_file, container_name, status (ok, cached or failed),
+        seconds, timings (seconds per phase), log_file and error for every training, in the order of
+        train_model_files
+    """
+    _check_project_dir(project_root_dir)
+    jobs = _training_jobs(project_root_dir, container_name, train_model_files, containers)
+
+    image_tags = {}
+    for name in sorted(set(x['container_name'] for x in jobs)):
+        print("Building container {}...".format(name))
+        image_tags[name] = _build_container(project_root_dir, name, rebuild = rebuild)
+
+    def run(job):
+        _run_training(project_root_dir, job, image_tags[job['container_name']], force = force, transfer = transfer,
+            artifacts = artifacts, cpus = cpus, mem_limit = mem_limit, stream_logs = stream_logs)
+
+    start = _time.time()
+    with _futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        list(executor.map(_in_session(run), jobs))
+    _print_training_summary(jobs, _time.time() - start)
+    return jobs
+
+async def train_models(project_root_dir, container_name, train_model_files = None, containers = None,
+    max_concurrency = _constants.DEFAULT_TRAIN_WORKERS, cpus = None, mem_limit = None, rebuild = False,
+    transfer = None, artifacts = None, force = False, stream_logs = False):
+    """Coroutine version of train_many.  Image builds overlap with each other and with the trainings of
+    containers that are already built, instead of all builds finishing first.  The blocking Docker calls run
+    in a thread pool, so other coroutines keep running.
+
+        results = asyncio.run(harborml.train_models('.', 'default'))
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The container that training scripts run in, unless overridden in containers
+        train_model_files: Training scripts relative to src, defaults to every training script in src
+        containers: Optional dict of {train_model_file: container_name} overrides
+        max_concurrency: Maximum number of builds and trainings running at once
+        cpus: Optional CPU limit per container, for example 1.5
+        mem_limit: Optional memory limit per container, for example "2g"
+        rebuild: Build the images even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the containers, defaults to the strategy in project.ini
+        artifacts: Optional list of glob patterns, only matching output files are copied back
+        force: Train models even if they are up to date
+        stream_logs: Print each script's output as it runs, prefixed with the model name
+
+    Returns:
+        The same list of dicts as train_many, with the wait for the image included in timings as build
+    """
+    _check_project_dir(project_root_dir)
+    jobs = _training_jobs(project_root_dir, container_name, train_model_files, containers)
+    loop = _asyncio.get_running_loop()
+
+    start = _time.time()
+    with _futures.ThreadPoolExecutor(max_workers = max_concurrency) as executor:
+        image_tag = _image_builder(project_root_dir, executor, rebuild = rebuild)
+        async def run(job):
+            build_start = _time.time()
+            try:
+                tag = await image_tag(job['container_name'])
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                job['seconds'] = _time.time() - build_start
+                return
+            build_seconds = _time.time() - build_start
+            await loop.run_in_executor(executor, _in_session(lambda: _run_training(
+                project_root_dir, job, tag, force = force, transfer = transfer, artifacts = artifacts,
+                cpus = cpus, mem_limit = mem_limit, stream_logs = stream_logs)))
+            # set after the run, whose own build timing only covers looking up the image it was given
+            job['timings']['build'] = build_seconds
+            job['seconds'] += build_seconds
+        await _asyncio.gather(*[run(x) for x in jobs])
+    _print_training_summary(jobs, _time.time() - start)
+    return jobs
+
+def _deploy_flask_model(project_root_dir, model_api_file, container, serving = None, deploy_version = None,
+    model_name = None):
     # create a temporary flask folder, and fill it up
+    # one folder per call, deploys of several models can run at the same time
     tmp_flask_root = _build_relative_path(
         _build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH),
-        'flask')
+        'flask-' + _random_file_name())
     dst_flask_root = _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, 'flask')
     _mkdir_p(tmp_flask_root)
-    _shutil.copy(
-        _pkg_resources.resource_filename('harborml', 'static/flask/app.py'),
-        tmp_flask_root)
-    _shutil.copy(
-        _pkg_resources.resource_filename('harborml', 'static/flask/loader.py'),
-        tmp_flask_root)
-    model_api_module = _os.path.splitext(model_api_file)[0]
-    with open(_build_relative_path(tmp_flask_root, 'loader.py'), 'a') as f:
-        f.write("import sys\n")
-        f.write("sys.path.append('{}')\n".format(
-            _build_relative_path(
-                _constants.DEFAULT_DIR_IN_CONTAINER, 
-                _constants.SOURCE_PATH)))
-        f.write("import {} as model\n".format(model_api_module))
-    # Copy the flask folder to the container
-    _copy_directory_to_container(
-        project_root_dir, 
-        tmp_flask_root, 
-        dst_flask_root,
-        container)
-    _shutil.rmtree(tmp_flask_root)
+    try:
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/flask/app.py'),
+            tmp_flask_root)
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/flask/loader.py'),
+            tmp_flask_root)
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/flask/microbatch.py'),
+            tmp_flask_root)
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/flask/codec.py'),
+            tmp_flask_root)
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/flask/cache.py'),
+            tmp_flask_root)
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/flask/artifacts.py'),
+            tmp_flask_root)
+        model_api_module = _os.path.splitext(model_api_file)[0]
+        with open(_build_relative_path(tmp_flask_root, 'loader.py'), 'a') as f:
+            f.write("import sys\n")
+            f.write("sys.path.append('{}')\n".format(
+                _build_relative_path(
+                    _constants.DEFAULT_DIR_IN_CONTAINER, 
+                    _constants.SOURCE_PATH)))
+            f.write("model = from_environment('{}')\n".format(model_api_module))
+        # Copy the flask folder to the container
+        _copy_directory_to_container(
+            project_root_dir, 
+            tmp_flask_root, 
+            dst_flask_root,
+            container)
+    finally:
+        _shutil.rmtree(tmp_flask_root, ignore_errors = True)
     # Run the flask app
-    cmd = _get_flask_deploy_command('flask/app.py')
+    cmd = _get_flask_deploy_command('flask/app.py', serving = serving, deploy_version = deploy_version,
+        model_name = model_name)
     return cmd
 
 def _deploy_plumber_model(project_root_dir, model_api_file, container):
     # create a temporary plumber folder, and fill it up
+    # one folder per call, deploys of several models can run at the same time
     tmp_plumber_root = _build_relative_path(
         _build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH),
-        'plumber')
+        'plumber-' + _random_file_name())
     dst_plumber_root = _build_relative_path(_constants.DEFAULT_DIR_IN_CONTAINER, 'plumber')
     _mkdir_p(tmp_plumber_root)
-    _shutil.copy(
-        _pkg_resources.resource_filename('harborml', 'static/plumber/plumber.R'),
-        tmp_plumber_root)
-    _shutil.copy(
-        _pkg_resources.resource_filename('harborml', 'static/plumber/loader.R'),
-        tmp_plumber_root)    
-    with open(_build_relative_path(tmp_plumber_root, 'loader.R'), 'a') as f:
-        # source the file
-        f.write("source('{}')\n".format(
-            _build_relative_path(
+    try:
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/plumber/plumber.R'),
+            tmp_plumber_root)
+        _shutil.copy(
+            _pkg_resources.resource_filename('harborml', 'static/plumber/loader.R'),
+            tmp_plumber_root)    
+        with open(_build_relative_path(tmp_plumber_root, 'loader.R'), 'a') as f:
+            # source the file
+            f.write("source('{}')\n".format(
                 _build_relative_path(
-                    _constants.DEFAULT_DIR_IN_CONTAINER, 
-                    _constants.SOURCE_PATH),
-                model_api_file)))
-
-    # Copy the plumber folder to the container
-    _copy_directory_to_container(
-        project_root_dir, 
-        tmp_plumber_root, 
-        dst_plumber_root,
-        container)
-    _shutil.rmtree(tmp_plumber_root)
+                    _build_relative_path(
+                        _constants.DEFAULT_DIR_IN_CONTAINER, 
+                        _constants.SOURCE_PATH),
+                    model_api_file)))
+
+        # Copy the plumber folder to the container
+        _copy_directory_to_container(
+            project_root_dir, 
+            tmp_plumber_root, 
+            dst_plumber_root,
+            container)
+    finally:
+        _shutil.rmtree(tmp_plumber_root, ignore_errors = True)
     # Run the plumber app
     cmd = _get_plumber_deploy_command('plumber/plumber.R')
     return cmd
@@ -398,198 +2005,1155 @@ def _deploy_reverse_proxy(project_root_dir):
     d_client = _docker_client()
     base_name = _get_docker_name(project_root_dir, '')
     new_name = "reverse_proxy-" + base_name
-    already_running = d_client.containers.list(all=True, filters={'name':new_name})
+    proxy_id = _load_registry(project_root_dir)['proxy']
+    if proxy_id is not None:
+        already_running = _get_containers([proxy_id])
+    else:
+        # not registered yet, look for a proxy started before the registry existed
+        already_running = [x for x in d_client.containers.list(all=True, filters={'name':new_name}) if x.name == new_name]
     if len(already_running) > 0:
         if already_running[0].status == 'running':
             print("Reverse proxy already running")
+            if proxy_id is None:
+                _update_registry(project_root_dir, lambda registry: registry.update(proxy = already_running[0].id))
             return already_running[0]
         else:
             already_running[0].remove()
 
+    # a missing proxy usually means containers were stopped outside of harborml, so check the registry
+    for model_name in _reconcile_deployments(project_root_dir):
+        print("Model {} is no longer running, removing it from the registry".format(model_name))
     print("Building reverse proxy container...")
     image_tag = _build_container(project_root_dir, _constants.DEFAULT_NGINX_NAME)
     print("Starting reverse proxy container...")
     rev_proxy = _start_container(image_tag, port_mappings = {5000:5000})
     d_client.api.rename(rev_proxy.id, new_name)
+    # the container runs the idle default command, nginx is started with the config baked into the image
+    # and daemonizes, so later config pushes have a master process to reload
+    _exec_and_wait(rev_proxy, ['nginx'])
+    _update_registry(project_root_dir, lambda registry: registry.update(proxy = rev_proxy.id))
     return rev_proxy
 
 def _get_current_deploy_version(project_root_dir, model_name):
+    """Latest version number used for a model, -1 if it was never deployed.  Read from the registry, Docker
+    is only scanned for models the registry has not seen, for example ones deployed before it existed."""
+    version = _load_registry(project_root_dir)['versions'].get(model_name)
+    if version is None:
+        version = _scan_deploy_version(project_root_dir, model_name)
+        if version >= 0:
+            _update_registry(project_root_dir, lambda registry: registry['versions'].setdefault(model_name, version))
+    return version
+
+def _scan_deploy_version(project_root_dir, model_name):
     d_client = _docker_client()
     base_name = _get_docker_name(project_root_dir, model_name)
-    deploy_container_names = [x.name for x in d_client.containers.list(all=True, filters = {'name':base_name})]
+    # the name filter matches substrings, so ignore other models that share the prefix
+    pattern = _re.compile('^' + _re.escape(base_name) + r'-(\d+)(?:-r\d+)?$')
     version = -1
-    for n in deploy_container_names:
-        potential_id = int(n.split("-")[-1])
-        if version < potential_id:
-            version = potential_id
+    for x in d_client.containers.list(all=True, filters = {'name':base_name}):
+        match = pattern.match(x.name)
+        if match is not None and version < int(match.group(1)):
+            version = int(match.group(1))
     return version
 
-def _copy_down_nginx_conf(project_root_dir, container):
-    src_path = _constants.NGINX_CONF_IN_CONTAINER_PATH
-    rng_file_name = _random_file_name()
-    dst_path = _build_relative_path(
-        _build_relative_path(project_root_dir, _constants.TMP_BUILD_PATH),
-        rng_file_name)
-        
-    _mkdir_p(dst_path)
-    with open(dst_path + '.tar', 'wb') as f:
-        bits, _ = container.get_archive(src_path)
-        for chunk in bits:
-            f.write(chunk)
-    
-    with _tarfile.open(dst_path + '.tar') as tf:
-        tf.extractall(dst_path)
-    _os.remove(dst_path + '.tar')
-    return dst_path
+def _replica_name(base_name, version, index):
+    # the first replica keeps the unsuffixed name, which also names the nginx upstream
+    if index == 0:
+        return "{}-{}".format(base_name, version)
+    return "{}-{}-r{}".format(base_name, version, index)
 
-def _copy_up_nginx_conf(project_root_dir, conf_dir, container):
-    _copy_directory_to_container(project_root_dir, conf_dir, 'tmp/conf/', container)
-    container.exec_run('cp {} {}'.format('tmp/conf/nginx.conf', _constants.NGINX_CONF_IN_CONTAINER_PATH), detach = True)
-    _time.sleep(.1)
+def _version_containers(project_root_dir, model_name, version):
+    d_client = _docker_client()
+    name = _get_docker_name(project_root_dir, model_name) + "-" + str(version)
+    pattern = _re.compile('^' + _re.escape(name) + r'(?:-r\d+)?$')
+    return [x for x in d_client.containers.list(all=True, filters = {'name':name}) if pattern.match(x.name)]
 
-def _edit_nginx_entry(project_root_dir, rev_proxy_container, model_name, hostname, ip_port, old_hostname = None):
-    conf_dir = _copy_down_nginx_conf(project_root_dir, rev_proxy_container)
-    try:
-        conf_file = _build_relative_path(conf_dir,'nginx.conf')
-        c = _nginx.loadf(conf_file)
-        http = c.filter('Http')[0]
-
-        endpoint_url = '/{}/'.format(model_name)
-        # check for existing upstream entry for item, edit as needed
-        if old_hostname is not None:
-            for ups in http.filter('Upstream'):
-                if ups.value == old_hostname:
-                    http.remove(ups)
-        # create new hostname entry
-        upstream = _nginx.Upstream(hostname)
-        upstream.add(_nginx.Key('server', ip_port))
-        http.add(
-            upstream
-        )
-        # check for existing location entry and remove if present
-        servers = http.filter('Server')
-        add2http = False
-        if len(servers) > 0:
-            server = servers[0]
-            for loc in server.filter('Location'):
-                if loc.value == endpoint_url:
-                    server.remove(loc)
-        else:
-            add2http = True
-            server = _nginx.Server()
-            server.add(_nginx.Key('listen', '5000'))
-        
-        location = _nginx.Location(endpoint_url)
+def _get_proxy_config(project_root_dir):
+    """Reverse proxy settings: the profile named in the [proxy] section of project.ini, with any of its
+    settings overridden in the same section"""
+    config = _get_project_config(project_root_dir)
+    profile = config.get('proxy', 'profile', fallback = _constants.DEFAULT_PROXY_PROFILE)
+    if profile not in _constants.PROXY_PROFILES:
+        raise ValueError("Unknown proxy profile {}, must be one of {}".format(
+            profile, ', '.join(sorted(_constants.PROXY_PROFILES))))
+    proxy = dict.fromkeys(_constants.PROXY_SETTINGS)
+    proxy.update(_constants.PROXY_PROFILES[profile])
+    if config.has_section('proxy'):
+        for key in _constants.PROXY_SETTINGS:
+            if key in config['proxy']:
+                proxy[key] = config.get('proxy', key)
+    proxy['upstream_keepalive'] = int(proxy['upstream_keepalive'])
+    return proxy
+
+def _set_nginx_key(block, name, value):
+    """Sets a directive in an nginx block, replacing it if present.  None leaves the block unchanged."""
+    if value is None:
+        return
+    existing = block.filter('Key', name)
+    if len(existing) > 0:
+        existing[0].value = value
+    else:
+        block.add(_nginx.Key(name, value))
+
+def _apply_proxy_profile(conf, proxy):
+    _set_nginx_key(conf, 'worker_processes', proxy['worker_processes'])
+    events = conf.filter('Events')
+    if len(events) == 0:
+        events = [_nginx.Events()]
+        conf.add(events[0])
+    _set_nginx_key(events[0], 'worker_connections', proxy['worker_connections'])
+    http = conf.filter('Http')[0]
+    for key in ['keepalive_requests', 'gzip', 'gzip_min_length', 'gzip_comp_level', 'gzip_types', 'gzip_proxied']:
+        _set_nginx_key(http, key, proxy[key])
+
+def _proxy_location_keys(proxy):
+    keys = []
+    for key in ['proxy_buffering', 'proxy_buffer_size', 'proxy_buffers', 'proxy_busy_buffers_size',
+        'proxy_connect_timeout', 'proxy_send_timeout', 'proxy_read_timeout']:
+        if proxy[key] is not None:
+            keys.append(_nginx.Key(key, proxy[key]))
+    return keys
+
+def _render_nginx_conf(project_root_dir, deployments):
+    """Builds the reverse proxy config from includes/nginx.conf, the proxy profile and the deployed models"""
+    template = _build_relative_path(_build_relative_path(project_root_dir, _constants.DOCKER_INCLUDES), 'nginx.conf')
+    if not _os.path.isfile(template):
+        template = _pkg_resources.resource_filename('harborml', 'static/nginx/nginx.conf')
+    proxy = _get_proxy_config(project_root_dir)
+    c = _nginx.loadf(template)
+    _apply_proxy_profile(c, proxy)
+    http = c.filter('Http')[0]
+    # combined is built into nginx, so it exists whatever the template defines
+    _set_nginx_key(http, 'access_log', _constants.NGINX_ACCESS_LOG_IN_CONTAINER_PATH + ' combined')
+    servers = http.filter('Server')
+    if len(servers) > 0:
+        server = servers[0]
+    else:
+        server = _nginx.Server()
+        server.add(_nginx.Key('listen', '5000'))
+
+    for model_name in sorted(deployments):
+        deployment = deployments[model_name]
+        # one upstream per model, with one server per replica
+        upstream = _nginx.Upstream(deployment['upstream'])
+        if deployment['balance'] != 'round_robin':
+            upstream.add(_nginx.Key(deployment['balance'], ''))
+        for replica in deployment['replicas']:
+            upstream.add(_nginx.Key('server', replica['address']))
+        if deployment['keepalive'] > 0:
+            upstream.add(_nginx.Key('keepalive', str(deployment['keepalive'])))
+        http.add(upstream)
+
+        location = _nginx.Location('/{}/'.format(model_name))
         location.add(
-            _nginx.Key('proxy_pass', 'http://{}/'.format(hostname)),
+            _nginx.Key('proxy_pass', 'http://{}/'.format(deployment['upstream'])),
             _nginx.Key('proxy_redirect', 'off'),
             _nginx.Key('proxy_set_header', 'Host $host'),
             _nginx.Key('proxy_set_header', 'X-Real-IP $remote_addr'),
             _nginx.Key('proxy_set_header', 'X-Forwarded-For $proxy_add_x_forwarded_for'),
             _nginx.Key('proxy_set_header', 'X-Forwarded-Host $server_name')
         )
-
+        if deployment['keepalive'] > 0:
+            # upstream connections are only reused with HTTP/1.1 and no Connection: close
+            location.add(
+                _nginx.Key('proxy_http_version', '1.1'),
+                _nginx.Key('proxy_set_header', 'Connection ""')
+            )
+        location.add(*_proxy_location_keys(proxy))
         server.add(location)
-        if add2http:
-            http.add(server)
-        _nginx.dumpf(c, conf_file)
-        _copy_up_nginx_conf(project_root_dir, conf_dir, rev_proxy_container)
-        # reload nginx on server
-        rev_proxy_container.exec_run('/usr/sbin/nginx', detach = True)
-        rev_proxy_container.exec_run('/usr/sbin/nginx -s reload', detach = True)
-    finally:
-        _shutil.rmtree(conf_dir, ignore_errors=True)
+    if len(servers) == 0:
+        http.add(server)
+    return _nginx.dumps(c)
 
-def deploy_model(project_root_dir, container_name, model_api_file, model_name = None, include_data = False):
-    if model_name is None:
-        model_name = _extract_deploy_model_name(model_api_file)
+def _push_nginx_conf(rev_proxy_container, conf_text):
+    """Uploads a config next to the live one in a single archive, checks it with nginx -t and only then
+    renames it over the live config and reloads nginx, or starts it if it is not running"""
+    data = conf_text.encode('utf-8')
+    buffer = _io.BytesIO()
+    with _tarfile.open(fileobj = buffer, mode = 'w') as tar:
+        info = _tarfile.TarInfo(_constants.NGINX_STAGED_CONF_NAME)
+        info.size = len(data)
+        info.mtime = _time.time()
+        tar.addfile(info, _io.BytesIO(data))
+    conf_dir = _os.path.dirname(_constants.NGINX_CONF_IN_CONTAINER_PATH)
+    staged = conf_dir + '/' + _constants.NGINX_STAGED_CONF_NAME
+    rev_proxy_container.put_archive(conf_dir, buffer.getvalue())
+    result = rev_proxy_container.exec_run(['sh', '-c', 'nginx -t -q -c {staged} && mv -f {staged} {live} && (nginx -s reload || nginx)'.format(
+        staged = staged, live = _constants.NGINX_CONF_IN_CONTAINER_PATH)])
+    if result.exit_code != 0:
+        rev_proxy_container.exec_run(['rm', '-f', staged])
+        raise RuntimeError("Reverse proxy rejected the new config, keeping the current one:\n" +
+            result.output.decode('utf-8', 'replace'))
+
+def _sync_reverse_proxy(project_root_dir, rev_proxy_container = None):
+    """Renders the proxy config for every model in the deployment registry, keeps a copy in the project and
+    pushes it to the reverse proxy, reloading nginx once"""
+    if rev_proxy_container is None:
+        rev_proxy_container = _deploy_reverse_proxy(project_root_dir)
+    conf_text = _render_nginx_conf(project_root_dir, _load_deployments(project_root_dir))
+    _push_nginx_conf(rev_proxy_container, conf_text)
+    local_conf = _build_relative_path(project_root_dir, _constants.NGINX_CONF_PATH)
+    _mkdir_p(_os.path.dirname(local_conf))
+    with open(local_conf, 'w') as f:
+        f.write(conf_text)
+
+def _get_rollout_config(project_root_dir, readiness_timeout = None, drain_seconds = None):
+    config = _get_project_config(project_root_dir)
+    if readiness_timeout is None:
+        readiness_timeout = config.getfloat('deploy', 'readiness_timeout', fallback = _constants.DEFAULT_READINESS_TIMEOUT)
+    if drain_seconds is None:
+        drain_seconds = config.getfloat('deploy', 'drain_seconds', fallback = _constants.DEFAULT_DRAIN_SECONDS)
+    return readiness_timeout, drain_seconds
+
+def _wait_until_ready(rev_proxy_container, ip_port, timeout):
+    """Polls the health route of a deployed container from inside the reverse proxy, which can always reach
+    it over the docker network, with exponential backoff.  Returns the number of probes made."""
+    url = 'http://{}{}'.format(ip_port, _constants.HEALTH_ROUTE)
+    deadline = _time.time() + timeout
+    delay = .1
+    probes = 0
+    while True:
+        probes += 1
+        result = rev_proxy_container.exec_run(['wget', '-q', '-O', '-', '-T', '2', url])
+        if result.exit_code == 0:
+            return probes
+        if _time.time() + delay > deadline:
+            raise TimeoutError("{} did not become ready within {}s".format(url, timeout))
+        _time.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+
+def _proxy_log_offset(rev_proxy_container):
+    """Current size of the reverse proxy access log, 0 if nginx has not written it yet"""
+    result = rev_proxy_container.exec_run(['sh', '-c', 'cat {} 2>/dev/null | wc -c'.format(
+        _constants.NGINX_ACCESS_LOG_IN_CONTAINER_PATH)])
+    try:
+        return int(result.output.strip())
+    except ValueError:
+        return 0
+
+def _count_proxy_errors(rev_proxy_container, model_name, offset):
+    """Counts 502/503/504 responses for a model in the reverse proxy access log, after its first offset bytes"""
+    result = rev_proxy_container.exec_run(['tail', '-c', '+{}'.format(offset + 1),
+        _constants.NGINX_ACCESS_LOG_IN_CONTAINER_PATH])
+    if result.exit_code != 0:
+        return 0
+    logs = result.output.decode('utf-8', 'replace')
+    pattern = _re.compile(r'"[A-Z]+ /{}/[^"]*" (50[234]) '.format(_re.escape(model_name)))
+    return len(pattern.findall(logs))
+
+def _record_rollout(project_root_dir, rollout):
+    history_file = _build_relative_path(project_root_dir, _constants.ROLLOUT_HISTORY_PATH)
+    history = _read_json_file(history_file, default = [])
+    history.append(rollout)
+    _write_json_file(history_file, history[-_constants.ROLLOUT_HISTORY_LENGTH:])
+
+def _get_balancing_config(project_root_dir, model_name, replicas = None, balance = None, keepalive = None):
+    """Replica count and nginx balancing for a model: the [deploy] section of project.ini, then a
+    [deploy.<model_name>] section, then the arguments"""
+    config = _get_project_config(project_root_dir)
+    settings = {
+        'replicas': _constants.DEFAULT_REPLICAS,
+        'balance': _constants.DEFAULT_BALANCE,
+        'keepalive': _get_proxy_config(project_root_dir)['upstream_keepalive']
+    }
+    for section in ['deploy', 'deploy.' + model_name]:
+        if not config.has_section(section):
+            continue
+        for key in ['replicas', 'keepalive']:
+            if key in config[section]:
+                settings[key] = config.getint(section, key)
+        if 'balance' in config[section]:
+            settings['balance'] = config.get(section, 'balance')
+    for key, value in [('replicas', replicas), ('balance', balance), ('keepalive', keepalive)]:
+        if value is not None:
+            settings[key] = value
+    if settings['replicas'] < 1:
+        raise ValueError("A model needs at least one replica")
+    if settings['balance'] not in _constants.BALANCE_METHODS:
+        raise ValueError("Unknown balancing method {}, must be one of {}".format(
+            settings['balance'], ', '.join(sorted(_constants.BALANCE_METHODS))))
+    return settings
+
+def _load_registry(project_root_dir):
+    """The deployment registry: models holds what each deployed model runs (version, image id, replica
+    names, container ids and addresses), versions the last version number used per model, including
+    undeployed ones so their container names are not reused, and proxy the reverse proxy container id"""
+    registry = _read_json_file(_build_relative_path(project_root_dir, _constants.DEPLOYMENTS_PATH))
+    registry.setdefault('models', {})
+    registry.setdefault('versions', {})
+    registry.setdefault('proxy', None)
+    return registry
+
+def _update_registry(project_root_dir, update):
+    with _file_lock(_build_relative_path(project_root_dir, _constants.DEPLOYMENTS_LOCK_PATH)):
+        registry = _load_registry(project_root_dir)
+        update(registry)
+        _write_json_file(_build_relative_path(project_root_dir, _constants.DEPLOYMENTS_PATH), registry)
+
+def _load_deployments(project_root_dir):
+    return _load_registry(project_root_dir)['models']
+
+def _update_deployment(project_root_dir, model_name, deployment):
+    def update(registry):
+        if deployment is None:
+            registry['models'].pop(model_name, None)
+        else:
+            registry['models'][model_name] = deployment
+            registry['versions'][model_name] = max(deployment['version'], registry['versions'].get(model_name, -1))
+    _update_registry(project_root_dir, update)
+
+def _reconcile_deployments(project_root_dir):
+    """Drops replicas whose containers are no longer running from the registry, and models left without
+    any.  Returns the names of the models that were dropped."""
+    running = set()
+    for deployment in _load_deployments(project_root_dir).values():
+        running.update(x.id for x in _get_containers([r['id'] for r in deployment['replicas']]) if x.status == 'running')
+    dropped = []
+    def update(registry):
+        for model_name in list(registry['models']):
+            deployment = registry['models'][model_name]
+            deployment['replicas'] = [x for x in deployment['replicas'] if x['id'] in running]
+            if len(deployment['replicas']) == 0:
+                del registry['models'][model_name]
+                dropped.append(model_name)
+    _update_registry(project_root_dir, update)
+    return dropped
+
+def _get_containers(container_ids):
+    """Looks containers up by id, skipping ones that no longer exist"""
     d_client = _docker_client()
-    _check_project_dir(project_root_dir)
-    print("Building container...")
-    image_tag = _build_container(project_root_dir, container_name)
+    containers = []
+    for container_id in container_ids:
+        try:
+            containers.append(d_client.containers.get(container_id))
+        except _docker.errors.NotFound:
+            pass
+    return containers
+
+def _launch_replica(project_root_dir, image_tag, name, deployment):
+    """Starts one container of a deployment and its API server, without waiting for it to be ready"""
+    d_client = _docker_client()
+    volumes = None
+    # registered before the artifact store existed
+    artifact_version = deployment.get('artifact_version')
+    if deployment['transfer'] == 'mount':
+        volumes = _project_volumes(project_root_dir, include_data = deployment['include_data'],
+            include_model = deployment['model_name'])
+    elif artifact_version is not None:
+        volumes = {_artifact_volume_name(project_root_dir): {'bind': _constants.ARTIFACT_BLOBS_IN_CONTAINER, 'mode': 'rw'}}
+    container = _start_container(image_tag, hostname = name, volumes = volumes)
+    d_client.api.rename(container.id, name)
+    try:
+        if deployment['transfer'] != 'mount':
+            print("Copying project to container {}...".format(name))
+            _copy_project_to_container(project_root_dir, container, include_data = deployment['include_data'],
+                include_model = deployment['model_name'] if artifact_version is None else None,
+                transfer = deployment['transfer'])
+            # deployed containers are never reused, so their sync manifest is not needed
+            _remove_container_manifest(project_root_dir, container.id)
+            if artifact_version is not None:
+                _copy_artifacts_to_container(project_root_dir, container,
+                    _load_artifact_manifest(project_root_dir, deployment['model_name'], artifact_version))
+
+        model_api_file = deployment['model_api_file']
+        file_type = _get_file_type(model_api_file)
+        if file_type == 'python':
+            cmd = _deploy_flask_model(project_root_dir, model_api_file, container,
+                serving = deployment['serving'], deploy_version = deployment['version'],
+                model_name = deployment['model_name'])
+        elif file_type == 'r':
+            cmd = _deploy_plumber_model(project_root_dir, model_api_file, container)
+        else:
+            raise NotImplementedError("No deployment option available for file {}".format(model_api_file))
+
+        print("Running command in container: " + cmd)
+        container.exec_run(cmd, detach = True)
+    except:
+        _stop_container(container)
+        raise
+    return container
+
+def _wait_for_replica(rev_proxy_container, container, timeout):
+    """Waits for a replica's health route, returning its address and the number of probes made"""
+    ip_port = _docker_client().api.inspect_container(container.id)['NetworkSettings']['IPAddress'] + ':5000'
+    try:
+        probes = _wait_until_ready(rev_proxy_container, ip_port, timeout)
+    except TimeoutError as e:
+        raise RuntimeError("{}.  Container log:\n{}".format(e, _tail_container_log(container)))
+    return ip_port, probes
+
+def _start_replicas(project_root_dir, image_tag, names, deployment, rev_proxy_container, readiness_timeout):
+    """Launches containers for the given names and waits until all of them are ready.  If one fails, all of
+    them are removed.  Returns the containers, their addresses and the total number of probes."""
+    containers = []
+    try:
+        for name in names:
+            containers.append(_launch_replica(project_root_dir, image_tag, name, deployment))
+        ip_ports = []
+        probes = 0
+        for container in containers:
+            ip_port, n = _wait_for_replica(rev_proxy_container, container, readiness_timeout)
+            ip_ports.append(ip_port)
+            probes += n
+    except:
+        print("Replica failed to start, removing new containers...")
+        for container in containers:
+            _stop_container(container)
+        raise
+    return containers, ip_ports, probes
+
+def _tail_container_log(container, lines = 20):
+    result = container.exec_run(['sh', '-c', 'tail -n {} "{}/{}/log.log"'.format(
+        lines, _constants.DEFAULT_DIR_IN_CONTAINER, _constants.OUTPUT_PATH)])
+    return result.output.decode('utf-8', 'replace')
+
+def _get_deploy_artifact_version(project_root_dir, model_name, transfer, artifact_version = None):
+    """The artifact store version a deploy ships, or None to copy model/<model_name> as it is.  With the store
+    enabled, the current model output is stored first, which returns the latest version if it is unchanged."""
+    if artifact_version is not None:
+        if transfer == 'mount':
+            raise ValueError("Artifact versions can not be deployed with the mount transfer strategy")
+        if _load_artifact_manifest(project_root_dir, model_name, artifact_version) is None:
+            raise ValueError("Model {} has no artifact version {}".format(model_name, artifact_version))
+        return artifact_version
+    model_dir = _build_relative_path(_build_relative_path(project_root_dir, _constants.MODEL_PATH), model_name)
+    if transfer == 'mount' or not _get_artifacts_config(project_root_dir)['enabled'] or not _os.path.isdir(model_dir):
+        return None
+    return _store_artifacts(project_root_dir, model_name)['version']
+
+def _stage_deployment(project_root_dir, container_name, model_api_file, model_name, include_data = False,
+    rebuild = False, transfer = None, serving = None, readiness_timeout = None, drain_seconds = None,
+    replicas = None, balance = None, keepalive = None, artifact_version = None, image_tag = None):
+    """Starts and health-checks the replicas of a new version and records it in the deployment registry,
+    without switching the reverse proxy.  Returns the pending rollout for _complete_rollouts."""
+    readiness_timeout, drain_seconds = _get_rollout_config(project_root_dir, readiness_timeout, drain_seconds)
+    balancing = _get_balancing_config(project_root_dir, model_name, replicas, balance, keepalive)
+    transfer = _get_transfer_strategy(project_root_dir, transfer)
+    artifact_version = _get_deploy_artifact_version(project_root_dir, model_name, transfer, artifact_version)
+    rollout_start = _time.time()
+    if image_tag is None:
+        print("Building container...")
+        image_tag = _build_container(project_root_dir, container_name, rebuild = rebuild)
     print("Starting container...")
     old_version = _get_current_deploy_version(project_root_dir, model_name)
-    print("Deployment version {}".format(old_version + 1))
+    version = old_version + 1
+    print("Deployment version {}".format(version))
     base_name = _get_docker_name(project_root_dir, model_name)
-    new_name = base_name + "-" + str(old_version + 1)
-    old_name = base_name + "-" + str(old_version)
-    container = _start_container(image_tag, hostname = new_name)
-    d_client.api.rename(container.id, new_name)
-    print("Copying project to container...")
-    _copy_project_to_container(project_root_dir, container, include_data = include_data, include_model = model_name)
-    
-    file_type = _get_file_type(model_api_file)
-    if file_type == 'python':
-        cmd = _deploy_flask_model(project_root_dir, model_api_file, container)
-    elif file_type == 'r':
-        cmd = _deploy_plumber_model(project_root_dir, model_api_file, container)
+    names = [_replica_name(base_name, version, i) for i in range(balancing['replicas'])]
+    deployment = {
+        'model_name': model_name,
+        'model_api_file': model_api_file,
+        'version': version,
+        'image': _docker_client().images.get(image_tag).id,
+        'include_data': include_data,
+        'transfer': transfer,
+        'artifact_version': artifact_version,
+        'serving': _get_serving_config(project_root_dir, model_name, serving),
+        'upstream': names[0],
+        'balance': balancing['balance'],
+        'keepalive': balancing['keepalive']
+    }
+
+    rev_proxy = _deploy_reverse_proxy(project_root_dir)
+    print("Waiting for version {} to become ready...".format(version))
+    ready_start = _time.time()
+    containers, ip_ports, probes = _start_replicas(
+        project_root_dir, deployment['image'], names, deployment, rev_proxy, readiness_timeout)
+    deployment['replicas'] = [{'name': n, 'id': c.id, 'address': a} for n, c, a in zip(names, containers, ip_ports)]
+    previous = _load_deployments(project_root_dir).get(model_name)
+    if previous is not None:
+        old_containers = _get_containers([x['id'] for x in previous['replicas']])
+    elif old_version >= 0:
+        # deployed before the registry existed
+        old_containers = [x for x in _version_containers(project_root_dir, model_name, old_version) if x.status == 'running']
     else:
-        raise NotImplementedError("No deployment option available for file {}".format(model_api_file))
+        old_containers = []
+    stop_timeout = _get_stop_timeout(previous)
+    _update_deployment(project_root_dir, model_name, deployment)
+    return {
+        'rollout': {
+            'model_name': model_name,
+            'version': version,
+            'replicas': len(containers),
+            'started': rollout_start,
+            'ready_seconds': _time.time() - ready_start,
+            'readiness_probes': probes
+        },
+        'previous': previous,
+        'containers': containers,
+        'old_containers': old_containers,
+        'stop_timeout': stop_timeout,
+        'drain_seconds': drain_seconds
+    }
 
-    print("Running command in container: " + cmd)
-    container.exec_run(cmd, detach = True)
+def _get_stop_timeout(deployment):
+    """Seconds the replicas of a registered deployment get to finish their in-flight requests when stopped,
+    the default for deployments from before the registry"""
+    serving = dict(_constants.DEFAULT_SERVING, **((deployment or {}).get('serving') or {}))
+    return serving['graceful_timeout']
 
+def _complete_rollouts(project_root_dir, pending):
+    """Switches the reverse proxy to the staged versions with a single reload, then drains and stops the
+    versions they replace.  If the proxy rejects the config, the staged versions are removed."""
     rev_proxy = _deploy_reverse_proxy(project_root_dir)
-    api_ip_address = d_client.api.inspect_container(container.id)['NetworkSettings']['IPAddress']
-    _edit_nginx_entry(project_root_dir, rev_proxy, model_name, new_name, api_ip_address + ':5000', old_hostname=old_name)
-    #TODO: add test for making sure new endpoint is up?
-    # Kill old container
-    old_container = d_client.containers.list(all=True, filters={'name':old_name})
-    if len(old_container) > 0:
-        old_container[0].stop(timeout = 0)
-    return container
+    log_offset = _proxy_log_offset(rev_proxy)
+    try:
+        _sync_reverse_proxy(project_root_dir, rev_proxy)
+    except:
+        print("Switching the reverse proxy failed, removing the new versions...")
+        for item in pending:
+            _update_deployment(project_root_dir, item['rollout']['model_name'], item['previous'])
+            for container in item['containers']:
+                _stop_container(container)
+        raise
+    # let the previous versions finish the requests nginx already sent them, then stop them
+    draining = [x for x in pending if len(x['old_containers']) > 0]
+    if len(draining) > 0:
+        drain_seconds = max(x['drain_seconds'] for x in draining)
+        print("Draining previous version(s) for {}s...".format(drain_seconds))
+        _time.sleep(drain_seconds)
+        for item in draining:
+            for old_container in item['old_containers']:
+                _stop_container(old_container, item['stop_timeout'])
+    for item in pending:
+        rollout = item['rollout']
+        rollout['rollout_seconds'] = _time.time() - rollout['started']
+        rollout['dropped_requests'] = _count_proxy_errors(rev_proxy, rollout['model_name'], log_offset)
+        _record_rollout(project_root_dir, rollout)
+        print("Rolled out {} version {} in {:.1f}s (ready after {:.1f}s, {} dropped request(s))".format(
+            rollout['model_name'], rollout['version'], rollout['rollout_seconds'], rollout['ready_seconds'],
+            rollout['dropped_requests']))
 
-def undeploy_single_model(project_root_dir, model_name):
-    d_client = _docker_client()
+def deploy_model(project_root_dir, container_name, model_api_file, model_name = None, include_data = False,
+    rebuild = False, transfer = None, serving = None, readiness_timeout = None, drain_seconds = None,
+    replicas = None, balance = None, keepalive = None, artifact_version = None):
+    """Deploys a model behind the project's reverse proxy.  Traffic is only switched to the new version once
+    its health route answers, and the previous version is given time to finish in-flight requests before
+    it is stopped.
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The name of the container
+        model_api_file: Deploy script in src, with an api_predict function
+        model_name: Name of the model, taken from the file name by default
+        include_data: Copy the data directory into the container
+        rebuild: Build the image even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the container, defaults to the strategy in project.ini
+        serving: Optional dict overriding the serving settings in project.ini
+        readiness_timeout: Seconds to wait for the new version to become ready, defaults to the [deploy] settings
+        drain_seconds: Seconds the previous version keeps running after the switch, defaults to the [deploy] settings
+        replicas: Number of identical containers behind the model's endpoint, defaults to the [deploy] settings
+        balance: nginx balancing method across replicas, one of round_robin, least_conn, ip_hash or random
+        keepalive: Idle connections nginx keeps open to the replicas, 0 to open one per request, defaults to the
+            proxy profile
+        artifact_version: Deploy this version from the artifact store instead of the current model output
+
+    Returns:
+        The container of the first replica
+    """
+    if model_name is None:
+        model_name = _extract_deploy_model_name(model_api_file)
     _check_project_dir(project_root_dir)
-    old_version = _get_current_deploy_version(project_root_dir, model_name)
-    if old_version == -1:
-        print(f"No currently running endpoint for model {model_name}")
+    pending = _stage_deployment(project_root_dir, container_name, model_api_file, model_name,
+        include_data = include_data, rebuild = rebuild, transfer = transfer, serving = serving,
+        readiness_timeout = readiness_timeout, drain_seconds = drain_seconds, replicas = replicas,
+        balance = balance, keepalive = keepalive, artifact_version = artifact_version)
+    _complete_rollouts(project_root_dir, [pending])
+    return pending['containers'][0]
+
+_DEPLOY_MODELS_OPTIONS = set(['model_api_file', 'container_name', 'model_name', 'include_data', 'serving',
+    'readiness_timeout', 'drain_seconds', 'replicas', 'balance', 'keepalive', 'artifact_version'])
+
+async def deploy_models(project_root_dir, container_name, models, max_concurrency = _constants.DEFAULT_TRAIN_WORKERS,
+    rebuild = False, transfer = None):
+    """Coroutine deploying several models behind the reverse proxy at once.  Image builds, project uploads and
+    container starts of different models overlap, and the proxy is switched to all new versions with a single
+    reload once every model is ready or has failed.  A model that fails to start leaves its previous version
+    serving and does not hold back the others.
+
+        results = asyncio.run(harborml.deploy_models('.', 'default', ['deploy_iris_model.py', 'deploy_wine_model.py']))
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The container models are deployed in, unless overridden per model
+        models: List of deploy scripts in src, or of dicts with a model_api_file key and optionally any of
+            container_name, model_name, include_data, serving, readiness_timeout, drain_seconds, replicas,
+            balance, keepalive and artifact_version, with the same meaning as for deploy_model
+        max_concurrency: Maximum number of builds and deployments running at once
+        rebuild: Build the images even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the containers, defaults to the strategy in project.ini
+
+    Returns:
+        A list of dicts with model_name, model_api_file, container_name, status (ok or failed), version, seconds,
+        timings (build, stage and switch seconds) and error for every model, in the order of models
+    """
+    _check_project_dir(project_root_dir)
+    jobs = []
+    for model in models:
+        options = {'model_api_file': model} if isinstance(model, str) else dict(model)
+        unknown = set(options) - _DEPLOY_MODELS_OPTIONS
+        if len(unknown) > 0:
+            raise ValueError("Unknown deploy option(s): " + ', '.join(sorted(unknown)))
+        if 'model_api_file' not in options:
+            raise ValueError("Every model needs a model_api_file")
+        options.setdefault('container_name', container_name)
+        options.setdefault('model_name', _extract_deploy_model_name(options['model_api_file']))
+        jobs.append({
+            'options': options,
+            'result': {
+                'model_name': options['model_name'],
+                'model_api_file': options['model_api_file'],
+                'container_name': options['container_name'],
+                'status': 'pending',
+                'version': None,
+                'seconds': None,
+                'timings': {},
+                'error': None
+            }
+        })
+    model_names = [x['result']['model_name'] for x in jobs]
+    duplicates = sorted(set(x for x in model_names if model_names.count(x) > 1))
+    if len(duplicates) > 0:
+        raise ValueError("Several entries deploy the same model: " + ', '.join(duplicates))
+    loop = _asyncio.get_running_loop()
+
+    start = _time.time()
+    with _futures.ThreadPoolExecutor(max_workers = max_concurrency) as executor:
+        image_tag = _image_builder(project_root_dir, executor, rebuild = rebuild)
+        # started once up front, so the deployments do not each start their own
+        rev_proxy = loop.run_in_executor(executor, _in_session(_deploy_reverse_proxy), project_root_dir)
+
+        async def stage(job):
+            options = dict(job['options'])
+            container, model_api_file, model_name = [options.pop(x) for x in ('container_name', 'model_api_file', 'model_name')]
+            result = job['result']
+            phase_start = _time.time()
+            try:
+                tag = await image_tag(container)
+                await rev_proxy
+                result['timings']['build'] = _time.time() - phase_start
+                phase_start = _time.time()
+                job['pending'] = await loop.run_in_executor(executor, _in_session(lambda: _stage_deployment(
+                    project_root_dir, container, model_api_file, model_name, transfer = transfer,
+                    image_tag = tag, **options)))
+                result['timings']['stage'] = _time.time() - phase_start
+                result['version'] = job['pending']['rollout']['version']
+            except Exception as e:
+                result['status'] = 'failed'
+                result['error'] = str(e)
+        await _asyncio.gather(*[stage(x) for x in jobs])
+
+        staged = [x for x in jobs if 'pending' in x]
+        if len(staged) > 0:
+            switch_start = _time.time()
+            try:
+                await loop.run_in_executor(
+                    executor, _in_session(_complete_rollouts), project_root_dir, [x['pending'] for x in staged])
+                status, error = 'ok', None
+            except Exception as e:
+                status, error = 'failed', "Switching the reverse proxy failed: {}".format(e)
+            for job in staged:
+                job['result']['timings']['switch'] = _time.time() - switch_start
+                job['result']['status'] = status
+                job['result']['error'] = error
+    total = _time.time() - start
+
+    results = [x['result'] for x in jobs]
+    for result in results:
+        result['seconds'] = sum(result['timings'].values())
+    _print_table(
+        ['model', 'script', 'container', 'status', 'version', 'seconds'],
+        [[x['model_name'], x['model_api_file'], x['container_name'], x['status'],
+            '' if x['version'] is None else x['version'], '{:.1f}'.format(x['seconds'])] for x in results])
+    print("{} of {} deployments succeeded in {:.1f}s".format(
+        len([x for x in results if x['status'] == 'ok']), len(results), total))
+    for result in results:
+        if result['error'] is not None:
+            print("{} failed: {}".format(result['model_api_file'], result['error']))
+    return results
+
+def scale_model(project_root_dir, model_name, replicas, readiness_timeout = None, drain_seconds = None):
+    """Changes the number of replicas of a deployed model without redeploying it.  New replicas are started
+    from the image of the running version and added to the upstream once ready, removed replicas are taken
+    out of the upstream and stopped after the drain period.
+
+    Args:
+        project_root_dir: The root directory of the project
+        model_name: Name of the deployed model
+        replicas: Number of replicas to run
+        readiness_timeout: Seconds to wait for new replicas to become ready, defaults to the [deploy] settings
+        drain_seconds: Seconds removed replicas keep running after the switch, defaults to the [deploy] settings
+    """
+    _check_project_dir(project_root_dir)
+    if replicas < 1:
+        raise ValueError("A model needs at least one replica, use undeploy-model to remove it")
+    deployment = _load_deployments(project_root_dir).get(model_name)
+    if deployment is None:
+        raise ValueError("Model {} is not deployed".format(model_name))
+    readiness_timeout, drain_seconds = _get_rollout_config(project_root_dir, readiness_timeout, drain_seconds)
+    current = deployment['replicas']
+    if replicas == len(current):
+        print("{} already has {} replica(s)".format(model_name, replicas))
         return
-    print("Undeploying {} version {}".format(model_name, old_version))
+    rev_proxy = _deploy_reverse_proxy(project_root_dir)
     base_name = _get_docker_name(project_root_dir, model_name)
-    old_name = base_name + "-" + str(old_version)
-    old_container = d_client.containers.list(all=True, filters={'name':old_name})
-    if len(old_container) == 0:
+    previous = dict(deployment)
+    started = []
+    removed = []
+    if replicas > len(current):
+        # number after the highest replica so far, names of stopped replicas are not reused
+        next_index = 1 + max(
+            int(x['name'].rsplit('-r', 1)[1]) if x['name'] != deployment['upstream'] else 0 for x in current)
+        names = [_replica_name(base_name, deployment['version'], next_index + i) for i in range(replicas - len(current))]
+        print("Starting {} replica(s) of {}...".format(len(names), model_name))
+        started, ip_ports, _ = _start_replicas(
+            project_root_dir, deployment['image'], names, deployment, rev_proxy, readiness_timeout)
+        deployment['replicas'] = current + [{'name': n, 'id': c.id, 'address': a} for n, c, a in zip(names, started, ip_ports)]
+    else:
+        deployment['replicas'], removed = current[:replicas], current[replicas:]
+    _update_deployment(project_root_dir, model_name, deployment)
+    try:
+        _sync_reverse_proxy(project_root_dir, rev_proxy)
+    except:
+        _update_deployment(project_root_dir, model_name, previous)
+        for container in started:
+            _stop_container(container)
+        raise
+    if len(removed) > 0:
+        print("Draining {} replica(s) for {}s...".format(len(removed), drain_seconds))
+        _time.sleep(drain_seconds)
+        for container in _get_containers([x['id'] for x in removed]):
+            _stop_container(container, _get_stop_timeout(deployment))
+    print("{} now has {} replica(s)".format(model_name, replicas))
+
+def rollout_history(project_root_dir, model_name = None):
+    """Returns recorded rollouts, oldest first, with their duration, readiness wait and the number of requests
+    the reverse proxy failed (502/503/504) for the model from the traffic switch until the old version stopped
+
+    Args:
+        project_root_dir: The root directory of the project
+        model_name: Optional model to filter on
+    """
+    _check_project_dir(project_root_dir)
+    history = _read_json_file(_build_relative_path(project_root_dir, _constants.ROLLOUT_HISTORY_PATH), default = [])
+    return [x for x in history if model_name is None or x['model_name'] == model_name]
+
+def list_deployments(project_root_dir, reconcile = False):
+    """Returns the deployed models from the deployment registry, as a dict of
+    {model_name: {version, image, replicas: [{name, id, address}], ...}}
+
+    Args:
+        project_root_dir: The root directory of the project
+        reconcile: Check the replicas against Docker first and drop the ones that are no longer running
+    """
+    _check_project_dir(project_root_dir)
+    if reconcile:
+        _reconcile_deployments(project_root_dir)
+    return _load_deployments(project_root_dir)
+
+def undeploy_single_model(project_root_dir, model_name):
+    """Removes a model's endpoint from the reverse proxy and stops its containers
+
+    Args:
+        project_root_dir: The root directory of the project
+        model_name: Name of the model
+    """
+    _check_project_dir(project_root_dir)
+    deployment = _load_deployments(project_root_dir).get(model_name)
+    if deployment is not None:
+        containers = _get_containers([x['id'] for x in deployment['replicas']])
+        version = deployment['version']
+    else:
+        # deployed before the registry existed
+        version = _get_current_deploy_version(project_root_dir, model_name)
+        containers = [x for x in _version_containers(project_root_dir, model_name, version) if x.status == 'running']
+    if len(containers) == 0 and deployment is None:
         print(f"No currently running endpoint for model {model_name}")
         return
-    old_container.stop(timeout = 0)
+    print("Undeploying {} version {}".format(model_name, version))
+    _update_deployment(project_root_dir, model_name, None)
+    proxy_id = _load_registry(project_root_dir)['proxy']
+    rev_proxy = _get_containers([proxy_id]) if proxy_id is not None else []
+    if len(rev_proxy) > 0 and rev_proxy[0].status == 'running':
+        _sync_reverse_proxy(project_root_dir, rev_proxy[0])
+    stop_timeout = _get_stop_timeout(deployment)
+    for container in containers:
+        _stop_container(container, stop_timeout)
 
 def undeploy_all(project_root_dir):
-    d_client = _docker_client()
-    base_name = _get_docker_name(project_root_dir, '')
-    # base_name will be deploy-PROJECTID
-    already_running = d_client.containers.list(filters={'name':base_name})
+    registry = _load_registry(project_root_dir)
     print("Undeploying all models in project")
+    if len(registry['models']) > 0 or registry['proxy'] is not None:
+        container_ids = [x['id'] for d in registry['models'].values() for x in d['replicas']]
+        if registry['proxy'] is not None:
+            container_ids.append(registry['proxy'])
+        already_running = _get_containers(container_ids)
+    else:
+        # nothing registered, fall back to finding the project's containers by name
+        d_client = _docker_client()
+        base_name = _get_docker_name(project_root_dir, '')
+        # base_name will be deploy-PROJECTID
+        already_running = d_client.containers.list(filters={'name':base_name})
+    # replicas of the same model share its graceful timeout, the proxy has no model server and stops right away
+    stop_timeouts = {x['id']: _get_stop_timeout(d) for d in registry['models'].values() for x in d['replicas']}
     for con in already_running:
-        con.stop(timeout=0)
+        _stop_container(con, stop_timeouts.get(con.id, _constants.DEFAULT_SERVING['graceful_timeout']))
+    def clear(registry):
+        registry['models'] = {}
+        registry['proxy'] = None
+    _update_registry(project_root_dir, clear)
 
-def refresh_data(project_root_dir, container_name, data_refresh_file, dataset_name = None, stop_container = True):
+def refresh_data(project_root_dir, container_name, data_refresh_file, dataset_name = None, stop_container = True,
+    rebuild = False, transfer = None, artifacts = None, stream_logs = False, timings = False):
+    """Runs a data refresh script in a container and copies the output to data/<dataset_name>
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The name of the container
+        data_refresh_file: Refresh script, relative to src
+        dataset_name: Name of the dataset, taken from the file name by default
+        stop_container: Stop the container when the script is done, otherwise it is returned
+        rebuild: Build the image even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the container, defaults to the strategy in project.ini
+        artifacts: Optional list of glob patterns, only matching output files are copied back
+        stream_logs: Print the script's output as it runs, and keep a copy in .harborml/logs
+        timings: Return the run result instead of the container
+
+    Returns:
+        The container if stop_container is False, otherwise None.  With timings, a dict with the seconds spent
+        in each phase (timings: build, start, copy_in, run, copy_out, stop), the total seconds, target_dir,
+        log_file when streaming, and the container if stop_container is False.
+    """
     if dataset_name is None:
         dataset_name = _extract_refresh_data_name(data_refresh_file)
 
     _check_project_dir(project_root_dir)
-    print("Building container...")
-    image_tag = _build_container(project_root_dir, container_name)
-    print("Starting container...")
-    container = _start_container(image_tag)
-    try:
-        print("Copying project to container...")
-        _copy_project_to_container(project_root_dir, container)
-        cmd = _get_refresh_data_command(data_refresh_file)
-        print("Running command in container: " + cmd)
-        result = container.exec_run(cmd)
-        if result.exit_code != 0:
-            raise RuntimeError("Error while running container command: " + str(result.output))
-        print("Copying output back to project")
-        
-        output_dir = _copy_output_to_project(project_root_dir, container, _build_relative_path(_constants.DATA_PATH, dataset_name))
-        print("Run output written to " + output_dir)
-    finally:
-        if stop_container and container != None:
-            print("Stopping container...")
-            container.stop(timeout = 0)
-        if not stop_container and container != None:
-            print("Container still running")
-            return container
+    result = _run_job(
+        project_root_dir, container_name, data_refresh_file,
+        _build_relative_path(_constants.DATA_PATH, dataset_name),
+        stop_container = stop_container, rebuild = rebuild, transfer = transfer, artifacts = artifacts,
+        stream_logs = stream_logs)
+    return result if timings else result['container']
+
+def warm_pool(project_root_dir, container_name, size = None, rebuild = False):
+    """Starts idle containers for a container image so that later train and refresh runs can lease them
+    instead of starting a new container
+
+    Args:
+        project_root_dir: The root directory of the project
+        container_name: The name of the container
+        size: Number of idle containers to keep, defaults to the pool size in project.ini
+        rebuild: Build the image even if the build cache has an image for the current dockerfile and includes
+
+    Returns:
+        The number of containers started
+    """
+    _check_project_dir(project_root_dir)
+    if size is None:
+        size, _ = _get_pool_config(project_root_dir)
+    image_tag = _build_container(project_root_dir, container_name, rebuild = rebuild)
+    client = _docker_client()
+    image_id = client.images.get(image_tag).id
+    with _pool_lock(project_root_dir):
+        state = _load_pool_state(project_root_dir)
+        _, ttl = _get_pool_config(project_root_dir)
+        _evict_pooled_containers(project_root_dir, state, ttl, client, image_tag, image_id)
+        idle = len([x for x in state['containers'].values()
+            if x['state'] == 'idle' and x['image_tag'] == image_tag])
+        _save_pool_state(project_root_dir, state)
+    started = 0
+    for _ in range(size - idle):
+        start = _time.time()
+        container = _start_container(image_tag, labels = _pool_labels(project_root_dir))
+        startup = _time.time() - start
+        with _pool_lock(project_root_dir):
+            state = _load_pool_state(project_root_dir)
+            state['stats']['startups'] += 1
+            state['stats']['startup_total'] += startup
+            state['stats']['startup_max'] = max(state['stats']['startup_max'], startup)
+            state['containers'][container.id] = {
+                'image_tag': image_tag,
+                'image_id': image_id,
+                'state': 'idle',
+                'since': _time.time()
+            }
+            _save_pool_state(project_root_dir, state)
+        started += 1
+    return started
+
+def drain_pool(project_root_dir, expired_only = False):
+    """Stops and removes idle pooled containers
+
+    Args:
+        project_root_dir: The root directory of the project
+        expired_only: Only remove containers that have been idle for longer than the pool ttl
+
+    Returns:
+        The number of containers removed
+    """
+    _check_project_dir(project_root_dir)
+    client = _docker_client()
+    _, ttl = _get_pool_config(project_root_dir)
+    with _pool_lock(project_root_dir):
+        state = _load_pool_state(project_root_dir)
+        before = len(state['containers'])
+        _evict_pooled_containers(project_root_dir, state, ttl if expired_only else 0, client)
+        _save_pool_state(project_root_dir, state)
+    return before - len(state['containers'])
+
+def pool_stats(project_root_dir):
+    """Returns container pool statistics, used for sizing the pool
+
+    Args:
+        project_root_dir: The root directory of the project
+
+    Returns:
+        A dict with lease and startup counters and timings, and the number of idle and leased containers
+    """
+    _check_project_dir(project_root_dir)
+    state = _load_pool_state(project_root_dir)
+    stats = dict(state['stats'])
+    stats['idle'] = len([x for x in state['containers'].values() if x['state'] == 'idle'])
+    stats['leased'] = len([x for x in state['containers'].values() if x['state'] == 'leased'])
+    stats['lease_wait_mean'] = stats['lease_wait_total'] / stats['leases'] if stats['leases'] else 0.0
+    stats['startup_mean'] = stats['startup_total'] / stats['startups'] if stats['startups'] else 0.0
+    return stats
+
+def _load_pipeline(project_root_dir, pipeline_file = None):
+    if pipeline_file is None:
+        pipeline_file = _build_relative_path(project_root_dir, _constants.PIPELINE_PATH)
+    if not _os.path.isfile(pipeline_file):
+        raise FileNotFoundError("Pipeline file not found: {}".format(pipeline_file))
+    config = _configparser.ConfigParser()
+    config.read(pipeline_file)
+    stages = {}
+    for name in config.sections():
+        section = config[name]
+        stage_type = section.get('type')
+        if stage_type not in _constants.PIPELINE_STAGE_TYPES:
+            raise ValueError("Stage {} has invalid type {}, must be one of {}".format(
+                name, stage_type, ', '.join(sorted(_constants.PIPELINE_STAGE_TYPES))))
+        if 'file' not in section or 'container' not in section:
+            raise ValueError("Stage {} must set file and container".format(name))
+        stage_file = section['file']
+        target_name = section.get('name')
+        if target_name is None:
+            target_name = {
+                'refresh': _extract_refresh_data_name,
+                'train': _extract_train_model_name,
+                'deploy': _extract_deploy_model_name
+            }[stage_type](stage_file)
+        stages[name] = {
+            'type': stage_type,
+            'file': stage_file,
+            'container': section['container'],
+            'name': target_name,
+            'depends': [x.strip() for x in section.get('depends', '').replace(',', ' ').split()],
+            'include_data': section.getboolean('include_data', fallback = False),
+            'always': section.getboolean('always', fallback = False)
+        }
+    for name, stage in stages.items():
+        for dep in stage['depends']:
+            if dep not in stages:
+                raise ValueError("Stage {} depends on unknown stage {}".format(name, dep))
+    # reject cycles
+    visited = {}
+    def visit(name):
+        if visited.get(name) == 'active':
+            raise ValueError("Pipeline has a dependency cycle through stage " + name)
+        if visited.get(name) == 'done':
+            return
+        visited[name] = 'active'
+        for dep in stages[name]['depends']:
+            visit(dep)
+        visited[name] = 'done'
+    for name in stages:
+        visit(name)
+    return stages
+
+def _hash_project_scopes(project_root_dir, scopes, exclude = None):
+    files = _scan_project_files(project_root_dir, scopes)
+    hasher = _hashlib.sha256()
+    for rel_path in sorted(files):
+        if exclude is not None and (rel_path == exclude or rel_path.startswith(exclude + '/')):
+            continue
+        hasher.update(rel_path.encode('utf-8') + b'\0' + files[rel_path]['hash'].encode('utf-8') + b'\0')
+    return hasher.hexdigest()
+
+def _container_digest(project_root_dir, container_name):
+    container_path = _check_and_format_file(
+        project_root_dir, _constants.DOCKER_PATH + '/' + container_name + _constants.DOCKERFILE_EXTENSION)
+    return _hash_build_context(container_path, _build_relative_path(project_root_dir, _constants.DOCKER_INCLUDES))
+
+def _stage_fingerprint(project_root_dir, stage):
+    """Hash of everything a stage reads: its source file, its input data and its container definition.
+    A stage's own output directory is left out, so running a stage does not invalidate it."""
+    hasher = _hashlib.sha256()
+    hasher.update(_json.dumps(
+        [stage['type'], stage['file'], stage['container'], stage['name'], stage['include_data']]).encode('utf-8'))
+    hasher.update(_container_digest(project_root_dir, stage['container']).encode('utf-8'))
+    _hash_file(_check_and_format_file(project_root_dir, _constants.SOURCE_PATH + '/' + stage['file']), hasher)
+    if stage['type'] == 'refresh':
+        inputs = _hash_project_scopes(project_root_dir, [_constants.DATA_PATH],
+            exclude = _build_relative_path(_constants.DATA_PATH, stage['name']))
+    elif stage['type'] == 'train':
+        inputs = _hash_project_scopes(project_root_dir, [_constants.DATA_PATH])
+    else:
+        inputs = _hash_project_scopes(project_root_dir, _project_scopes(stage['include_data'], stage['name'])[1:])
+    hasher.update(inputs.encode('utf-8'))
+    return hasher.hexdigest()
+
+def _is_model_deployed(project_root_dir, model_name):
+    deployment = _load_deployments(project_root_dir).get(model_name)
+    if deployment is None:
+        return False
+    return any(x.status == 'running' for x in _get_containers([x['id'] for x in deployment['replicas']]))
+
+def _pipeline_stage_order(stages, selected = None):
+    if selected is None:
+        return set(stages)
+    wanted = set()
+    def add(name):
+        if name not in stages:
+            raise ValueError("Unknown pipeline stage " + name)
+        if name in wanted:
+            return
+        wanted.add(name)
+        for dep in stages[name]['depends']:
+            add(dep)
+    for name in selected:
+        add(name)
+    return wanted
+
+def run_pipeline(project_root_dir, pipeline_file = None, stages = None, max_workers = _constants.DEFAULT_TRAIN_WORKERS,
+    force = False, rebuild = False, transfer = None):
+    """Runs the refresh, train and deploy stages declared in pipeline.ini, in dependency order.
+
+    Each section of pipeline.ini is a stage:
+
+        [train_iris]
+        type = train                # refresh, train or deploy
+        file = train_iris_model.py  # script in src
+        container = default
+        depends = refresh_iris      # optional, stages that must finish first
+        name = iris_model           # optional dataset/model name, taken from the file name by default
+        include_data = no           # optional, deploy stages only
+        always = no                 # optional, run even if the inputs are unchanged
+
+    Stages whose dependencies are done run in parallel.  A stage is skipped if its source file, input
+    data and container definition are unchanged since its last successful run.  Deploy stages start their
+    new versions one at a time, and the reverse proxy is switched to all of them with a single reload once
+    the other stages are done.
+
+    Args:
+        project_root_dir: The root directory of the project
+        pipeline_file: Path to the pipeline spec, defaults to pipeline.ini in the project
+        stages: Optional list of stages to run, along with the stages they depend on.  Defaults to all
+        max_workers: Maximum number of stages running at once
+        force: Run every stage even if its inputs are unchanged
+        rebuild: Build the images even if the build cache has an image for the current dockerfile and includes
+        transfer: How the project is transferred to the containers, defaults to the strategy in project.ini
+
+    Returns:
+        A dict of {stage: {status, seconds, error}}, where status is ok, skipped, failed or blocked
+    """
+    _check_project_dir(project_root_dir)
+    pipeline = _load_pipeline(project_root_dir, pipeline_file)
+    wanted = _pipeline_stage_order(pipeline, stages)
+    state_file = _build_relative_path(project_root_dir, _constants.PIPELINE_STATE_PATH)
+    state_lock = _threading.Lock()
+    deploy_lock = _threading.Lock()
+    rollouts = []
+    results = {name: {'status': 'pending', 'seconds': None, 'error': None} for name in wanted}
+
+    image_tags = {}
+    for name in sorted(set(pipeline[x]['container'] for x in wanted)):
+        print("Building container {}...".format(name))
+        image_tags[name] = _build_container(project_root_dir, name, rebuild = rebuild)
+
+    def run(name):
+        stage = pipeline[name]
+        # hashing the inputs can take a while, only the state file is shared between stages
+        fingerprint = _stage_fingerprint(project_root_dir, stage)
+        with state_lock:
+            previous = _read_json_file(state_file).get(name)
+        if not force and not stage['always'] and previous == fingerprint:
+            if stage['type'] != 'deploy' or _is_model_deployed(project_root_dir, stage['name']):
+                print("Stage {} is up to date, skipping".format(name))
+                return 'skipped'
+        if stage['type'] == 'deploy':
+            with deploy_lock:
+                pending = _stage_deployment(project_root_dir, stage['container'], stage['file'], stage['name'],
+                    include_data = stage['include_data'], transfer = transfer,
+                    image_tag = image_tags[stage['container']])
+                # the stage is recorded once the proxy has been switched
+                rollouts.append((name, fingerprint, pending))
+            return 'ok'
+        elif stage['type'] == 'train':
+            _train_model(project_root_dir, stage['container'], stage['file'], stage['name'],
+                image_tags[stage['container']], force = True, transfer = transfer)
+        else:
+            _run_job(project_root_dir, stage['container'], stage['file'],
+                _build_relative_path(_constants.DATA_PATH, stage['name']),
+                transfer = transfer, image_tag = image_tags[stage['container']])
+        with state_lock:
+            state = _read_json_file(state_file)
+            state[name] = fingerprint
+            _write_json_file(state_file, state)
+        return 'ok'
+
+    def timed(name):
+        start = _time.time()
+        try:
+            return run(name)
+        finally:
+            results[name]['seconds'] = _time.time() - start
+
+    start = _time.time()
+    pending = set(wanted)
+    running = {}
+    with _futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for name in sorted(pending):
+                dep_status = [results[x]['status'] for x in pipeline[name]['depends']]
+                if any(x in ('failed', 'blocked') for x in dep_status):
+                    results[name]['status'] = 'blocked'
+                    pending.remove(name)
+                elif all(x in ('ok', 'skipped') for x in dep_status):
+                    print("Starting stage " + name)
+                    results[name]['status'] = 'running'
+                    running[executor.submit(_in_session(timed), name)] = name
+                    pending.remove(name)
+            if len(running) == 0:
+                continue
+            done, _ = _futures.wait(running, return_when = _futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name]['status'] = future.result()
+                except Exception as e:
+                    results[name]['status'] = 'failed'
+                    results[name]['error'] = str(e)
+    if len(rollouts) > 0:
+        try:
+            _complete_rollouts(project_root_dir, [x[2] for x in rollouts])
+            state = _read_json_file(state_file)
+            for name, fingerprint, _ in rollouts:
+                state[name] = fingerprint
+            _write_json_file(state_file, state)
+        except Exception as e:
+            for name, _, _ in rollouts:
+                results[name]['status'] = 'failed'
+                results[name]['error'] = str(e)
+    total = _time.time() - start
 
+    order = [x for x in pipeline if x in wanted]
+    _print_table(
+        ['stage', 'type', 'status', 'seconds'],
+        [[x, pipeline[x]['type'], results[x]['status'],
+            '' if results[x]['seconds'] is None else '{:.1f}'.format(results[x]['seconds'])] for x in order])
+    print("Pipeline finished in {:.1f}s".format(total))
+    for name in order:
+        if results[name]['error'] is not None:
+            print("{} failed: {}".format(name, results[name]['error']))
+    return results
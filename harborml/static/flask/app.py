@@ -1,12 +1,84 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, abort, jsonify, request
 app = Flask(__name__)
 
-from loader import model #pylint: disable=no-name-in-module
-import json
+from loader import LazyModel, model #pylint: disable=no-name-in-module
+import cache
+import codec
+import os
+import microbatch
+
+batcher = microbatch.from_environment(model)
+response_cache = cache.from_environment()
+
+def _cached(route, data, score):
+    if response_cache is None:
+        return codec.encode(score(data), request)
+    key = response_cache.key(route, request.headers.get('Accept', ''), data)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return Response(cached[0], mimetype = cached[1])
+    response = codec.encode(score(data), request)
+    response_cache.put(key, (response.get_data(), response.mimetype))
+    return response
+
+def _rss_bytes():
+    # resident memory of this worker, memory-mapped model files only count for the pages it touched
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _columns_to_rows(data):
+    # columns keep the order of the body, so each row lists its values in that order
+    columns = list(data.values())
+    if not all(isinstance(x, list) for x in columns) or len(set(len(x) for x in columns)) > 1:
+        abort(400, 'Columns must be lists of the same length')
+    return [list(values) for values in zip(*columns)]
+
+def _score(data):
+    if batcher is not None:
+        return batcher.predict(data)
+    return model.api_predict(data)
+
+def _score_batch(data):
+    rows = _columns_to_rows(data) if isinstance(data, dict) else data
+    if hasattr(model, 'api_predict_batch'):
+        return model.api_predict_batch(rows)
+    return [model.api_predict(row) for row in rows]
 
 @app.route('/', methods = ['POST'])
 def predict():
-    return jsonify(model.api_predict(request.get_json(force=True)))
+    return _cached('/', codec.decode(request), _score)
+
+@app.route('/batch', methods = ['POST'])
+def predict_batch():
+    """Scores many rows in one request.  The body is either a list of rows, or a dict of
+    {column: [values]} that is turned into rows of values in column order.  The rows are passed to
+    api_predict_batch if the deploy module defines it, otherwise api_predict is called once per row."""
+    return _cached('/batch', codec.decode(request), _score_batch)
+
+@app.route('/health', methods = ['GET'])
+def health():
+    # a lazily loaded model that is still warming up in this worker is not ready for traffic
+    if isinstance(model, LazyModel) and not model.ready():
+        return Response('loading', status = 503)
+    return 'ok'
+
+@app.route('/stats', methods = ['GET'])
+def stats():
+    """Statistics of the worker process that handles the request"""
+    result = {'pid': os.getpid(), 'rss': _rss_bytes()}
+    if isinstance(model, LazyModel):
+        result['model_loaded'] = model.loaded()
+    if batcher is not None:
+        result['microbatch'] = batcher.stats()
+    if response_cache is not None:
+        result['cache'] = response_cache.stats()
+    return jsonify(result)
 
 @app.route('/debug', methods = ['GET'])
 def debug():
@@ -23,4 +95,4 @@ def debug():
 
 @app.route('/debug', methods = ['POST'])
 def debug_post():
-    return jsonify(model.api_predict(json.loads(request.form['jsondata'])))
+    return codec.encode(model.api_predict(codec.loads_json(request.form['jsondata'])), request)
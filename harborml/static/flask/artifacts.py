@@ -0,0 +1,62 @@
+"""Loads files the training script wrote to model/<model_name>, for use in deploy scripts:
+
+    import artifacts
+    mdl = artifacts.load('iris.joblib')
+
+With HARBORML_MMAP set, NumPy arrays are memory-mapped read-only instead of read into memory, so every
+worker process in the container shares one copy of them through the page cache.  Arrays inside a joblib
+file can only be mapped if it was saved uncompressed, for example joblib.dump(mdl, 'output/iris.joblib').
+
+    .npy               numpy.load
+    .npz               numpy.load, arrays are read when they are accessed, never mapped
+    .joblib            joblib.load, needs joblib installed in the container
+    anything else      pickle.load
+"""
+import os
+import pickle
+import threading
+
+try:
+    import joblib
+except ImportError:
+    joblib = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_loaded = {}
+_lock = threading.Lock()
+
+def mmap_enabled():
+    return os.environ.get('HARBORML_MMAP', '0').lower() in ('1', 'true', 'yes')
+
+def model_dir():
+    """model/<model_name> of the deployed model, or the current directory when not deployed by harborml"""
+    return os.environ.get('HARBORML_MODEL_DIR', '.')
+
+def _load(path, mmap_mode):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.npy', '.npz'):
+        if numpy is None:
+            raise ImportError("numpy is needed to load " + path)
+        return numpy.load(path, mmap_mode = mmap_mode if extension == '.npy' else None)
+    if extension == '.joblib':
+        if joblib is None:
+            raise ImportError("joblib is needed to load " + path)
+        return joblib.load(path, mmap_mode = mmap_mode)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load(file_name, mmap = None):
+    """Loads a file from the model directory once per process, later calls return the same object.
+
+    mmap overrides HARBORML_MMAP for this file."""
+    path = file_name if os.path.isabs(file_name) else os.path.join(model_dir(), file_name)
+    mmap_mode = 'r' if (mmap_enabled() if mmap is None else mmap) else None
+    key = (path, mmap_mode)
+    with _lock:
+        if key not in _loaded:
+            _loaded[key] = _load(path, mmap_mode)
+        return _loaded[key]
@@ -0,0 +1,79 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+def canonical_key(route, accept, data, version):
+    """Hash of a decoded request payload.  JSON and msgpack payloads are re-serialized with sorted keys,
+    so equal payloads hash the same regardless of key order or whitespace."""
+    hasher = hashlib.sha256()
+    hasher.update('{}\0{}\0{}\0'.format(version, route, accept).encode('utf-8'))
+    if hasattr(data, 'tobytes') and hasattr(data, 'shape'):
+        hasher.update('{}\0{}\0'.format(data.dtype.str, data.shape).encode('utf-8'))
+        hasher.update(data.tobytes())
+    else:
+        hasher.update(json.dumps(data, sort_keys = True, separators = (',', ':'), default = str).encode('utf-8'))
+    return hasher.hexdigest()
+
+class ResponseCache(object):
+    """Bounded LRU cache of encoded responses, with entries expiring ttl seconds after they were stored"""
+    def __init__(self, max_size = 1024, ttl = 300, version = ''):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, route, accept, data):
+        return canonical_key(route, accept, data, self.version)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self.version,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+def from_environment():
+    """Creates a ResponseCache if HARBORML_CACHE is set.  Keys include HARBORML_DEPLOY_VERSION, so results
+    are never shared between deployed versions of a model."""
+    if os.environ.get('HARBORML_CACHE', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    return ResponseCache(
+        max_size = int(os.environ.get('HARBORML_CACHE_SIZE', '1024')),
+        ttl = float(os.environ.get('HARBORML_CACHE_TTL', '300')),
+        version = os.environ.get('HARBORML_DEPLOY_VERSION', ''))
@@ -0,0 +1,108 @@
+"""Request and response encodings for the scoring app, selected by Content-Type and Accept.
+
+    application/json                 default, parsed with orjson when it is installed
+    application/msgpack              needs msgpack installed in the container
+    application/x-float32-array      raw numeric array, decoded straight into a NumPy array:
+                                     uint32 ndim, ndim uint32 dimensions, then the float32 values,
+                                     all little-endian
+
+A float32 array body can be built on the client with:
+
+    body = struct.pack('<I', arr.ndim) + struct.pack('<{}I'.format(arr.ndim), *arr.shape) + arr.astype('<f4').tobytes()
+"""
+import json
+import struct
+
+from flask import Response, abort
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = set([MSGPACK, 'application/x-msgpack'])
+FLOAT32 = 'application/x-float32-array'
+
+def _to_builtin(value):
+    # numpy arrays and scalars
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError("Type is not serializable: {}".format(type(value)))
+
+def loads_json(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+def dumps_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default = _to_builtin, option = orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, default = _to_builtin)
+
+def _media_type(header):
+    return (header or '').split(';')[0].strip().lower()
+
+def decode_float32(body):
+    if numpy is None:
+        abort(415, 'numpy is not installed')
+    if len(body) < 4:
+        abort(400, 'Missing array header')
+    ndim = struct.unpack_from('<I', body, 0)[0]
+    offset = 4 + 4 * ndim
+    if len(body) < offset:
+        abort(400, 'Truncated array header')
+    shape = struct.unpack_from('<{}I'.format(ndim), body, 4)
+    expected = 4
+    for dim in shape:
+        expected *= dim
+    if len(body) - offset != expected:
+        abort(400, 'Array data does not match shape {}'.format(shape))
+    return numpy.frombuffer(body, dtype = '<f4', offset = offset).reshape(shape)
+
+def encode_float32(value):
+    arr = numpy.ascontiguousarray(value, dtype = '<f4')
+    return struct.pack('<I', arr.ndim) + struct.pack('<{}I'.format(arr.ndim), *arr.shape) + arr.tobytes()
+
+def decode(request):
+    """Decodes the request body based on its Content-Type.  Anything that is not a known binary type is
+    parsed as JSON."""
+    media_type = _media_type(request.headers.get('Content-Type'))
+    body = request.get_data(cache = False)
+    if media_type in MSGPACK_TYPES:
+        if msgpack is None:
+            abort(415, 'msgpack is not installed')
+        return msgpack.unpackb(body, raw = False)
+    if media_type == FLOAT32:
+        return decode_float32(body)
+    try:
+        return loads_json(body)
+    except ValueError:
+        abort(400, 'Request body is not valid JSON')
+
+def encode(value, request):
+    """Encodes a result in the type named by the Accept header.  A msgpack request gets a msgpack response
+    unless it asks otherwise, everything else defaults to JSON."""
+    accept = _media_type(request.headers.get('Accept'))
+    if accept in ('', '*/*') and _media_type(request.headers.get('Content-Type')) in MSGPACK_TYPES:
+        accept = MSGPACK
+    if accept in MSGPACK_TYPES and msgpack is not None:
+        return Response(msgpack.packb(value, default = _to_builtin, use_bin_type = True), mimetype = MSGPACK)
+    if accept == FLOAT32 and numpy is not None:
+        try:
+            return Response(encode_float32(value), mimetype = FLOAT32)
+        except (TypeError, ValueError):
+            # not numeric, fall back to JSON
+            pass
+    return Response(dumps_json(value), mimetype = JSON)
@@ -0,0 +1,72 @@
+import importlib
+import os
+import threading
+import traceback
+
+def _flag(name):
+    return os.environ.get(name, '0').lower() in ('1', 'true', 'yes')
+
+def _import_model(module_name, warmup):
+    module = importlib.import_module(module_name)
+    if warmup and hasattr(module, 'api_warmup'):
+        module.api_warmup()
+    return module
+
+class LazyModel(object):
+    """Stands in for the deploy module and imports it on first use, so the server starts without loading the
+    model and each worker process loads its own after it was forked.
+
+    With warmup, every worker starts importing the module in the background as soon as it starts, then calls
+    the module's api_warmup function if it has one, and ready() stays False until that has finished."""
+    def __init__(self, module_name, warmup = False):
+        self._module_name = module_name
+        self._warmup = warmup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = _import_model(self._module_name, self._warmup)
+        return self._module
+
+    def _start_warmup(self):
+        def run():
+            try:
+                self._load()
+            except Exception:
+                # the next request tries again and gets the error
+                traceback.print_exc()
+        thread = threading.Thread(target = run, name = 'warmup')
+        thread.daemon = True
+        thread.start()
+
+    def _after_fork(self):
+        # a thread that held the lock in the parent does not exist in the child
+        self._lock = threading.Lock()
+        if self._warmup and self._module is None:
+            self._start_warmup()
+
+    def loaded(self):
+        return self._module is not None
+
+    def ready(self):
+        return not self._warmup or self.loaded()
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+def from_environment(module_name):
+    """Imports the deploy module, or returns a LazyModel for it if HARBORML_LOAD is lazy"""
+    warmup = _flag('HARBORML_WARMUP')
+    if os.environ.get('HARBORML_LOAD', 'eager') != 'lazy':
+        return _import_model(module_name, warmup)
+    model = LazyModel(module_name, warmup = warmup)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child = model._after_fork)
+    # a preloading gunicorn master forks the workers after importing the app, they start their own warmup
+    if warmup and not _flag('HARBORML_PRELOAD'):
+        model._start_warmup()
+    return model
+
@@ -0,0 +1,137 @@
+import os
+import queue
+import threading
+import time
+
+# bucket upper bounds, the last bucket counts everything above
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+QUEUE_WAIT_MS_BUCKETS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def to_dict(self):
+        with self._lock:
+            labels = [str(x) for x in self.buckets] + ['+Inf']
+            return {
+                'buckets': [{'le': le, 'count': n} for le, n in zip(labels, self.counts)],
+                'count': self.count,
+                'sum': self.sum
+            }
+
+class _Request(object):
+    def __init__(self, data):
+        self.data = data
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher(object):
+    """Collects concurrent single-row requests into batches.  A batch is scored once max_batch_size
+    requests are queued, or max_wait_ms after the first one was taken off the queue, whichever is first.
+
+    predict_batch takes a list of request payloads and returns a list of results in the same order.
+    The worker thread is started on first use, so that it is created in each forked gunicorn worker
+    rather than in the preloading master."""
+    def __init__(self, predict_batch, max_batch_size = 32, max_wait_ms = 5):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_MS_BUCKETS)
+        self._queue = queue.Queue()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            thread = threading.Thread(target = self._run, name = 'microbatch')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def predict(self, data):
+        self._ensure_started()
+        req = _Request(data)
+        self._queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout = remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            now = time.time()
+            for req in batch:
+                self.queue_wait_ms.observe((now - req.queued) * 1000.0)
+            self.batch_size.observe(len(batch))
+            try:
+                results = self.predict_batch([x.data for x in batch])
+                if hasattr(results, 'tolist'):
+                    results = results.tolist()
+                if len(results) != len(batch):
+                    raise RuntimeError("Batch prediction returned {} results for {} requests".format(
+                        len(results), len(batch)))
+                for req, result in zip(batch, results):
+                    req.result = result
+            except Exception as e:
+                for req in batch:
+                    req.error = e
+            for req in batch:
+                req.done.set()
+
+    def stats(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'batch_size': self.batch_size.to_dict(),
+            'queue_wait_ms': self.queue_wait_ms.to_dict()
+        }
+
+def from_environment(model):
+    """Creates a MicroBatcher if HARBORML_MICROBATCH is set, using api_predict_batch from the deploy module,
+    or a loop over api_predict if it has none"""
+    if os.environ.get('HARBORML_MICROBATCH', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    def predict_batch(rows):
+        # looked up per batch, a lazily loaded model is only imported on first use
+        if hasattr(model, 'api_predict_batch'):
+            return model.api_predict_batch(rows)
+        return [model.api_predict(x) for x in rows]
+    return MicroBatcher(
+        predict_batch,
+        max_batch_size = int(os.environ.get('HARBORML_MAX_BATCH_SIZE', '32')),
+        max_wait_ms = float(os.environ.get('HARBORML_MAX_WAIT_MS', '5')))
@@ -0,0 +1,82 @@
+import io
+import os
+import sys
+import tarfile
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import pytest
+from harborml import core
+
+def _archive(members):
+    """A tar archive of (name, data) members, data None for a directory or ('symlink', target) for a link,
+    in 100 byte chunks like a get_archive stream"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj = buffer, mode = 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif isinstance(data, tuple):
+                info.type = tarfile.SYMTYPE
+                info.linkname = data[1]
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    data = buffer.getvalue()
+    return (data[i:i + 100] for i in range(0, len(data), 100))
+
+def test_member_paths():
+    assert core._archive_member_path('output/model/iris.pkl') == 'model/iris.pkl'
+    assert core._archive_member_path('./output//iris.pkl') == 'iris.pkl'
+    assert core._archive_member_path('output\\iris.pkl') == 'iris.pkl'
+    assert core._archive_member_path('output') is None
+    assert core._archive_member_path('iris.pkl', strip_root = False) == 'iris.pkl'
+
+def test_parent_member_is_rejected():
+    for name in ['../iris.pkl', 'output/../../iris.pkl', 'output/model/../../../iris.pkl']:
+        with pytest.raises(RuntimeError):
+            core._archive_member_path(name)
+    with pytest.raises(RuntimeError):
+        core._archive_member_path('..', strip_root = False)
+
+def test_absolute_member_stays_inside_target():
+    assert core._archive_member_path('/etc/passwd') == 'passwd'
+    assert core._archive_member_path('/etc/passwd', strip_root = False) == 'etc/passwd'
+
+def test_extract_stream(tmp_path):
+    dst = str(tmp_path / 'model')
+    os.makedirs(dst)
+    extracted = core._extract_archive_stream(_archive([
+        ('output', None),
+        ('output/iris.pkl', b'x' * 1000),
+        ('output/sub', None),
+        ('output/sub/notes.txt', b'notes'),
+        ('output/latest.pkl', ('symlink', 'iris.pkl'))
+    ]), dst)
+    assert extracted == ['iris.pkl', 'sub/notes.txt', 'latest.pkl']
+    with open(os.path.join(dst, 'iris.pkl'), 'rb') as f:
+        assert f.read() == b'x' * 1000
+    with open(os.path.join(dst, 'latest.pkl'), 'rb') as f:
+        assert f.read() == b'x' * 1000
+
+def test_extract_stream_rejects_traversal(tmp_path):
+    dst = str(tmp_path / 'model')
+    os.makedirs(dst)
+    with pytest.raises(RuntimeError):
+        core._extract_archive_stream(_archive([('output', None), ('output/../../escaped', b'x')]), dst)
+    assert not os.path.exists(str(tmp_path / 'escaped'))
+    core._extract_archive_stream(_archive([('/output/abs', b'x')]), dst)
+    assert os.path.isfile(os.path.join(dst, 'abs'))
+
+def test_extract_stream_rejects_links_out_of_target(tmp_path):
+    dst = str(tmp_path / 'model')
+    os.makedirs(dst)
+    for target in ['/etc', '../..', 'sub/../../outside']:
+        with pytest.raises(RuntimeError):
+            core._extract_archive_stream(_archive([
+                ('output/link', ('symlink', target)),
+                ('output/link/passwd', b'x')
+            ]), dst)
+    assert os.listdir(dst) == []
@@ -0,0 +1,137 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import harborml
+from harborml import constants
+from harborml import core
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _blobs(project_dir):
+    blob_dir = os.path.join(project_dir, constants.ARTIFACTS_PATH, 'blobs')
+    return [name for _, _, names in os.walk(blob_dir) for name in names]
+
+def test_unchanged_chunks_are_stored_once(tmp_path):
+    project_dir = str(tmp_path)
+    harborml.start_project(project_dir)
+    model = os.urandom(constants.ARTIFACT_CHUNK_SIZE + 100)
+    _write(os.path.join(project_dir, 'model/iris_model/iris.pkl'), model)
+    assert harborml.store_artifacts(project_dir, 'iris_model') == 1
+    assert len(_blobs(project_dir)) == 2
+    # nothing changed, so no new version
+    assert harborml.store_artifacts(project_dir, 'iris_model') == 1
+    # only the last chunk changes
+    _write(os.path.join(project_dir, 'model/iris_model/iris.pkl'), model[:-1] + b'x')
+    assert harborml.store_artifacts(project_dir, 'iris_model') == 2
+    assert len(_blobs(project_dir)) == 3
+    harborml.restore_artifacts(project_dir, 'iris_model', 1)
+    with open(os.path.join(project_dir, 'model/iris_model/iris.pkl'), 'rb') as f:
+        assert f.read() == model
+
+def test_gc_keeps_last_versions(tmp_path):
+    project_dir = str(tmp_path)
+    harborml.start_project(project_dir)
+    for i in range(4):
+        _write(os.path.join(project_dir, 'model/iris_model/iris.pkl'), str(i).encode('utf-8'))
+        harborml.store_artifacts(project_dir, 'iris_model')
+    removed = harborml.gc_artifacts(project_dir, keep = 2)
+    assert removed['versions'] == 2
+    assert [x['version'] for x in harborml.list_artifacts(project_dir, 'iris_model')] == [3, 4]
+    assert len(_blobs(project_dir)) == 2
+
+class FakeDeployContainer(object):
+    """A deploy container whose commands run locally, with the artifact volume and project directory mapped
+    into root"""
+    def __init__(self, root):
+        self.id = 'deploy'
+        self.paths = [(constants.ARTIFACT_BLOBS_IN_CONTAINER, os.path.join(root, 'volume')),
+            (constants.DEFAULT_DIR_IN_CONTAINER, os.path.join(root, 'app'))]
+
+    def _local(self, arg):
+        for path, local in self.paths:
+            arg = arg.replace(path, local)
+        return arg
+
+    def exec_run(self, cmd, **kwargs):
+        import subprocess
+        run = subprocess.run([self._local(x) for x in cmd], stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        output = run.stdout
+        for path, local in self.paths:
+            output = output.replace(local.encode('utf-8'), path.encode('utf-8'))
+        return core._docker.models.containers.ExecResult(run.returncode, output)
+
+    def put_archive(self, path, data):
+        import io
+        import tarfile
+        with tarfile.open(fileobj = io.BytesIO(b''.join(data))) as tar:
+            tar.extractall(self._local(path))
+        return True
+
+class FakeAPI(object):
+    def __init__(self, container):
+        self.container = container
+        self.execs = {}
+
+    def exec_create(self, container_id, cmd):
+        exec_id = 'exec{}'.format(len(self.execs))
+        self.execs[exec_id] = cmd
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, detach = False):
+        self.execs[exec_id] = self.container.exec_run(self.execs[exec_id]).exit_code
+
+    def exec_inspect(self, exec_id):
+        return {'Running': False, 'ExitCode': self.execs[exec_id]}
+
+class FakeClient(object):
+    def __init__(self, container):
+        self.api = FakeAPI(container)
+
+def test_deploy_restores_from_volume_and_removes_old_blobs(tmp_path):
+    project_dir = str(tmp_path / 'project')
+    os.makedirs(project_dir)
+    harborml.start_project(project_dir)
+    container = FakeDeployContainer(str(tmp_path / 'container'))
+    volume = os.path.join(str(tmp_path / 'container'), 'volume')
+    model_file = os.path.join(str(tmp_path / 'container'), 'app', 'model', 'iris_model', 'iris.pkl')
+    _write(os.path.join(project_dir, 'model/iris_model/iris.pkl'), b'first')
+    harborml.store_artifacts(project_dir, 'iris_model')
+    with harborml.docker_session(FakeClient(container)):
+        core._copy_artifacts_to_container(project_dir, container, core._load_artifact_manifest(project_dir, 'iris_model', 1))
+        with open(model_file, 'rb') as f:
+            assert f.read() == b'first'
+        # the staging directory is gone, only the blob is left
+        assert os.listdir(volume) == _blobs(project_dir)
+        old_blob = os.listdir(volume)[0]
+        _write(os.path.join(project_dir, 'model/iris_model/iris.pkl'), b'second')
+        harborml.store_artifacts(project_dir, 'iris_model')
+        harborml.gc_artifacts(project_dir, keep = 1)
+        core._copy_artifacts_to_container(project_dir, container, core._load_artifact_manifest(project_dir, 'iris_model', 2))
+        with open(model_file, 'rb') as f:
+            assert f.read() == b'second'
+        assert old_blob not in os.listdir(volume)
+        assert sorted(os.listdir(volume)) == sorted(_blobs(project_dir))
+
+def test_volume_gc_waits_for_artifact_lock(tmp_path):
+    import threading
+    import time
+    project_dir = str(tmp_path / 'project')
+    os.makedirs(project_dir)
+    harborml.start_project(project_dir)
+    container = FakeDeployContainer(str(tmp_path / 'container'))
+    volume = os.path.join(str(tmp_path / 'container'), 'volume')
+    _write(os.path.join(volume, 'unreferenced.gz'), b'x')
+    with harborml.docker_session(FakeClient(container)):
+        # a deploy storing its version holds the lock, the blob may be about to become referenced
+        with core._file_lock(os.path.join(project_dir, constants.ARTIFACTS_LOCK_PATH)):
+            gc = threading.Thread(target = core._in_session(core._remove_unreferenced_volume_blobs),
+                args = (project_dir, container))
+            gc.start()
+            time.sleep(.3)
+            assert os.listdir(volume) == ['unreferenced.gz']
+        gc.join()
+    assert os.listdir(volume) == []
@@ -0,0 +1,65 @@
+import importlib.util
+import os
+
+import numpy
+
+def _load(name):
+    # the scoring app's modules are copied into deploy containers, not part of the harborml package
+    path = os.path.join(os.path.abspath('./'), 'harborml', 'static', 'flask', name + '.py')
+    spec = importlib.util.spec_from_file_location('harborml_app_' + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+cache = _load('cache')
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+def test_least_recently_used_entry_is_evicted():
+    responses = cache.ResponseCache(max_size = 2, ttl = 60)
+    responses.put('a', 1)
+    responses.put('b', 2)
+    # reading a makes b the least recently used
+    assert responses.get('a') == 1
+    responses.put('c', 3)
+    assert responses.get('b') is None
+    assert responses.get('a') == 1
+    assert responses.get('c') == 3
+    stats = responses.stats()
+    assert stats['size'] == 2
+    assert stats['evictions'] == 1
+    assert (stats['hits'], stats['misses']) == (3, 1)
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.time, 'time', clock.time)
+    responses = cache.ResponseCache(max_size = 10, ttl = 5)
+    responses.put('a', 1)
+    clock.now += 5
+    assert responses.get('a') == 1
+    clock.now += .1
+    assert responses.get('a') is None
+    assert responses.stats()['expirations'] == 1
+    assert responses.stats()['size'] == 0
+    # storing again restarts the ttl
+    responses.put('a', 2)
+    clock.now += 4
+    assert responses.get('a') == 2
+
+def test_keys_ignore_key_order_but_not_version():
+    key = cache.canonical_key('/', 'application/json', {'a': 1, 'b': [1, 2]}, '3')
+    assert key == cache.canonical_key('/', 'application/json', {'b': [1, 2], 'a': 1}, '3')
+    assert key != cache.canonical_key('/', 'application/json', {'a': 1, 'b': [1, 2]}, '4')
+    assert key != cache.canonical_key('/batch', 'application/json', {'a': 1, 'b': [1, 2]}, '3')
+    assert key != cache.canonical_key('/', 'application/msgpack', {'a': 1, 'b': [1, 2]}, '3')
+
+def test_array_keys_include_shape():
+    arr = numpy.arange(4, dtype = 'float32')
+    key = cache.canonical_key('/', '', arr, '')
+    assert key == cache.canonical_key('/', '', arr.copy(), '')
+    assert key != cache.canonical_key('/', '', arr.reshape(2, 2), '')
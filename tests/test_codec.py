@@ -0,0 +1,80 @@
+import importlib.util
+import os
+import struct
+
+import flask
+import numpy
+import pytest
+from werkzeug.exceptions import HTTPException
+
+# only needed in the container, like orjson
+msgpack = pytest.importorskip('msgpack')
+
+def _load(name):
+    # the scoring app's modules are copied into deploy containers, not part of the harborml package
+    path = os.path.join(os.path.abspath('./'), 'harborml', 'static', 'flask', name + '.py')
+    spec = importlib.util.spec_from_file_location('harborml_app_' + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+codec = _load('codec')
+app = flask.Flask(__name__)
+
+def _decode(body, content_type):
+    with app.test_request_context('/', method = 'POST', data = body, headers = {'Content-Type': content_type}):
+        return codec.decode(flask.request)
+
+def _encode(value, content_type = codec.JSON, accept = None):
+    headers = {'Content-Type': content_type}
+    if accept is not None:
+        headers['Accept'] = accept
+    with app.test_request_context('/', method = 'POST', headers = headers):
+        return codec.encode(value, flask.request)
+
+def _status(func, *args):
+    with pytest.raises(HTTPException) as e:
+        func(*args)
+    return e.value.code
+
+def test_float32_round_trip():
+    arr = numpy.arange(6, dtype = 'float32').reshape(2, 3) / 4
+    body = codec.encode_float32(arr)
+    decoded = _decode(body, codec.FLOAT32)
+    assert decoded.dtype == numpy.dtype('<f4')
+    assert decoded.shape == (2, 3)
+    assert (decoded == arr).all()
+    response = _encode(decoded * 2, accept = codec.FLOAT32)
+    assert response.mimetype == codec.FLOAT32
+    assert (codec.decode_float32(response.get_data()) == arr * 2).all()
+
+def test_float32_bad_payloads():
+    assert _status(codec.decode_float32, b'\x01\x00') == 400
+    # two dimensions announced, only one given
+    assert _status(codec.decode_float32, struct.pack('<II', 2, 3)) == 400
+    assert _status(codec.decode_float32, struct.pack('<II', 1, 3) + b'\x00' * 8) == 400
+
+def test_float32_response_falls_back_to_json_for_text():
+    response = _encode(['setosa'], accept = codec.FLOAT32)
+    assert response.mimetype == codec.JSON
+    assert response.get_json() == ['setosa']
+
+def test_msgpack_round_trip():
+    data = {'data': [[0.0, 1.5], [2.0, 3.0]], 'name': 'iris'}
+    assert _decode(msgpack.packb(data, use_bin_type = True), codec.MSGPACK) == data
+    assert _decode(msgpack.packb(data, use_bin_type = True), 'application/x-msgpack') == data
+    # a msgpack request gets a msgpack response unless it asks for something else
+    response = _encode(numpy.array([1.0, 2.0]), content_type = codec.MSGPACK)
+    assert response.mimetype == codec.MSGPACK
+    assert msgpack.unpackb(response.get_data(), raw = False) == [1.0, 2.0]
+    assert _encode([1], content_type = codec.MSGPACK, accept = codec.JSON).mimetype == codec.JSON
+
+def test_msgpack_without_the_package(monkeypatch):
+    monkeypatch.setattr(codec, 'msgpack', None)
+    assert _status(_decode, b'\x90', codec.MSGPACK) == 415
+
+def test_json_bad_payload():
+    assert _decode(b'{"a": [1, 2]}', codec.JSON) == {'a': [1, 2]}
+    # anything that is not a known binary type is parsed as JSON
+    assert _decode(b'[1]', 'text/plain') == [1]
+    assert _status(_decode, b'{"a": ', codec.JSON) == 400
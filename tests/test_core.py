@@ -18,9 +18,11 @@ def setup_module(module):
         shutil.rmtree('./tests/testproject/tmp')
 
     harborml.start_project(testproject_dir)
-    harborml.refresh_data(testproject_dir, 'default', 'refresh_iris.py', dataset_name = 'iris', stop_container=False)
+    module.refresh_container = harborml.refresh_data(testproject_dir, 'default', 'refresh_iris.py', dataset_name = 'iris', stop_container=False)
 
 def teardown_module(module):
+    module.refresh_container.stop(timeout=0)
+    module.refresh_container.remove()
     harborml.undeploy_all(testproject_dir)
     if os.path.isdir('./tests/testproject/data'):
         shutil.rmtree('./tests/testproject/data')
@@ -28,12 +30,25 @@ def teardown_module(module):
         shutil.rmtree('./tests/testproject/model')
     if os.path.isdir('./tests/testproject/tmp'):
         shutil.rmtree('./tests/testproject/tmp')
+    if os.path.isdir('./tests/testproject/.harborml'):
+        shutil.rmtree('./tests/testproject/.harborml')
     if os.path.isfile('./tests/testproject/project.ini'):
         os.remove('./tests/testproject/project.ini')
 
 def test_build():
     harborml.build_container(testproject_dir, 'default')
 
+def test_build_cache():
+    tag = harborml.build_container(testproject_dir, 'default')
+    import docker
+    image_id = docker.from_env().images.get(tag).id
+    with open(testproject_dir + '.harborml/build_cache.json') as f:
+        import json
+        build_cache = json.load(f)
+    assert image_id in [x['image_id'] for x in build_cache.values()]
+    # cached build must not create a new image
+    assert docker.from_env().images.get(harborml.build_container(testproject_dir, 'default')).id == image_id
+
 #useless warnings filter
 @pytest.mark.filterwarnings("ignore:numpy.ufunc size changed")
 def test_train_and_deploy():
@@ -54,18 +69,132 @@ def test_train_and_deploy():
             'deploy_iris_model.py',
             include_data = False)
 
+        # deploy_model only returns once the health check passes
         import requests
-        import time
-        time.sleep(3) # have to wait for flask to spin up
         import json
         r = requests.post('http://localhost:5000/iris_model/', json=[0.0, 0.0, 0.0, 0.0])
         assert json.loads(r.text) == 'setosa'
         r = requests.post('http://localhost:5000/iris_model/', json=[10.0, 10.0, 10.0, 10.0])
         assert json.loads(r.text) == 'virginica'
+        r = requests.post('http://localhost:5000/iris_model/batch', json=[[0.0, 0.0, 0.0, 0.0], [10.0, 10.0, 10.0, 10.0]])
+        assert json.loads(r.text) == ['setosa', 'virginica']
+        r = requests.post('http://localhost:5000/iris_model/batch', json={
+            'sepal_length': [0.0, 10.0], 'sepal_width': [0.0, 10.0], 'petal_length': [0.0, 10.0], 'petal_width': [0.0, 10.0]})
+        assert json.loads(r.text) == ['setosa', 'virginica']
+        # rolling redeploy, the endpoint keeps answering throughout
+        container = harborml.deploy_model(
+            './tests/testproject',
+            'default',
+            'deploy_iris_model.py',
+            drain_seconds = 1)
+        r = requests.post('http://localhost:5000/iris_model/', json=[0.0, 0.0, 0.0, 0.0])
+        assert json.loads(r.text) == 'setosa'
+        rollouts = harborml.rollout_history(testproject_dir, 'iris_model')
+        assert len(rollouts) == 2
+        assert rollouts[-1]['dropped_requests'] == 0
+        harborml.scale_model(testproject_dir, 'iris_model', 2, drain_seconds = 0)
+        for _ in range(4):
+            r = requests.post('http://localhost:5000/iris_model/', json=[10.0, 10.0, 10.0, 10.0])
+            assert json.loads(r.text) == 'virginica'
+        harborml.scale_model(testproject_dir, 'iris_model', 1, drain_seconds = 0)
+        assert len(harborml.list_deployments(testproject_dir)['iris_model']['replicas']) == 1
+        harborml.undeploy_single_model(testproject_dir, 'iris_model')
+        assert 'iris_model' not in harborml.list_deployments(testproject_dir)
     finally:
         if container is not None:
             container.stop(timeout=0)
 
+def test_train_cache():
+    harborml.train_model(testproject_dir, 'default', 'train_iris_model.py')
+    hits = harborml.model_cache_stats(testproject_dir)['hits']
+    # same script, data and image, so the second run is skipped
+    harborml.train_model(testproject_dir, 'default', 'train_iris_model.py')
+    assert harborml.model_cache_stats(testproject_dir)['hits'] == hits + 1
+    misses = harborml.model_cache_stats(testproject_dir)['misses']
+    harborml.train_model(testproject_dir, 'default', 'train_iris_model.py', force = True)
+    assert harborml.model_cache_stats(testproject_dir)['misses'] == misses + 1
+
+def test_stream_logs():
+    result = harborml.train_model(testproject_dir, 'default', 'train_iris_model.py', force = True, stream_logs = True,
+        timings = True)
+    assert not result['cached']
+    assert os.path.isfile(result['log_file'])
+    assert set(result['timings']) == set(['build', 'start', 'copy_in', 'run', 'copy_out', 'stop'])
+    assert result['seconds'] >= result['timings']['run']
+
+def test_deploy_to_new_proxy():
+    # no reverse proxy running, so the deploy starts one and its first config push has to start nginx
+    harborml.undeploy_all(testproject_dir)
+    harborml.deploy_model(testproject_dir, 'default', 'deploy_iris_model.py', drain_seconds = 0)
+    try:
+        import requests
+        import json
+        r = requests.post('http://localhost:5000/iris_model/', json=[0.0, 0.0, 0.0, 0.0])
+        assert json.loads(r.text) == 'setosa'
+    finally:
+        harborml.undeploy_single_model(testproject_dir, 'iris_model')
+
+def test_dropped_requests_are_counted():
+    from harborml import core
+    container = harborml.deploy_model(testproject_dir, 'default', 'deploy_iris_model.py', drain_seconds = 0)
+    try:
+        import requests
+        proxy = core._deploy_reverse_proxy(testproject_dir)
+        offset = core._proxy_log_offset(proxy)
+        # the upstream is gone, so nginx fails the request
+        container.stop(timeout=0)
+        r = requests.post('http://localhost:5000/iris_model/', json=[0.0, 0.0, 0.0, 0.0])
+        assert r.status_code in (502, 504)
+        assert core._count_proxy_errors(proxy, 'iris_model', offset) == 1
+    finally:
+        harborml.undeploy_single_model(testproject_dir, 'iris_model')
+
+def test_undeploy_removes_containers():
+    import docker
+    container = harborml.deploy_model(testproject_dir, 'default', 'deploy_iris_model.py', drain_seconds = 0)
+    redeployed = harborml.deploy_model(testproject_dir, 'default', 'deploy_iris_model.py', drain_seconds = 0)
+    client = docker.from_env()
+    # the drained version is removed, not left behind as an exited container
+    with pytest.raises(docker.errors.NotFound):
+        client.containers.get(container.id)
+    harborml.undeploy_single_model(testproject_dir, 'iris_model')
+    with pytest.raises(docker.errors.NotFound):
+        client.containers.get(redeployed.id)
+
+def test_deploy_models():
+    import asyncio
+    results = asyncio.run(harborml.deploy_models(testproject_dir, 'default', [
+        {'model_api_file': 'deploy_iris_model.py', 'drain_seconds': 0}]))
+    try:
+        assert [x['status'] for x in results] == ['ok']
+        assert set(results[0]['timings']) == set(['build', 'stage', 'switch'])
+        import requests
+        import json
+        r = requests.post('http://localhost:5000/iris_model/', json=[0.0, 0.0, 0.0, 0.0])
+        assert json.loads(r.text) == 'setosa'
+    finally:
+        harborml.undeploy_single_model(testproject_dir, 'iris_model')
+
+def test_lazy_load():
+    container = harborml.deploy_model(testproject_dir, 'default', 'deploy_iris_model.py',
+        serving = {'load': 'lazy', 'warmup': True}, drain_seconds = 0)
+    try:
+        import requests
+        import json
+        r = requests.post('http://localhost:5000/iris_model/', json=[0.0, 0.0, 0.0, 0.0])
+        assert json.loads(r.text) == 'setosa'
+        assert 'model_loaded' in requests.get('http://localhost:5000/iris_model/stats').json()
+    finally:
+        harborml.undeploy_single_model(testproject_dir, 'iris_model')
+
+def test_pipeline():
+    results = harborml.run_pipeline(testproject_dir, force = True)
+    assert all(x['status'] == 'ok' for x in results.values())
+    assert os.path.isfile(testproject_dir + 'model/iris_model/iris.pkl')
+    # nothing changed, so every stage is skipped
+    results = harborml.run_pipeline(testproject_dir)
+    assert all(x['status'] == 'skipped' for x in results.values())
+
 def test_r_train_and_deploy():
     harborml.train_model(
         testproject_dir,
@@ -81,13 +210,13 @@ def test_r_train_and_deploy():
             include_data = False)
 
         import requests
-        import time
-        time.sleep(3) # have to wait for plumber to spin up
         import json
         r = requests.post('http://localhost:5000/iris_model_r/', json={"data":[0.0, 0.0, 0.0, 0.0]})
         assert json.loads(r.text)[0] == "setosa"
         r = requests.post('http://localhost:5000/iris_model_r/', json={"data":[10.0, 10.0, 10.0, 10.0]})
         assert json.loads(r.text)[0] == "virginica"
+        r = requests.post('http://localhost:5000/iris_model_r/batch', json={"data":[[0.0, 0.0, 0.0, 0.0], [10.0, 10.0, 10.0, 10.0]]})
+        assert json.loads(r.text) == ["setosa", "virginica"]
     finally:
         if container is not None:
             container.stop(timeout=0)
@@ -0,0 +1,52 @@
+import os
+import shutil
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import pytest
+
+FLASK_DIR = os.path.join(os.path.abspath('./'), 'harborml', 'static', 'flask')
+APP_MODULES = ['app', 'loader', 'cache', 'codec', 'microbatch', 'artifacts', 'deploy_fake_model']
+
+# predicts the sum of each row, the batch hook records what it was given
+DEPLOY_MODULE = """
+batches = []
+
+def api_predict(data):
+    return sum(data)
+
+def api_predict_batch(data):
+    batches.append(data)
+    return [sum(row) for row in data]
+"""
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """The scoring app as deployed, with loader.py completed the way deploy_model does it"""
+    app_dir = str(tmp_path / 'flask')
+    shutil.copytree(FLASK_DIR, app_dir, ignore = shutil.ignore_patterns('__pycache__'))
+    with open(os.path.join(app_dir, 'deploy_fake_model.py'), 'w') as f:
+        f.write(DEPLOY_MODULE)
+    with open(os.path.join(app_dir, 'loader.py'), 'a') as f:
+        f.write("model = from_environment('deploy_fake_model')\n")
+    for name in APP_MODULES:
+        monkeypatch.delitem(sys.modules, name, raising = False)
+    monkeypatch.syspath_prepend(app_dir)
+    import app
+    yield app.app.test_client()
+    for name in APP_MODULES:
+        sys.modules.pop(name, None)
+
+def test_batch_of_rows(client):
+    r = client.post('/batch', json = [[1, 2], [3, 4]])
+    assert r.get_json() == [3, 7]
+
+def test_batch_of_columns(client):
+    r = client.post('/batch', json = {'a': [1, 3], 'b': [2, 4]})
+    assert r.get_json() == [3, 7]
+    # the hook gets rows of values in column order, not the columns
+    assert sys.modules['deploy_fake_model'].batches[-1] == [[1, 2], [3, 4]]
+
+def test_batch_of_uneven_columns(client):
+    r = client.post('/batch', json = {'a': [1, 3], 'b': [2]})
+    assert r.status_code == 400
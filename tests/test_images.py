@@ -0,0 +1,83 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import docker
+import harborml
+from harborml import constants
+from harborml import core
+
+class FakeImage(object):
+    def __init__(self, image_id, tags, project_id = None):
+        self.id = image_id
+        self.short_id = image_id[:10]
+        self.tags = tags
+        self.labels = {constants.CONTAINER_LABEL_PROJECT: project_id} if project_id is not None else {}
+
+class FakeImages(object):
+    def __init__(self, images):
+        self.images = {x.id: x for x in images}
+        self.removed = []
+
+    def get(self, image_id):
+        if image_id not in self.images:
+            raise docker.errors.ImageNotFound(image_id)
+        return self.images[image_id]
+
+    def list(self, name = None):
+        return list(self.images.values())
+
+    def remove(self, image_id):
+        self.removed.append(image_id)
+        del self.images[image_id]
+
+class FakeClient(object):
+    def __init__(self, images):
+        self.images = FakeImages(images)
+        self.api = None
+
+def _project(path):
+    os.makedirs(path)
+    harborml.start_project(path)
+    return core._get_project_config(path)['DEFAULT']['PROJECT_ID']
+
+def _cache(project_dir, entries):
+    core._save_build_cache(project_dir, {digest: {'container_name': name, 'image_id': image_id, 'built': built}
+        for digest, name, image_id, built in entries})
+
+def test_prune_keeps_other_projects_images(tmp_path):
+    project_dir = str(tmp_path / 'a')
+    other_dir = str(tmp_path / 'b')
+    project_id = _project(project_dir)
+    other_id = _project(other_dir)
+    images = [
+        FakeImage('sha256:old', [], project_id),
+        FakeImage('sha256:new', ['harborml_default:latest'], project_id),
+        # another project's build of a container this project has no dockerfile for
+        FakeImage('sha256:other', ['harborml_gpu:latest'], other_id),
+        # another project's image that found its way into this project's cache
+        FakeImage('sha256:shared', [], other_id)
+    ]
+    _cache(project_dir, [
+        ('d1', 'default', 'sha256:old', 1.0),
+        ('d2', 'default', 'sha256:new', 2.0),
+        ('d3', 'default', 'sha256:shared', 0.5),
+        ('d4', 'default', 'sha256:gone', 0.1)
+    ])
+    _cache(other_dir, [('e1', 'gpu', 'sha256:other', 1.0)])
+    fake = FakeClient(images)
+    with harborml.docker_session(fake):
+        removed = harborml.prune_images(project_dir)
+    assert fake.images.removed == ['sha256:old']
+    assert removed == ['sha256:old'[:10]]
+    assert sorted(core._load_build_cache(project_dir)) == ['d2', 'd3']
+    assert sorted(core._load_build_cache(other_dir)) == ['e1']
+
+def test_prune_removes_images_of_deleted_dockerfiles(tmp_path):
+    project_dir = str(tmp_path / 'a')
+    project_id = _project(project_dir)
+    _cache(project_dir, [('d1', 'gpu', 'sha256:gpu', 1.0)])
+    fake = FakeClient([FakeImage('sha256:gpu', ['harborml_gpu:latest'], project_id)])
+    with harborml.docker_session(fake):
+        assert harborml.prune_images(project_dir) == ['harborml_gpu:latest']
+    assert core._load_build_cache(project_dir) == {}
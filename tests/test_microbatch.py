@@ -0,0 +1,80 @@
+import importlib.util
+import os
+import threading
+import time
+
+import pytest
+
+def _load(name):
+    # the scoring app's modules are copied into deploy containers, not part of the harborml package
+    path = os.path.join(os.path.abspath('./'), 'harborml', 'static', 'flask', name + '.py')
+    spec = importlib.util.spec_from_file_location('harborml_app_' + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+microbatch = _load('microbatch')
+
+def _predict_concurrently(batcher, payloads):
+    results = [None] * len(payloads)
+    def run(i):
+        try:
+            results[i] = batcher.predict(payloads[i])
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target = run, args = (i,)) for i in range(len(payloads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+def test_full_batch_is_scored_without_waiting():
+    batches = []
+    def predict_batch(rows):
+        batches.append(list(rows))
+        return [x * 10 for x in rows]
+    # the deadline is far away, only the batch size can end the batch
+    batcher = microbatch.MicroBatcher(predict_batch, max_batch_size = 4, max_wait_ms = 10000)
+    start = time.time()
+    results = _predict_concurrently(batcher, [1, 2, 3, 4])
+    assert time.time() - start < 5
+    assert results == [10, 20, 30, 40]
+    assert [sorted(x) for x in batches] == [[1, 2, 3, 4]]
+    assert batcher.stats()['batch_size']['count'] == 1
+
+def test_partial_batch_is_scored_at_deadline():
+    batches = []
+    def predict_batch(rows):
+        batches.append(list(rows))
+        return rows
+    batcher = microbatch.MicroBatcher(predict_batch, max_batch_size = 100, max_wait_ms = 50)
+    start = time.time()
+    assert batcher.predict('row') == 'row'
+    assert .04 <= time.time() - start < 5
+    assert batches == [['row']]
+
+def test_error_reaches_every_waiter():
+    def predict_batch(rows):
+        raise ValueError("model failed")
+    batcher = microbatch.MicroBatcher(predict_batch, max_batch_size = 3, max_wait_ms = 10000)
+    results = _predict_concurrently(batcher, [1, 2, 3])
+    assert all(isinstance(x, ValueError) for x in results)
+    # the worker thread survives a failed batch
+    batcher.predict_batch = lambda rows: rows
+    batcher.max_batch_size = 1
+    assert batcher.predict(4) == 4
+
+def test_wrong_number_of_results_fails_the_batch():
+    batcher = microbatch.MicroBatcher(lambda rows: rows[:1], max_batch_size = 2, max_wait_ms = 10000)
+    results = _predict_concurrently(batcher, [1, 2])
+    assert all(isinstance(x, RuntimeError) for x in results)
+
+def test_histogram_buckets():
+    histogram = microbatch.Histogram([1, 10])
+    for value in [0.5, 1, 5, 50]:
+        histogram.observe(value)
+    result = histogram.to_dict()
+    assert [x['count'] for x in result['buckets']] == [2, 1, 1]
+    assert result['count'] == 4
+    assert result['sum'] == pytest.approx(56.5)
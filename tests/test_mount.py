@@ -0,0 +1,59 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import harborml
+from harborml import constants
+from harborml import core
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def test_project_volumes(tmp_path):
+    project_dir = str(tmp_path / 'project')
+    os.makedirs(project_dir)
+    harborml.start_project(project_dir)
+    output_dir = str(tmp_path / 'output')
+    volumes = core._project_volumes(project_dir, include_data = False, include_model = 'iris_model', output_dir = output_dir)
+    in_container = constants.DEFAULT_DIR_IN_CONTAINER
+    assert volumes == {
+        os.path.join(os.path.abspath(project_dir), 'src'): {'bind': in_container + '/src', 'mode': 'ro'},
+        os.path.join(os.path.abspath(project_dir), 'model', 'iris_model'): {'bind': in_container + '/model/iris_model', 'mode': 'ro'},
+        os.path.abspath(output_dir): {'bind': in_container + '/output', 'mode': 'rw'}
+    }
+    # a model that was never trained still gets its directory, docker would create it as root
+    assert os.path.isdir(os.path.join(project_dir, 'model', 'iris_model'))
+    volumes = core._project_volumes(project_dir)
+    assert sorted(x['bind'] for x in volumes.values()) == [in_container + '/data', in_container + '/src']
+    assert all(x['mode'] == 'ro' for x in volumes.values())
+
+def test_mounted_output_is_merged_into_target(tmp_path):
+    project_dir = str(tmp_path / 'project')
+    output_dir = str(tmp_path / 'output')
+    _write(os.path.join(project_dir, 'model', 'iris_model', 'old.pkl'), 'old')
+    _write(os.path.join(project_dir, 'model', 'iris_model', 'sub', 'keep.txt'), 'keep')
+    _write(os.path.join(output_dir, 'iris.pkl'), 'new')
+    _write(os.path.join(output_dir, 'sub', 'notes.txt'), 'notes')
+    target = core._move_output_to_project(project_dir, output_dir, 'model/iris_model')
+    assert _read(os.path.join(target, 'iris.pkl')) == 'new'
+    assert _read(os.path.join(target, 'sub', 'notes.txt')) == 'notes'
+    assert _read(os.path.join(target, 'sub', 'keep.txt')) == 'keep'
+    assert _read(os.path.join(target, 'old.pkl')) == 'old'
+
+def test_mounted_output_artifacts(tmp_path):
+    project_dir = str(tmp_path / 'project')
+    output_dir = str(tmp_path / 'output')
+    _write(os.path.join(output_dir, 'iris.pkl'), 'model')
+    _write(os.path.join(output_dir, 'sub', 'weights.pkl'), 'weights')
+    _write(os.path.join(output_dir, 'debug.log'), 'log')
+    target = core._move_output_to_project(project_dir, output_dir, 'model/iris_model', artifacts = ['*.pkl'])
+    assert sorted(os.listdir(target)) == ['iris.pkl', 'sub']
+    assert _read(os.path.join(target, 'sub', 'weights.pkl')) == 'weights'
+    # files that did not match stay in the output directory
+    assert os.path.isfile(os.path.join(output_dir, 'debug.log'))
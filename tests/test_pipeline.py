@@ -0,0 +1,38 @@
+import os
+import sys
+import threading
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import harborml
+from harborml import core
+
+PIPELINE = """
+[users]
+type = refresh
+file = refresh_users.py
+container = default
+
+[orders]
+type = refresh
+file = refresh_orders.py
+container = default
+"""
+
+def test_independent_stages_fingerprint_in_parallel(tmp_path, monkeypatch):
+    project_dir = str(tmp_path)
+    harborml.start_project(project_dir)
+    pipeline_file = os.path.join(project_dir, 'pipeline.ini')
+    with open(pipeline_file, 'w') as f:
+        f.write(PIPELINE)
+    # both stages have to be hashing at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout = 5)
+    def fake_fingerprint(project_root_dir, stage):
+        barrier.wait()
+        return stage['name']
+    monkeypatch.setattr(core, '_stage_fingerprint', fake_fingerprint)
+    monkeypatch.setattr(core, '_build_container', lambda *args, **kwargs: 'harborml_default:latest')
+    monkeypatch.setattr(core, '_run_job', lambda *args, **kwargs: None)
+    results = harborml.run_pipeline(project_dir, pipeline_file = pipeline_file, max_workers = 2)
+    assert {x: results[x]['status'] for x in results} == {'users': 'ok', 'orders': 'ok'}
+    state = core._read_json_file(os.path.join(project_dir, '.harborml', 'pipeline_state.json'))
+    assert state == {'users': 'users', 'orders': 'orders'}
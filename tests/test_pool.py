@@ -0,0 +1,149 @@
+import configparser
+import os
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import docker
+import harborml
+from harborml import constants
+from harborml import core
+
+IMAGE_TAG = 'harborml_default:latest'
+
+class FakeContainer(object):
+    def __init__(self, container_id):
+        self.id = container_id
+        self.status = 'running'
+        self.removed = False
+
+    def stop(self, timeout = None):
+        self.status = 'exited'
+
+    def remove(self):
+        self.removed = True
+
+class FakeImage(object):
+    def __init__(self, image_id):
+        self.id = image_id
+
+class FakeImages(object):
+    def __init__(self):
+        self.image_id = 'sha256:one'
+
+    def get(self, tag):
+        return FakeImage(self.image_id)
+
+class FakeContainers(object):
+    def __init__(self):
+        self.containers = {}
+
+    def get(self, container_id):
+        if container_id not in self.containers or self.containers[container_id].removed:
+            raise docker.errors.NotFound(container_id)
+        return self.containers[container_id]
+
+class FakeAPI(object):
+    """Every exec succeeds"""
+    def exec_create(self, container_id, cmd):
+        return {'Id': 'exec'}
+
+    def exec_start(self, exec_id, detach = False):
+        return None
+
+    def exec_inspect(self, exec_id):
+        return {'Running': False, 'ExitCode': 0}
+
+class FakeClient(object):
+    def __init__(self):
+        self.images = FakeImages()
+        self.containers = FakeContainers()
+        self.api = FakeAPI()
+
+    def start(self, image_tag, labels = None, **kwargs):
+        container = FakeContainer('c{}'.format(len(self.containers.containers)))
+        self.containers.containers[container.id] = container
+        return container
+
+def _pool_project(tmp_path, monkeypatch, size = 2, ttl = 600):
+    project_dir = str(tmp_path)
+    harborml.start_project(project_dir)
+    ini_path = os.path.join(project_dir, constants.INI_PATH)
+    config = configparser.ConfigParser()
+    config.read(ini_path)
+    config['pool'] = {'size': str(size), 'ttl': str(ttl)}
+    with open(ini_path, 'w') as f:
+        config.write(f)
+    client = FakeClient()
+    monkeypatch.setattr(core, '_start_container', client.start)
+    return project_dir, client
+
+def _age_idle_containers(project_dir, seconds):
+    state = core._load_pool_state(project_dir)
+    for entry in state['containers'].values():
+        entry['since'] -= seconds
+    core._save_pool_state(project_dir, state)
+
+def test_released_container_is_leased_again(tmp_path, monkeypatch):
+    project_dir, client = _pool_project(tmp_path, monkeypatch)
+    with harborml.docker_session(client):
+        first = core._lease_container(project_dir, IMAGE_TAG)
+        assert harborml.pool_stats(project_dir)['leased'] == 1
+        core._release_container(project_dir, first)
+        assert harborml.pool_stats(project_dir)['idle'] == 1
+        second = core._lease_container(project_dir, IMAGE_TAG)
+    assert second is first
+    stats = harborml.pool_stats(project_dir)
+    assert (stats['leases'], stats['hits'], stats['misses'], stats['startups']) == (2, 1, 1, 1)
+    assert (stats['idle'], stats['leased']) == (0, 1)
+
+def test_release_beyond_pool_size_removes_container(tmp_path, monkeypatch):
+    project_dir, client = _pool_project(tmp_path, monkeypatch, size = 1)
+    with harborml.docker_session(client):
+        first = core._lease_container(project_dir, IMAGE_TAG)
+        second = core._lease_container(project_dir, IMAGE_TAG)
+        core._release_container(project_dir, first)
+        core._release_container(project_dir, second)
+    assert not first.removed
+    assert second.removed
+    assert harborml.pool_stats(project_dir)['idle'] == 1
+
+def test_expired_and_outdated_containers_are_evicted(tmp_path, monkeypatch):
+    project_dir, client = _pool_project(tmp_path, monkeypatch, ttl = 60)
+    with harborml.docker_session(client):
+        expired = core._lease_container(project_dir, IMAGE_TAG)
+        core._release_container(project_dir, expired)
+        _age_idle_containers(project_dir, 61)
+        fresh = core._lease_container(project_dir, IMAGE_TAG)
+        assert fresh is not expired and expired.removed
+        core._release_container(project_dir, fresh)
+        # the image was rebuilt, so the idle container runs an old version of it
+        client.images.image_id = 'sha256:two'
+        rebuilt = core._lease_container(project_dir, IMAGE_TAG)
+        assert rebuilt is not fresh and fresh.removed
+    assert harborml.pool_stats(project_dir)['evictions'] == 2
+
+def test_dead_pooled_container_is_skipped(tmp_path, monkeypatch):
+    project_dir, client = _pool_project(tmp_path, monkeypatch)
+    with harborml.docker_session(client):
+        first = core._lease_container(project_dir, IMAGE_TAG)
+        core._release_container(project_dir, first)
+        first.status = 'exited'
+        second = core._lease_container(project_dir, IMAGE_TAG)
+    assert second is not first
+    assert list(core._load_pool_state(project_dir)['containers']) == [second.id]
+
+def test_drain_pool(tmp_path, monkeypatch):
+    project_dir, client = _pool_project(tmp_path, monkeypatch, ttl = 60)
+    with harborml.docker_session(client):
+        containers = [core._lease_container(project_dir, IMAGE_TAG) for _ in range(3)]
+        core._release_container(project_dir, containers[0])
+        _age_idle_containers(project_dir, 61)
+        core._release_container(project_dir, containers[1])
+        # only the container idle for longer than the ttl
+        assert harborml.drain_pool(project_dir, expired_only = True) == 1
+        assert containers[0].removed and not containers[1].removed
+        # leased containers are left alone
+        assert harborml.drain_pool(project_dir) == 1
+        assert containers[1].removed and not containers[2].removed
+    stats = harborml.pool_stats(project_dir)
+    assert (stats['idle'], stats['leased']) == (0, 1)
@@ -0,0 +1,226 @@
+import configparser
+import os
+import stat
+import subprocess
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import pytest
+import harborml
+from harborml import core
+
+# stands in for nginx: reload fails without a running master, like the real one
+FAKE_NGINX = """#!/bin/sh
+if [ "$1" = "-s" ]; then
+    [ -f "$NGINX_ROOT/nginx.pid" ] || { echo "nginx: [error] invalid PID number" >&2; exit 1; }
+    echo reload >> "$NGINX_ROOT/calls"
+elif [ "$1" = "-t" ]; then
+    exit 0
+else
+    touch "$NGINX_ROOT/nginx.pid"
+    echo start >> "$NGINX_ROOT/calls"
+fi
+"""
+
+class FakeProxy(object):
+    """A reverse proxy container whose commands run in a local directory, with a fake nginx on the PATH"""
+    def __init__(self, root):
+        self.id = 'proxy'
+        self.status = 'running'
+        self.root = root
+        nginx = os.path.join(root, 'bin', 'nginx')
+        os.makedirs(os.path.dirname(nginx))
+        with open(nginx, 'w') as f:
+            f.write(FAKE_NGINX)
+        os.chmod(nginx, os.stat(nginx).st_mode | stat.S_IEXEC)
+
+    def exec_run(self, cmd, **kwargs):
+        if cmd[:2] == ['sh', '-c']:
+            cmd = cmd[2]
+        else:
+            cmd = ' '.join(cmd)
+        env = dict(os.environ, NGINX_ROOT = self.root, PATH = os.path.join(self.root, 'bin') + ':' + os.environ['PATH'])
+        run = subprocess.run(['sh', '-c', cmd.replace('/etc/nginx', self.root)], env = env,
+            stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        return core._docker.models.containers.ExecResult(run.returncode, run.stdout)
+
+    def put_archive(self, path, data):
+        import io
+        import tarfile
+        with tarfile.open(fileobj = io.BytesIO(data)) as tar:
+            tar.extractall(path.replace('/etc/nginx', self.root))
+        return True
+
+    def calls(self):
+        with open(os.path.join(self.root, 'calls')) as f:
+            return f.read().split()
+
+def test_push_starts_nginx_when_not_running(tmp_path):
+    proxy = FakeProxy(str(tmp_path))
+    core._push_nginx_conf(proxy, 'events {}\n')
+    assert proxy.calls() == ['start']
+    core._push_nginx_conf(proxy, 'events {}\n')
+    assert proxy.calls() == ['start', 'reload']
+    with open(os.path.join(str(tmp_path), 'nginx.conf')) as f:
+        assert f.read() == 'events {}\n'
+
+def test_dropped_requests_are_counted_after_offset(tmp_path):
+    proxy = FakeProxy(str(tmp_path))
+    log_file = os.path.join(str(tmp_path), 'harborml_access.log')
+    proxy.exec_run = lambda cmd, **kwargs: FakeProxy.exec_run(proxy, [x.replace('/var/log/nginx', str(tmp_path)) for x in cmd])
+    assert core._proxy_log_offset(proxy) == 0
+    with open(log_file, 'w') as f:
+        f.write('1.1.1.1 - - [x] "POST /iris_model/ HTTP/1.1" 502 0 "-" "-"\n')
+    offset = core._proxy_log_offset(proxy)
+    with open(log_file, 'a') as f:
+        f.write('1.1.1.1 - - [x] "POST /iris_model/ HTTP/1.1" 502 0 "-" "-"\n')
+        f.write('1.1.1.1 - - [x] "POST /iris_model/ HTTP/1.1" 200 9 "-" "-"\n')
+        f.write('1.1.1.1 - - [x] "POST /other_model/ HTTP/1.1" 504 0 "-" "-"\n')
+    assert core._count_proxy_errors(proxy, 'iris_model', offset) == 1
+    assert core._count_proxy_errors(proxy, 'iris_model', 0) == 2
+
+class FakeAPI(object):
+    def __init__(self, containers):
+        self.containers = containers
+        self.execs = {}
+
+    def rename(self, container_id, name):
+        self.containers[container_id].name = name
+
+    def exec_create(self, container_id, cmd):
+        exec_id = 'exec{}'.format(len(self.execs))
+        self.execs[exec_id] = [container_id, cmd, None]
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, detach = False):
+        container_id, cmd, _ = self.execs[exec_id]
+        self.execs[exec_id][2] = self.containers[container_id].exec_run(cmd).exit_code
+
+    def exec_inspect(self, exec_id):
+        return {'Running': False, 'ExitCode': self.execs[exec_id][2]}
+
+class FakeContainers(object):
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def run(self, image_tag, **kwargs):
+        return self.proxy
+
+    def list(self, **kwargs):
+        return []
+
+class FakeClient(object):
+    def __init__(self, proxy):
+        self.containers = FakeContainers(proxy)
+        self.api = FakeAPI({proxy.id: proxy})
+
+def test_new_proxy_runs_nginx(tmp_path, monkeypatch):
+    project_dir = str(tmp_path / 'project')
+    os.makedirs(project_dir)
+    harborml.start_project(project_dir)
+    proxy = FakeProxy(str(tmp_path / 'proxy'))
+    monkeypatch.setattr(core, '_build_container', lambda *args, **kwargs: 'harborml_nginx:latest')
+    with harborml.docker_session(FakeClient(proxy)):
+        assert core._deploy_reverse_proxy(project_dir) is proxy
+        # the first config push of a new project reloads the nginx started with the container
+        core._push_nginx_conf(proxy, 'events {}\n')
+    assert proxy.calls() == ['start', 'reload']
+
+def _proxy_project(tmp_path, proxy_settings = None, template = None):
+    """A project whose [proxy] section is replaced by proxy_settings, or removed if it is None"""
+    project_dir = str(tmp_path / 'project')
+    os.makedirs(project_dir)
+    harborml.start_project(project_dir)
+    ini_path = os.path.join(project_dir, 'project.ini')
+    config = configparser.ConfigParser()
+    config.read(ini_path)
+    config.remove_section('proxy')
+    if proxy_settings is not None:
+        config['proxy'] = proxy_settings
+    with open(ini_path, 'w') as f:
+        config.write(f)
+    if template is not None:
+        with open(os.path.join(project_dir, 'containers', 'includes', 'nginx.conf'), 'w') as f:
+            f.write(template)
+    return project_dir
+
+def _render(project_dir):
+    balancing = core._get_balancing_config(project_dir, 'iris_model')
+    deployments = {'iris_model': {
+        'upstream': 'deploy-x-iris_model-0',
+        'balance': balancing['balance'],
+        'keepalive': balancing['keepalive'],
+        'replicas': [{'name': 'deploy-x-iris_model-0', 'address': '172.17.0.3:5000'}]
+    }}
+    return core._nginx.loads(core._render_nginx_conf(project_dir, deployments))
+
+def _key(block, name):
+    keys = block.filter('Key', name)
+    return [x.value for x in keys]
+
+def _location(conf):
+    http = conf.filter('Http')[0]
+    return http.filter('Server')[0].filter('Location')[0]
+
+def test_default_profile_leaves_template_untouched(tmp_path):
+    conf = _render(_proxy_project(tmp_path))
+    http = conf.filter('Http')[0]
+    assert _key(conf, 'worker_processes') == ['1']
+    assert _key(conf.filter('Events')[0], 'worker_connections') == ['1024']
+    for name in ['gzip', 'gzip_types', 'keepalive_requests']:
+        assert _key(http, name) == []
+    assert _key(http, 'keepalive_timeout') == ['65']
+    assert _key(http, 'access_log') == ['/var/log/nginx/harborml_access.log combined']
+    location = _location(conf)
+    assert _key(location, 'proxy_buffering') == []
+    assert _key(location, 'proxy_http_version') == []
+    assert _key(http.filter('Upstream')[0], 'keepalive') == []
+
+def test_performance_profile(tmp_path):
+    conf = _render(_proxy_project(tmp_path, {'profile': 'performance'}))
+    http = conf.filter('Http')[0]
+    assert _key(conf, 'worker_processes') == ['auto']
+    assert _key(conf.filter('Events')[0], 'worker_connections') == ['4096']
+    assert _key(http, 'keepalive_requests') == ['1000']
+    assert _key(http, 'gzip') == ['on']
+    assert _key(http, 'gzip_min_length') == ['1024']
+    assert _key(http, 'gzip_comp_level') == ['4']
+    # nginx always compresses text/html and warns about it being listed again
+    assert _key(http, 'gzip_types') == ['application/json text/plain']
+    assert _key(http, 'gzip_proxied') == ['any']
+    location = _location(conf)
+    assert _key(location, 'proxy_buffering') == ['on']
+    assert _key(location, 'proxy_buffer_size') == ['16k']
+    assert _key(location, 'proxy_buffers') == ['16 16k']
+    assert _key(location, 'proxy_busy_buffers_size') == ['32k']
+    assert _key(location, 'proxy_connect_timeout') == ['5s']
+    assert _key(location, 'proxy_read_timeout') == ['60s']
+    assert _key(location, 'proxy_http_version') == ['1.1']
+    assert _key(http.filter('Upstream')[0], 'keepalive') == ['32']
+    assert _key(http.filter('Upstream')[0], 'server') == ['172.17.0.3:5000']
+
+def test_profile_settings_can_be_overridden(tmp_path):
+    conf = _render(_proxy_project(tmp_path, {'profile': 'performance', 'worker_connections': '8192',
+        'upstream_keepalive': '64', 'proxy_read_timeout': '120s'}))
+    http = conf.filter('Http')[0]
+    assert _key(conf.filter('Events')[0], 'worker_connections') == ['8192']
+    assert _key(http.filter('Upstream')[0], 'keepalive') == ['64']
+    assert _key(_location(conf), 'proxy_read_timeout') == ['120s']
+    # the rest of the profile still applies
+    assert _key(http, 'gzip') == ['on']
+
+def test_settings_replace_template_directives_once(tmp_path):
+    template = 'worker_processes 2;\nevents {\n}\nhttp {\n    gzip off;\n    gzip_comp_level 9;\n}\n'
+    conf = _render(_proxy_project(tmp_path, {'profile': 'default', 'gzip': 'on'}, template = template))
+    http = conf.filter('Http')[0]
+    assert _key(http, 'gzip') == ['on']
+    # settings the profile leaves as None keep the template's value
+    assert _key(http, 'gzip_comp_level') == ['9']
+    assert _key(conf, 'worker_processes') == ['2']
+    # missing blocks are added, a server listening on 5000 is created
+    assert _key(http.filter('Server')[0], 'listen') == ['5000']
+
+def test_unknown_profile_is_rejected(tmp_path):
+    project_dir = _proxy_project(tmp_path, {'profile': 'fastest'})
+    with pytest.raises(ValueError):
+        core._get_proxy_config(project_dir)
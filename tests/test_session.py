@@ -0,0 +1,102 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import harborml
+from harborml import core
+
+class FakeAPI(object):
+    """Just enough of docker's APIClient for _exec_and_wait"""
+    def __init__(self, exit_code = 0):
+        self.exit_code = exit_code
+        self.commands = []
+
+    def exec_create(self, container_id, cmd):
+        self.commands.append(cmd)
+        return {'Id': 'exec{}'.format(len(self.commands))}
+
+    def exec_start(self, exec_id, detach = False):
+        return None
+
+    def exec_inspect(self, exec_id):
+        return {'Running': False, 'ExitCode': self.exit_code}
+
+class FakeClient(object):
+    def __init__(self, exit_code = 0):
+        self.api = FakeAPI(exit_code)
+
+class FakeContainer(object):
+    id = 'container'
+
+def test_session_uses_fake_client():
+    fake = FakeClient()
+    with harborml.docker_session(fake) as session:
+        assert core._docker_client() is fake
+        core._exec_and_wait(FakeContainer(), ['mkdir', '-p', '/var/harborml'])
+        stats = session.stats()
+    assert fake.api.commands == [['mkdir', '-p', '/var/harborml']]
+    assert set(stats) == set(['exec_create', 'exec_start', 'exec_inspect'])
+    assert stats['exec_create']['count'] == 1
+
+def test_nested_sessions():
+    outer, inner = FakeClient(), FakeClient()
+    with harborml.docker_session(outer):
+        with harborml.docker_session(inner):
+            assert core._docker_client() is inner
+        assert core._docker_client() is outer
+
+class ClosableClient(FakeClient):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_session_leaves_callers_client_open():
+    fake = ClosableClient()
+    session = harborml.docker_session(fake)
+    with session:
+        core._exec_and_wait(FakeContainer(), ['true'])
+    assert not fake.closed
+    # the same session can be entered again, without timing each call twice
+    with session:
+        assert core._docker_client() is fake
+        core._exec_and_wait(FakeContainer(), ['true'])
+    assert not fake.closed
+    assert session.stats()['exec_create']['count'] == 2
+
+def test_failed_exec_is_retried():
+    fake = FakeClient(exit_code = 1)
+    with harborml.docker_session(fake) as session:
+        try:
+            core._exec_and_wait(FakeContainer(), ['false'], attempts = 2)
+            assert False, "expected the command to fail"
+        except RuntimeError:
+            pass
+        assert session.stats()['exec_create']['count'] == 2
+
+def test_threads_use_their_own_session():
+    import threading
+    clients = [FakeClient(), FakeClient()]
+    barrier = threading.Barrier(len(clients))
+    seen = {}
+    def run(i):
+        with harborml.docker_session(clients[i]):
+            # both sessions are active at the same time
+            barrier.wait()
+            seen[i] = core._docker_client()
+            barrier.wait()
+    threads = [threading.Thread(target = run, args = (i,)) for i in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen[0] is clients[0] and seen[1] is clients[1]
+    assert core._current_session() is core._default_session
+
+def test_executor_threads_use_callers_session():
+    import concurrent.futures
+    fake = FakeClient()
+    with harborml.docker_session(fake):
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 2) as executor:
+            clients = list(executor.map(core._in_session(lambda x: core._docker_client()), range(4)))
+    assert all(x is fake for x in clients)
@@ -0,0 +1,119 @@
+import io
+import os
+import subprocess
+import sys
+import tarfile
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import pytest
+import harborml
+from harborml import constants
+from harborml import core
+
+class FakeContainer(object):
+    """A container whose project directory is a local directory, recording the files of every upload"""
+    def __init__(self, root):
+        self.id = 'sync'
+        self.root = root
+        self.uploads = []
+        self.fail_uploads = False
+
+    def exec_run(self, cmd, **kwargs):
+        run = subprocess.run([x.replace(constants.DEFAULT_DIR_IN_CONTAINER, self.root) for x in cmd],
+            stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        return core._docker.models.containers.ExecResult(run.returncode, run.stdout)
+
+    def put_archive(self, path, data):
+        if self.fail_uploads:
+            return False
+        with tarfile.open(fileobj = io.BytesIO(b''.join(data))) as tar:
+            self.uploads.append(sorted(tar.getnames()))
+            tar.extractall(path.replace(constants.DEFAULT_DIR_IN_CONTAINER, self.root))
+        return True
+
+class FakeAPI(object):
+    def __init__(self, container):
+        self.container = container
+        self.execs = {}
+
+    def exec_create(self, container_id, cmd):
+        exec_id = 'exec{}'.format(len(self.execs))
+        self.execs[exec_id] = cmd
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, detach = False):
+        self.execs[exec_id] = self.container.exec_run(self.execs[exec_id]).exit_code
+
+    def exec_inspect(self, exec_id):
+        return {'Running': False, 'ExitCode': self.execs[exec_id]}
+
+class FakeClient(object):
+    def __init__(self, container):
+        self.api = FakeAPI(container)
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+@pytest.fixture
+def project(tmp_path):
+    project_dir = str(tmp_path / 'project')
+    os.makedirs(project_dir)
+    harborml.start_project(project_dir)
+    _write(os.path.join(project_dir, 'src', 'train_a.py'), 'print(1)\n')
+    _write(os.path.join(project_dir, 'data', 'iris', 'iris.csv'), 'a,b\n')
+    _write(os.path.join(project_dir, 'data', 'old.csv'), 'x\n')
+    container = FakeContainer(str(tmp_path / 'container'))
+    with harborml.docker_session(FakeClient(container)):
+        yield project_dir, container
+
+def test_sync_uploads_only_changes(project):
+    project_dir, container = project
+    core._sync_project_to_container(project_dir, container)
+    assert container.uploads == [['data/iris/iris.csv', 'data/old.csv', 'src/train_a.py']]
+    # nothing changed, nothing is uploaded
+    core._sync_project_to_container(project_dir, container)
+    assert len(container.uploads) == 1
+    _write(os.path.join(project_dir, 'src', 'train_a.py'), 'print(2)\n')
+    os.remove(os.path.join(project_dir, 'data', 'old.csv'))
+    core._sync_project_to_container(project_dir, container)
+    assert container.uploads[-1] == ['src/train_a.py']
+    with open(os.path.join(container.root, 'src', 'train_a.py')) as f:
+        assert f.read() == 'print(2)\n'
+    # deleted in the project, so deleted in the container
+    assert not os.path.exists(os.path.join(container.root, 'data', 'old.csv'))
+    assert os.path.isfile(os.path.join(container.root, 'data', 'iris', 'iris.csv'))
+
+def test_touched_file_is_not_uploaded(project):
+    project_dir, container = project
+    core._sync_project_to_container(project_dir, container)
+    path = os.path.join(project_dir, 'data', 'iris', 'iris.csv')
+    stat = os.stat(path)
+    os.utime(path, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    core._sync_project_to_container(project_dir, container)
+    assert len(container.uploads) == 1
+    # the new mtime is recorded, so the file is not hashed again
+    local = core._read_json_file(core._manifest_file(project_dir, constants.LOCAL_MANIFEST_NAME))
+    assert local['data/iris/iris.csv']['mtime'] == stat.st_mtime_ns + 10 ** 9
+
+def test_scopes_limit_what_is_synced(project):
+    project_dir, container = project
+    core._sync_project_to_container(project_dir, container, include_data = False)
+    assert container.uploads == [['src/train_a.py']]
+    # data is no longer excluded, so it is uploaded now
+    core._sync_project_to_container(project_dir, container)
+    assert container.uploads[-1] == ['data/iris/iris.csv', 'data/old.csv']
+
+def test_failed_sync_forces_full_sync(project, monkeypatch):
+    project_dir, container = project
+    core._sync_project_to_container(project_dir, container)
+    _write(os.path.join(project_dir, 'src', 'train_a.py'), 'print(2)\n')
+    container.fail_uploads = True
+    monkeypatch.setattr(core, '_retry', lambda func, **kwargs: func())
+    with pytest.raises(RuntimeError):
+        core._sync_project_to_container(project_dir, container)
+    assert not os.path.exists(core._manifest_file(project_dir, container.id + '.json'))
+    container.fail_uploads = False
+    core._sync_project_to_container(project_dir, container)
+    assert container.uploads[-1] == ['data/iris/iris.csv', 'data/old.csv', 'src/train_a.py']
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.abspath('./')) # don't have to build wheel
+
+import pytest
+import harborml
+from harborml import core
+
+def _project(tmp_path):
+    project_dir = str(tmp_path)
+    harborml.start_project(project_dir)
+    return project_dir
+
+def test_unknown_script_type_is_rejected():
+    for stream in [False, True]:
+        with pytest.raises(NotImplementedError):
+            core._get_train_model_command('train_iris_model.sh', stream = stream)
+    assert 'python -u' in core._get_train_model_command('train_iris_model.py', stream = True)
+    assert 'Rscript' in core._get_train_model_command('train_iris_model.R', stream = True)
+
+def test_train_model_returns_container_unless_timings(tmp_path, monkeypatch):
+    project_dir = _project(tmp_path)
+    container = object()
+    def fake_train_model(project_root_dir, container_name, train_model_file, model_name, image_tag, stop_container = True, **kwargs):
+        return {'timings': {'build': 0.0, 'run': 1.0}, 'seconds': 1.0, 'container': None if stop_container else container}
+    monkeypatch.setattr(core, '_build_container', lambda *args, **kwargs: 'harborml_default:latest')
+    monkeypatch.setattr(core, '_train_model', fake_train_model)
+    assert harborml.train_model(project_dir, 'default', 'train_iris_model.py') is None
+    assert harborml.train_model(project_dir, 'default', 'train_iris_model.py', stop_container = False) is container
+    result = harborml.train_model(project_dir, 'default', 'train_iris_model.py', stop_container = False, timings = True)
+    assert result['container'] is container
+    assert result['timings']['run'] == 1.0
+
+class FakeTrainer(object):
+    """Stands in for _train_model, recording how many trainings run at once"""
+    def __init__(self, fail = ()):
+        self.fail = fail
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, project_root_dir, container_name, train_model_file, model_name, image_tag, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(.05)
+            if model_name in self.fail:
+                raise RuntimeError("{} diverged".format(model_name))
+            return {'cached': model_name == 'cached', 'timings': {'run': .05}, 'log_file': None}
+        finally:
+            with self.lock:
+                self.running -= 1
+
+def _stub_training(monkeypatch, trainer):
+    builds = []
+    def fake_build(project_root_dir, container_name, rebuild = False):
+        builds.append(container_name)
+        return 'harborml_{}:latest'.format(container_name)
+    monkeypatch.setattr(core, '_build_container', fake_build)
+    monkeypatch.setattr(core, '_train_model', trainer)
+    return builds
+
+TRAIN_FILES = ['train_a.py', 'train_b.py', 'train_c.py', 'train_cached.py', 'train_e.py', 'train_f.R']
+
+def test_train_many_limits_workers_and_collects_errors(tmp_path, monkeypatch):
+    project_dir = _project(tmp_path)
+    trainer = FakeTrainer(fail = ['b', 'e'])
+    builds = _stub_training(monkeypatch, trainer)
+    jobs = harborml.train_many(project_dir, 'default', TRAIN_FILES, containers = {'train_f.R': 'default_r'}, max_workers = 2)
+    assert trainer.max_running == 2
+    # every image is built once, before the trainings start
+    assert sorted(builds) == ['default', 'default_r']
+    assert [x['train_model_file'] for x in jobs] == TRAIN_FILES
+    assert [x['status'] for x in jobs] == ['ok', 'failed', 'ok', 'cached', 'failed', 'ok']
+    assert jobs[1]['error'] == 'b diverged' and jobs[4]['error'] == 'e diverged'
+    assert all(x['error'] is None for x in jobs if x['status'] != 'failed')
+    assert all(x['seconds'] is not None for x in jobs)
+
+def test_train_models_limits_concurrency(tmp_path, monkeypatch):
+    project_dir = _project(tmp_path)
+    trainer = FakeTrainer(fail = ['c'])
+    builds = _stub_training(monkeypatch, trainer)
+    jobs = asyncio.run(harborml.train_models(project_dir, 'default', TRAIN_FILES, max_concurrency = 3))
+    assert trainer.max_running <= 3
+    assert sorted(builds) == ['default']
+    assert [x['status'] for x in jobs] == ['ok', 'ok', 'failed', 'cached', 'ok', 'ok']
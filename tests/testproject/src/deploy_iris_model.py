@@ -5,3 +5,6 @@ with open('model/iris_model/iris.pkl', 'rb') as f:
 
 def api_predict(data):
     return mdl.predict([data])[0]
+
+def api_predict_batch(data):
+    return mdl.predict(data)